@@ -13,4 +13,23 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """
+    Django doesn't take part in the ASGI lifespan protocol, so it is handled
+    here to close the chat history connection of the server's event loop
+    on shutdown
+    """
+    if scope["type"] != "lifespan":
+        return await django_application(scope, receive, send)
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            from rag.retrieval_qa import aclose_chat_engine
+            await aclose_chat_engine()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,73 @@
+"""
+Load test of the sync and async chat paths against a stub LLM.
+
+The sync path is what a threaded WSGI worker does: one thread per question,
+blocked for the whole generation. The async path keeps every question in
+flight on a single event loop, like the ASGI views do. Both keep the chat
+history in the SQLite checkpointers the server uses.
+
+    python -m benchmarks.async_concurrency --requests 200 --threads 8 --latency 0.5
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.vectorstores import InMemoryVectorStore
+
+from .environment import configure
+from .fakes import SlowChatModel, fake_embeddings
+
+
+def build_engine(latency: float):
+    from rag.checkpointer import create_checkpointer
+    from rag.retrieval_qa import ChatEngine
+    vectorstore = InMemoryVectorStore(fake_embeddings())
+    vectorstore.add_texts([f"Lecture note {i}" for i in range(50)])
+    # The async path opens its checkpointer with acreate_checkpointer() in
+    # the event loop, as the ASGI views do
+    return ChatEngine(
+        SlowChatModel(latency=latency),
+        create_checkpointer(),
+        retriever_factory=lambda course_id, document_ids: vectorstore.as_retriever(search_kwargs={"k": 5}),
+    )
+
+
+def run_sync(engine, requests: int, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda i: engine.invoke([1], "What is covered?", 1, i), range(requests)))
+    return time.perf_counter() - start
+
+
+async def run_async(engine, requests: int) -> float:
+    # Connect before timing, as a server does on its first request
+    await engine.async_graph()
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(engine.ainvoke([1], "What is covered?", 1, i) for i in range(requests)))
+        return time.perf_counter() - start
+    finally:
+        await engine.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8, help="worker threads for the sync path")
+    parser.add_argument("--latency", type=float, default=0.5, help="stub LLM latency in seconds")
+    args = parser.parse_args()
+    configure(tempfile.mkdtemp(prefix="bench-async-"))
+
+    engine = build_engine(args.latency)
+    sync_time = run_sync(engine, args.requests, args.threads)
+    async_time = asyncio.run(run_async(engine, args.requests))
+
+    print(f"{args.requests} questions, stub LLM latency {args.latency}s")
+    print(f"sync  ({args.threads} threads): {sync_time:.2f}s, {args.requests / sync_time:.1f} req/s")
+    print(f"async (1 event loop): {async_time:.2f}s, {args.requests / async_time:.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
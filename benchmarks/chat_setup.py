@@ -0,0 +1,105 @@
+"""
+Micro-benchmark for the per-request setup cost of the chat endpoint.
+
+"before" rebuilds what get_chain used to build on every question (State,
+prompt, RunnableSequence, RetrievalQA, SqliteSaver and the compiled graph).
+"after" is what is left per request with the shared ChatEngine: the graph
+config and a filtered retriever.
+
+    python -m benchmarks.chat_setup --iterations 200
+"""
+import argparse
+import sqlite3
+import tempfile
+import time
+from typing import Annotated
+
+from typing_extensions import TypedDict
+from langchain.chains import RetrievalQA
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableSequence
+from langchain_core.vectorstores import InMemoryVectorStore
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph import StateGraph, START, END
+from langgraph.graph.message import add_messages
+
+from .environment import configure
+from .fakes import fake_embeddings, fake_llm
+
+
+def legacy_setup(llm, vectorstore, conn, document_ids):
+    retriever = vectorstore.as_retriever(
+        search_kwargs={"k": 5, "filter": lambda doc: doc.metadata["id"] in document_ids}
+    )
+
+    class State(TypedDict):
+        messages: Annotated[list, add_messages]
+
+    prompt = ChatPromptTemplate.from_messages([
+        "You are an educational assistant.",
+        MessagesPlaceholder(variable_name="messages", optional=True),
+        ("user", "{input}")
+    ])
+    rag_chain = RunnableSequence(
+        lambda inputs: {"messages": inputs["messages"], "input": inputs["query"]},
+        prompt,
+        lambda input_with_prompt: {"query": input_with_prompt.to_string()},
+        RetrievalQA.from_chain_type(
+            retriever=retriever, llm=llm, chain_type="stuff", output_key="result",
+        ),
+        lambda result: AIMessage(content=result["result"]),
+    )
+
+    def chatbot(state: State):
+        return {"messages": [rag_chain.invoke(state)]}
+
+    graph_builder = StateGraph(State)
+    graph_builder.add_node("chatbot", chatbot)
+    graph_builder.add_edge(START, "chatbot")
+    graph_builder.add_edge("chatbot", END)
+    return graph_builder.compile(checkpointer=SqliteSaver(conn))
+
+
+def engine_setup(engine, vectorstore, document_ids):
+    config = engine.config(document_ids, course_id=1, user_id=1)
+    vectorstore.as_retriever(
+        search_kwargs={"k": 5, "filter": lambda doc: doc.metadata["id"] in document_ids}
+    )
+    return config
+
+
+def timed(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    configure(tempfile.mkdtemp(prefix="bench-chat-setup-"))
+    from rag.retrieval_qa import ChatEngine
+
+    llm = fake_llm()
+    vectorstore = InMemoryVectorStore(fake_embeddings())
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    document_ids = [1, 2, 3]
+
+    build_start = time.perf_counter()
+    engine = ChatEngine(llm, SqliteSaver(conn))
+    build_once = time.perf_counter() - build_start
+
+    before = timed(lambda: legacy_setup(llm, vectorstore, conn, document_ids), args.iterations)
+    after = timed(lambda: engine_setup(engine, vectorstore, document_ids), args.iterations)
+
+    print(f"ChatEngine build (once per process): {build_once * 1000:.3f} ms")
+    print(f"setup per request before: {before * 1000:.3f} ms")
+    print(f"setup per request after:  {after * 1000:.3f} ms")
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
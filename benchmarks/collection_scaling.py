@@ -0,0 +1,63 @@
+"""
+Query latency against corpus size for one global collection filtered by
+document id (the old layout) and one collection per course (the new one).
+The course being queried always has the same number of chunks; only the
+rest of the deployment grows.
+
+    python -m benchmarks.collection_scaling --sizes 10000 50000 100000
+"""
+import argparse
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+DIMENSIONS = 384
+CHUNKS_PER_COURSE = 2000
+DOCUMENTS_PER_COURSE = 5
+
+
+def add(collection, ids, embeddings, metadatas, batch_size=5000):
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        collection.add(ids=ids[start:end], embeddings=embeddings[start:end], metadatas=metadatas[start:end])
+
+
+def measure(collection, queries, where=None) -> float:
+    start = time.perf_counter()
+    for query in queries:
+        collection.query(query_embeddings=[query], n_results=5, where=where)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = rng.random((args.queries, DIMENSIONS)).tolist()
+    print(f"{'total chunks':>12} {'global + $in':>14} {'per course':>12}")
+    for size in args.sizes:
+        client = chromadb.PersistentClient(path=tempfile.mkdtemp(prefix="bench-chroma-"))
+        courses = max(1, size // CHUNKS_PER_COURSE)
+        global_collection = client.create_collection("documents")
+        for course in range(courses):
+            embeddings = rng.random((CHUNKS_PER_COURSE, DIMENSIONS)).tolist()
+            ids = [f"{course}_{i}" for i in range(CHUNKS_PER_COURSE)]
+            metadatas = [{"id": course * DOCUMENTS_PER_COURSE + i % DOCUMENTS_PER_COURSE}
+                         for i in range(CHUNKS_PER_COURSE)]
+            add(global_collection, ids, embeddings, metadatas)
+            if course == 0:
+                add(client.create_collection("course_0"), ids, embeddings, metadatas)
+
+        document_ids = list(range(DOCUMENTS_PER_COURSE))
+        before = measure(global_collection, queries, where={"id": {"$in": document_ids}})
+        after = measure(client.get_collection("course_0"), queries, where={"id": {"$in": document_ids}})
+        print(f"{courses * CHUNKS_PER_COURSE:>12} {before:>12.2f}ms {after:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Generated course material for benchmarks: deterministic lecture-like text
+written out as PDF, DOCX and TXT files of a given size.
+"""
+import os
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+import fitz
+
+WORDS_PER_PAGE = 400
+
+TOPICS = (
+    "entropy", "enthalpy", "photosynthesis", "mitochondria", "recursion", "eigenvalues", "inflation",
+    "supply", "demand", "osmosis", "algorithm", "integral", "derivative", "momentum", "velocity",
+    "catalyst", "genome", "protein", "circuit", "voltage", "semantics", "syntax", "theorem", "lemma",
+)
+FILLER = (
+    "the", "a", "of", "and", "in", "is", "to", "that", "which", "describes", "explains", "shows",
+    "lecture", "week", "example", "system", "process", "model", "result", "students", "course",
+    "first", "second", "law", "rate", "change", "energy", "value", "function", "structure",
+)
+FORMATS = ("pdf", "docx", "txt")
+
+
+def paragraphs(seed: int, pages: int) -> list[str]:
+    """About WORDS_PER_PAGE words per page, in paragraphs of 40-80 words"""
+    rng = random.Random(seed)
+    result, remaining = [], pages * WORDS_PER_PAGE
+    while remaining > 0:
+        length = min(remaining, rng.randint(40, 80))
+        words = [rng.choice(TOPICS) if rng.random() < 0.15 else rng.choice(FILLER) for _ in range(length)]
+        result.append(" ".join(words).capitalize() + ".")
+        remaining -= length
+    return result
+
+
+def write_txt(path: str, texts: list[str]) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("\n\n".join(texts))
+
+
+def write_pdf(path: str, texts: list[str], pages: int) -> None:
+    """A text PDF (no images, so no OCR) with the paragraphs spread over the pages"""
+    doc = fitz.open()
+    per_page = max(1, -(-len(texts) // pages))
+    for start in range(0, len(texts), per_page):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (50, 50, -50, -50), "\n".join(texts[start:start + per_page]), fontsize=7)
+    doc.save(path)
+    doc.close()
+
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+
+
+def write_docx(path: str, texts: list[str]) -> None:
+    """A minimal WordprocessingML package, enough for docx2txt"""
+    body = "".join(f"<w:p><w:r><w:t>{escape(text)}</w:t></w:r></w:p>" for text in texts)
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{body}</w:body></w:document>'
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as package:
+        package.writestr("[Content_Types].xml", CONTENT_TYPES)
+        package.writestr("_rels/.rels", RELATIONSHIPS)
+        package.writestr("word/document.xml", document)
+
+
+def make_corpus(directory: str, files: int, pages: int, formats=FORMATS) -> list[str]:
+    """
+    Writes `files` documents of `pages` pages in each format and returns
+    their paths. The same arguments always produce the same text.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for file_format in formats:
+        for i in range(files):
+            path = os.path.join(directory, f"lecture_{i}.{file_format}")
+            texts = paragraphs(seed=i, pages=pages)
+            if file_format == "pdf":
+                write_pdf(path, texts, pages)
+            elif file_format == "docx":
+                write_docx(path, texts)
+            else:
+                write_txt(path, texts)
+            paths.append(path)
+    return paths
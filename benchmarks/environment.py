@@ -0,0 +1,42 @@
+"""
+Standalone Django configuration for benchmarks: everything (database,
+Chroma, caches, chat history) lives in a scratch directory and the embedding
+model and LLM are replaced with the deterministic fakes.
+"""
+import os
+
+import django
+from django.conf import settings
+
+from .fakes import fake_embeddings, fake_llm
+
+
+def configure(workdir: str, llm=None, **overrides) -> None:
+    os.makedirs(workdir, exist_ok=True)
+    # Chroma and the chat history use paths relative to the working directory
+    os.chdir(workdir)
+    settings.configure(
+        SECRET_KEY="benchmark",
+        DEBUG=False,
+        USE_TZ=True,
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "rag",
+        ],
+        DATABASES={"default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.path.join(workdir, "db.sqlite3"),
+        }},
+        DEFAULT_AUTO_FIELD="django.db.models.BigAutoField",
+        MEDIA_ROOT=os.path.join(workdir, "media"),
+        MAX_UPLOAD_SIZE=3 * 1024 * 1024,
+        FILE_EXTENSIONS=[".pdf", ".docx", ".txt", ".pptx", ".png", ".jpg", ".jpeg"],
+        RAG_INGEST_CACHE_PATH=os.path.join(workdir, "ingest_cache.sqlite3"),
+        **overrides,
+    )
+    django.setup()
+
+    from rag import clients
+    clients.get_embed_model.set_instance(fake_embeddings())
+    clients.get_llm.set_instance(llm or fake_llm())
@@ -0,0 +1,85 @@
+"""
+Deterministic stand-ins for the embedding model and the LLM so benchmarks
+run offline and measure our code rather than the model.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import time
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+def fake_embeddings(size: int = 384) -> DeterministicFakeEmbedding:
+    """Same dimensionality as all-MiniLM-L6-v2"""
+    return DeterministicFakeEmbedding(size=size)
+
+
+def fake_llm(response: str = "This is a benchmark answer.") -> FakeListChatModel:
+    return FakeListChatModel(responses=[response])
+
+
+class SlowChatModel(BaseChatModel):
+    """
+    Answers after a fixed delay, standing in for an Ollama generation.
+    The sync path blocks its thread, the async path only yields to the loop.
+    """
+    latency: float = 1.0
+    response: str = "This is a benchmark answer."
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-fake"
+
+    def _result(self) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._result()
+
+
+def tutor_reply(prompt: str, answer: str) -> str:
+    """
+    `answer`, or for a quiz prompt the number of questions it asks for, in
+    the JSON the quiz parser expects. Questions are derived from the prompt
+    so different batches don't repeat each other.
+    """
+    match = re.search(r"Generate exactly (\d+) quiz questions", prompt)
+    if match is None:
+        return answer
+    seed = hashlib.sha256(prompt.encode()).hexdigest()[:12]
+    return json.dumps({"quiz": [{
+        "question": f"Benchmark question {seed}-{i}?",
+        "options": ["First", "Second", "Third", "Fourth"],
+        "answer": "ABCD"[i % 4],
+        "explanation": "The context states it.",
+    } for i in range(int(match.group(1)))]})
+
+
+class TutorChatModel(SlowChatModel):
+    """
+    Answers questions like SlowChatModel and quiz prompts with parseable
+    quiz JSON (see tutor_reply)
+    """
+    latency: float = 0.0
+
+    def _reply(self, messages) -> str:
+        return tutor_reply("\n".join(str(message.content) for message in messages), self.response)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
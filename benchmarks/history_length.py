@@ -0,0 +1,88 @@
+"""
+Per-turn latency and prompt size of one chat thread as it grows.
+
+"before" sends the whole thread with every question (the window and the
+summaries are switched off), "after" uses the default history budget with
+rolling summaries. The LLM is a fake that answers instantly and records how
+many tokens each prompt had, so the latency is our own overhead
+(checkpoint reads/writes and prompt building). Summaries run after the
+answer, so they are waited for between turns but not timed.
+
+    python -m benchmarks.history_length --turns 200
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.vectorstores import InMemoryVectorStore
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from .environment import configure
+from .fakes import fake_embeddings
+
+
+class PromptSizeModel(FakeListChatModel):
+    """Answers with a fixed paragraph and records each prompt's size"""
+    prompt_tokens: list = []
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        from rag.retrieval_qa import count_tokens
+        self.prompt_tokens.append(count_tokens(messages))
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+
+def run(engine, llm, turns: int, report_every: int) -> list[tuple[int, float, int]]:
+    rows = []
+    for turn in range(1, turns + 1):
+        start = time.perf_counter()
+        engine.invoke([1], f"Question {turn}: can you explain topic {turn} in more detail?", 1, 1)
+        elapsed = time.perf_counter() - start
+        # The answer prompt is the turn's last call before invoke returns
+        tokens = llm.prompt_tokens[-1]
+        # Lets the background summary finish so it doesn't overlap the next turn
+        engine._summaries.submit(lambda: None).result()
+        if turn % report_every == 0:
+            rows.append((turn, elapsed, tokens))
+    return rows
+
+
+def build(workdir: str, name: str, **history):
+    from rag.retrieval_qa import ChatEngine
+    llm = PromptSizeModel(responses=["An answer of about a paragraph. " * 12], prompt_tokens=[])
+    vectorstore = InMemoryVectorStore(fake_embeddings())
+    vectorstore.add_texts([f"Lecture note {i}" for i in range(50)])
+    conn = sqlite3.connect(os.path.join(workdir, f"{name}.sqlite3"), check_same_thread=False)
+    engine = ChatEngine(
+        llm,
+        SqliteSaver(conn),
+        retriever_factory=lambda course_id, document_ids: vectorstore.as_retriever(search_kwargs={"k": 5}),
+        summary_workers=1,
+        **history,
+    )
+    return engine, llm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--report-every", type=int, default=25)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench-history-")
+    configure(workdir)
+
+    unbounded = 10 ** 9
+    for label, history in (
+        ("before", {"history_tokens": unbounded, "summarize_after": unbounded}),
+        ("after", {}),
+    ):
+        engine, llm = build(workdir, label, **history)
+        print(f"{label}:")
+        for turn, elapsed, tokens in run(engine, llm, args.turns, args.report_every):
+            print(f"  turn {turn:>4}: {elapsed * 1000:8.2f} ms, answer prompt ~{tokens} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Peak RSS of storing a large document's chunks in Chroma, comparing the old
+single embed/add call (with the chunk text duplicated into the metadata)
+against batched insertion.
+
+    python -m benchmarks.ingest_memory --chunks 20000
+"""
+import argparse
+import multiprocessing
+import queue
+import random
+import resource
+import string
+import tempfile
+
+from .environment import configure
+
+
+def chunks(count: int):
+    from langchain.schema import Document
+    rng = random.Random(0)
+    for i in range(count):
+        text = "".join(rng.choices(string.ascii_lowercase + " ", k=1000))
+        yield Document(page_content=f"chunk {i} {text}")
+
+
+def legacy_store(doc_id, course_id, docs):
+    """store_in_chromadb before batching"""
+    from rag.clients import get_embed_model
+    from rag.doc_add import get_collection
+    docs = list(docs)
+    texts = [doc.page_content for doc in docs]
+    embeddings = get_embed_model().embed_documents(texts)
+    get_collection(course_id).add(
+        ids=[f"{doc_id}_{i}" for i in range(len(docs))],
+        documents=texts,
+        embeddings=embeddings,
+        metadatas=[{"text": docs[i].page_content, "id": doc_id} for i in range(len(docs))]
+    )
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def create_document():
+    """The course and document rows the keyword index refers to"""
+    from django.contrib.auth.models import User
+    from rag.models import Courses, Documents, Libraries
+    user = User.objects.create_user(username="benchmark", password="benchmark")
+    library = Libraries.objects.create(creator=user, library_name="Benchmark", library_description="")
+    course = Courses.objects.create(course_name="Benchmark", course_description="", library=library)
+    return Documents.objects.create(user=user, course=course, file="benchmark.txt")
+
+
+def run(variant: str, count: int, batch_size: int, results) -> None:
+    configure(tempfile.mkdtemp(prefix=f"bench-{variant}-"), RAG_EMBED_BATCH_SIZE=batch_size)
+    from django.core.management import call_command
+    call_command("migrate", run_syncdb=True, verbosity=0)
+    from rag.doc_add import get_collection, store_in_chromadb
+    document = create_document()
+    get_collection(document.course_id)
+    baseline = peak_rss_mb()
+    store = legacy_store if variant == "before" else store_in_chromadb
+    store(document.id, document.course_id, chunks(count))
+    results.put((variant, baseline, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=64, help="RAG_EMBED_BATCH_SIZE for the batched run")
+    args = parser.parse_args()
+
+    # Each variant gets a fresh process so peak RSS isn't shared
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    for variant in ("before", "after"):
+        process = ctx.Process(target=run, args=(variant, args.chunks, args.batch_size, results))
+        process.start()
+        process.join()
+        try:
+            # Empty if the child crashed, whose traceback is already printed
+            name, baseline, peak = results.get(timeout=5)
+        except queue.Empty:
+            raise SystemExit(f"the {variant} run failed (exit code {process.exitcode})")
+        print(f"{name:<6} peak RSS {peak:8.1f}MB  (+{peak - baseline:.1f}MB for {args.chunks} chunks)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Replays recorded API traffic against a running backend and reports
+throughput, latency percentiles and error rates per endpoint.
+
+    python -m benchmarks.loadtest benchmarks/traffic/sample.jsonl \\
+        --base-url http://127.0.0.1:8000 --concurrency 16 --rate 20 \\
+        --var library_id=1 --var course_id=1 --var document_id=1 --stub-ollama 11435
+
+Every line of the traffic file is one request:
+
+    {"t": 0.4, "user": "alice", "method": "GET", "path": "/question",
+     "params": {"query": "What is entropy?", "course_id": "${course_id}", "library_id": "${library_id}"}}
+
+  t        seconds since the recording started (optional, see --speed)
+  user     whose tokens the request is sent with; users are logged in once
+           before the replay with the credentials of their first
+           /auth/login/ request
+  params   query string, data: form fields, files: {field: file or [files]}
+           where a file is a path relative to the traffic file or
+           {"name": ..., "content": ...}
+  ${name}  replaced in every string with the value given by --var name=value
+
+Without --rate the requests keep their recorded spacing (divided by
+--speed), or are sent back to back if the file has no timestamps.
+The backend's LLM calls can go to the stub Ollama server started with
+--stub-ollama (run the backend with OLLAMA_HOST pointing at it).
+"""
+import argparse
+import json
+import math
+import mimetypes
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+LOGIN_PATH = "/auth/login/"
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile (q in 0-100) of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def substitute(value, variables: dict):
+    if isinstance(value, str):
+        return re.sub(r"\$\{(\w+)\}", lambda match: variables.get(match.group(1), match.group(0)), value)
+    if isinstance(value, list):
+        return [substitute(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute(item, variables) for key, item in value.items()}
+    return value
+
+
+def load_traffic(path: str, variables: dict) -> list[dict]:
+    records = []
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            record = substitute(json.loads(line), variables)
+            if "path" not in record:
+                raise ValueError(f"{path}:{number}: a request needs a path")
+            records.append(record)
+    return records
+
+
+def _file_part(spec, base_dir: str) -> tuple[str, bytes]:
+    if isinstance(spec, dict):
+        return spec["name"], spec["content"].encode()
+    with open(os.path.join(base_dir, spec), "rb") as file:
+        return os.path.basename(spec), file.read()
+
+
+def multipart(data: dict, files: dict, base_dir: str) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in data.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, specs in files.items():
+        for spec in specs if isinstance(specs, list) else [specs]:
+            filename, content = _file_part(spec, base_dir)
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n".encode() + content + b"\r\n"
+            )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class Replayer:
+    def __init__(self, base_url: str, base_dir: str, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.base_dir = base_dir
+        self.timeout = timeout
+        self.tokens: dict[str, str] = {}
+
+    def build(self, record: dict) -> Request:
+        method = record.get("method", "GET").upper()
+        url = self.base_url + record["path"]
+        if record.get("params"):
+            url += "?" + urlencode(record["params"], doseq=True)
+        headers, body = {}, None
+        if record.get("files"):
+            body, headers["Content-Type"] = multipart(record.get("data", {}), record["files"], self.base_dir)
+        elif "data" in record:
+            body, headers["Content-Type"] = json.dumps(record["data"]).encode(), "application/json"
+        token = self.tokens.get(record.get("user"))
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        return Request(url, data=body, headers=headers, method=method)
+
+    def send(self, record: dict) -> tuple[int | None, float, bytes]:
+        """Status (None on a connection error), seconds and body"""
+        start = time.perf_counter()
+        try:
+            with urlopen(self.build(record), timeout=self.timeout) as response:
+                # Streamed answers are timed until their last byte
+                body = response.read()
+                return response.status, time.perf_counter() - start, body
+        except HTTPError as error:
+            return error.code, time.perf_counter() - start, error.read()
+        except (URLError, OSError):
+            return None, time.perf_counter() - start, b""
+
+    def login(self, records: list[dict]) -> None:
+        for record in records:
+            user = record.get("user")
+            if record["path"] != LOGIN_PATH or not user or user in self.tokens:
+                continue
+            status, _, body = self.send(record)
+            if status != 200:
+                print(f"warning: logging in {user} failed ({status})", file=sys.stderr)
+                continue
+            self.tokens[user] = json.loads(body)["access"]
+
+
+def schedule(records: list[dict], rate: float | None, speed: float) -> list[float]:
+    """Seconds after the start at which each request is sent"""
+    if rate:
+        return [i / rate for i in range(len(records))]
+    if all("t" in record for record in records):
+        first = records[0]["t"] if records else 0
+        return [(record["t"] - first) / speed for record in records]
+    return [0.0] * len(records)
+
+
+def replay(replayer: Replayer, records: list[dict], offsets: list[float], concurrency: int) -> tuple[list, float]:
+    """
+    Sends the requests from `concurrency` threads, each no earlier than its
+    offset. Returns (endpoint, status, seconds, lag) per request and the
+    wall time; lag is how late a request was sent because every thread was
+    busy, which means the backend can't keep up with the rate.
+    """
+    pending = queue.Queue()
+    for record, offset in sorted(zip(records, offsets), key=lambda pair: pair[1]):
+        pending.put((record, offset))
+    results, lock = [], threading.Lock()
+    start = time.perf_counter()
+
+    def worker():
+        while True:
+            try:
+                record, offset = pending.get_nowait()
+            except queue.Empty:
+                return
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lag = max(0.0, time.perf_counter() - start - offset)
+            status, seconds, _ = replayer.send(record)
+            with lock:
+                results.append((record.get("name") or record["path"], status, seconds, lag))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def report(results: list, wall: float) -> dict:
+    by_endpoint = defaultdict(list)
+    for endpoint, status, seconds, lag in results:
+        by_endpoint[endpoint].append((status, seconds, lag))
+    by_endpoint["total"] = [result[1:] for result in results]
+
+    summary = {}
+    for endpoint, rows in by_endpoint.items():
+        times = sorted(seconds for _, seconds, _ in rows)
+        errors = sum(1 for status, _, _ in rows if status is None or status >= 400)
+        summary[endpoint] = {
+            "requests": len(rows),
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "throughput": round(len(rows) / wall, 2) if wall else 0.0,
+            "statuses": dict(sorted((str(status), sum(1 for row in rows if row[0] == status))
+                                    for status in {row[0] for row in rows})),
+            "mean_ms": round(sum(times) / len(times) * 1000, 1) if times else 0.0,
+            **{f"p{q}_ms": round(percentile(times, q) * 1000, 1) for q in (50, 95, 99)},
+            "max_lag_ms": round(max(lag for _, _, lag in rows) * 1000, 1) if rows else 0.0,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("traffic", help="JSONL file of recorded requests")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at most")
+    parser.add_argument("--rate", type=float, help="Requests per second, ignoring the recorded timing")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay the recorded timing this many times faster")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the traffic this many times in a row")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds before a request is abandoned")
+    parser.add_argument("--var", action="append", default=[], metavar="NAME=VALUE",
+                        help="Value substituted for ${NAME} in the traffic")
+    parser.add_argument("--skip-login", action="store_true",
+                        help="Don't log users in before the replay (e.g. the file has no login requests)")
+    parser.add_argument("--stub-ollama", type=int, metavar="PORT", help="Serve a stub Ollama on this port")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds the stub Ollama takes per call")
+    parser.add_argument("--output", help="Also write the report as JSON")
+    args = parser.parse_args()
+
+    variables = dict(var.split("=", 1) for var in args.var)
+    records = load_traffic(args.traffic, variables)
+    if args.stub_ollama:
+        from .stub_ollama import serve
+        serve(args.stub_ollama, latency=args.llm_latency, background=True)
+        print(f"stub Ollama on http://127.0.0.1:{args.stub_ollama}")
+
+    replayer = Replayer(args.base_url, os.path.dirname(os.path.abspath(args.traffic)), args.timeout)
+    if not args.skip_login:
+        replayer.login(records)
+
+    offsets = schedule(records, args.rate, args.speed)
+    span = (max(offsets) + (1 / args.rate if args.rate else 0)) if offsets else 0
+    records = records * args.repeat
+    offsets = [offset + round_number * span for round_number in range(args.repeat) for offset in offsets]
+
+    results, wall = replay(replayer, records, offsets, args.concurrency)
+    summary = report(results, wall)
+
+    print(f"{len(results)} requests in {wall:.1f}s at concurrency {args.concurrency}")
+    print(f"{'endpoint':<24} {'requests':>8} {'errors':>7} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'lag ms':>8}")
+    for endpoint, row in sorted(summary.items(), key=lambda item: item[0] == "total"):
+        print(f"{endpoint:<24} {row['requests']:>8} {row['error_rate']:>7.1%} {row['throughput']:>7.2f} "
+              f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_lag_ms']:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"base_url": args.base_url, "concurrency": args.concurrency, "rate": args.rate,
+                       "wall_seconds": round(wall, 3), "endpoints": summary}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of PDF extraction on a generated scanned document: every page is
+a single image of rendered text, so all of the work is Tesseract OCR.
+
+    python -m benchmarks.pdf_extraction --pages 60 --workers 8
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import fitz
+import pytesseract
+
+from rag.pdf_extract import extract_pdf_text
+
+LOREM = (
+    "Lecture {page}: Thermodynamics. The first law states that energy is conserved. "
+    "Entropy of an isolated system never decreases. Course code PHY 201, week {page}.\n"
+)
+
+
+def make_scanned_pdf(path: str, pages: int) -> None:
+    """Renders text pages to images and stores the images as a new PDF"""
+    out = fitz.open()
+    for page_number in range(pages):
+        source = fitz.open()
+        page = source.new_page()
+        page.insert_textbox(page.rect + (50, 50, -50, -50), LOREM.format(page=page_number) * 12, fontsize=11)
+        pixmap = page.get_pixmap(dpi=150)
+        scanned = out.new_page(width=page.rect.width, height=page.rect.height)
+        scanned.insert_image(scanned.rect, pixmap=pixmap)
+        source.close()
+    out.save(path)
+
+
+def legacy_extract(file_path: str) -> str:
+    """insert_pdf before this change: serial pages and repeated concatenation"""
+    doc = fitz.open(file_path)
+    text = ""
+    for page in doc:
+        text += page.get_text()
+        for image in page.get_images(full=True):
+            pix_pil = fitz.Pixmap(doc, image[0]).pil_image()
+            text += pytesseract.image_to_string(pix_pil)
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "scanned.pdf")
+        make_scanned_pdf(path, args.pages)
+
+        start = time.perf_counter()
+        before = legacy_extract(path)
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        after = extract_pdf_text(path, workers=args.workers)
+        parallel = time.perf_counter() - start
+
+    assert before == after, "parallel extraction must produce the same text"
+    print(f"{args.pages} scanned pages")
+    print(f"serial:                {serial:.2f}s")
+    print(f"parallel ({args.workers} workers): {parallel:.2f}s")
+    print(f"speedup: {serial / parallel:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
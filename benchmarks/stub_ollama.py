@@ -0,0 +1,139 @@
+"""
+A stand-in for the Ollama server for load tests: answers /api/chat and
+/api/generate after a configurable delay, streaming the reply a word at a
+time, so the backend runs its real Ollama client without a model or GPU.
+Quiz prompts get parseable quiz JSON.
+
+    python -m benchmarks.stub_ollama --port 11435 --latency 0.5
+    OLLAMA_HOST=http://127.0.0.1:11435 python manage.py runserver
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .fakes import tutor_reply
+
+ANSWER = "This is a load test answer drawn from the course material."
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set by serve()
+    latency = 0.0
+    token_delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [{"name": "llama3.2:latest", "model": "llama3.2:latest"}]})
+        elif self.path == "/api/version":
+            self._json({"version": "0.0.0-stub"})
+        else:
+            self._json({"error": "not found"}, status=404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self._json({"error": "invalid JSON"}, status=400)
+            return
+        if self.path == "/api/chat":
+            prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+            self._reply(request, prompt, chat=True)
+        elif self.path == "/api/generate":
+            self._reply(request, request.get("prompt", ""), chat=False)
+        else:
+            self._json({"error": "not found"}, status=404)
+
+    def _chunk(self, request: dict, text: str, chat: bool, done: bool) -> dict:
+        chunk = {
+            "model": request.get("model", "llama3.2:latest"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "done": done,
+        }
+        if chat:
+            chunk["message"] = {"role": "assistant", "content": text}
+        else:
+            chunk["response"] = text
+        return chunk
+
+    def _reply(self, request: dict, prompt: str, chat: bool) -> None:
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        words = tutor_reply(prompt, ANSWER).split(" ")
+        tokens = [word + " " for word in words[:-1]] + words[-1:]
+        final = {
+            "done_reason": "stop",
+            "prompt_eval_count": len(prompt) // 4,
+            "eval_count": len(tokens),
+        }
+
+        if not request.get("stream", True):
+            payload = self._chunk(request, "".join(tokens), chat, done=True)
+            time.sleep(self.token_delay * len(tokens))
+            self._json({**payload, **final, "total_duration": int((time.perf_counter() - start) * 1e9)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            self._write_line(self._chunk(request, token, chat, done=False))
+            time.sleep(self.token_delay)
+        self._write_line({**self._chunk(request, "", chat, done=True), **final,
+                          "total_duration": int((time.perf_counter() - start) * 1e9)})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_line(self, payload: dict) -> None:
+        line = json.dumps(payload).encode() + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(port: int, latency: float = 0.0, token_delay: float = 0.0, host: str = "127.0.0.1",
+          background: bool = False) -> ThreadingHTTPServer:
+    """
+    Starts the stub, in a daemon thread when `background` is set
+    """
+    handler = type("Handler", (StubOllamaHandler,), {"latency": latency, "token_delay": token_delay})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed tokens")
+    args = parser.parse_args()
+    print(f"stub Ollama listening on http://{args.host}:{args.port}")
+    serve(args.port, args.latency, args.token_delay, args.host)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+End-to-end benchmarks of ingestion, chat and quiz generation on a generated
+corpus, with fake embeddings and a fake LLM so they run offline on a CPU.
+Results are written as JSON so runs on different commits can be compared.
+
+    python -m benchmarks.suite --files 3 --pages 20 --output before.json
+    python -m benchmarks.suite --compare before.json after.json
+
+Scenarios:
+  upload    process_file on every generated PDF, DOCX and TXT file
+  question  get_chain with distinct questions over the uploaded documents
+  quiz      get_quiz on the uploaded documents
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from .corpus import FORMATS, TOPICS, make_corpus
+from .environment import configure
+from .fakes import TutorChatModel
+
+SCENARIOS = ("upload", "question", "quiz")
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summary(samples: list[float]) -> dict:
+    """Latency percentiles in milliseconds"""
+    from rag.metrics import percentile
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+        **{f"p{q}_ms": round(percentile(ordered, q) * 1000, 3) for q in (50, 95, 99)},
+    }
+
+
+def stage_totals() -> dict:
+    """
+    Seconds spent per instrumented stage since the last call
+    """
+    from rag.metrics import registry
+    with registry._lock:
+        totals = {labels[0][1]: {"calls": histogram.count, "seconds": round(histogram.sum, 4)}
+                  for (name, labels), histogram in registry.histograms.items()
+                  if name == "rag_stage_duration_seconds"}
+        registry.histograms.clear()
+    return dict(sorted(totals.items()))
+
+
+def create_course():
+    """The rows the keyword index and chat history refer to"""
+    from django.contrib.auth.models import User
+    from rag.models import Courses, Libraries
+    user = User.objects.create_user(username="benchmark", password="benchmark")
+    library = Libraries.objects.create(creator=user, library_name="Benchmark", library_description="")
+    return user, Courses.objects.create(course_name="Benchmark", course_description="", library=library)
+
+
+def run_upload(user, course, paths: list[str]) -> tuple[dict, list[int]]:
+    from rag.clients import get_collection
+    from rag.doc_add import process_file
+    from rag.models import Documents
+    samples = {file_format: [] for file_format in FORMATS}
+    document_ids = []
+    start = time.perf_counter()
+    for path in paths:
+        document = Documents.objects.create(user=user, course=course, file=os.path.basename(path),
+                                            status=Documents.PROCESSING)
+        file_start = time.perf_counter()
+        process_file(path, document.id, course.id)
+        samples[os.path.splitext(path)[1][1:]].append(time.perf_counter() - file_start)
+        document.status = Documents.READY
+        document.save(update_fields=["status"])
+        document_ids.append(document.id)
+    elapsed = time.perf_counter() - start
+    chunks = get_collection(course.id).count()
+    return {
+        "files": len(paths),
+        "chunks": chunks,
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(chunks / elapsed, 1),
+        "formats": {file_format: summary(values) for file_format, values in samples.items() if values},
+    }, document_ids
+
+
+def run_question(course_id: int, document_ids: list[int], questions: int, users: int) -> dict:
+    from rag.retrieval_qa import get_chain
+    rng = random.Random(0)
+    samples = []
+    for i in range(questions):
+        # Distinct questions, so every one goes through retrieval and the LLM
+        query = f"Question {i}: how does {rng.choice(TOPICS)} relate to {rng.choice(TOPICS)}?"
+        start = time.perf_counter()
+        get_chain(document_ids, query, course_id, user_id=i % users + 1)
+        samples.append(time.perf_counter() - start)
+    return summary(samples)
+
+
+def run_quiz(course_id: int, document_ids: list[int], quizzes: int, number_of_questions: int) -> dict:
+    from rag.retrieval_qa import get_quiz
+    samples = []
+    for i in range(quizzes):
+        start = time.perf_counter()
+        get_quiz(course_id, document_ids[i % len(document_ids)], number_of_questions)
+        samples.append(time.perf_counter() - start)
+    return {**summary(samples), "questions_per_quiz": number_of_questions}
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench-suite-")
+    configure(workdir, llm=TutorChatModel(latency=args.llm_latency))
+    from django.core.management import call_command
+    call_command("migrate", run_syncdb=True, verbosity=0)
+    random.seed(0)
+
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": {key: getattr(args, key) for key in
+                   ("files", "pages", "questions", "users", "quizzes", "quiz_questions", "llm_latency")},
+        "scenarios": {},
+    }
+    paths = make_corpus(os.path.join(workdir, "corpus"), args.files, args.pages)
+    user, course = create_course()
+    stage_totals()
+
+    # Questions and quizzes need the documents indexed, so upload always runs
+    upload, document_ids = run_upload(user, course, paths)
+    if "upload" in args.scenarios:
+        results["scenarios"]["upload"] = {**upload, "stages": stage_totals()}
+    stage_totals()
+    if "question" in args.scenarios:
+        results["scenarios"]["question"] = {
+            **run_question(course.id, document_ids, args.questions, args.users), "stages": stage_totals(),
+        }
+    if "quiz" in args.scenarios:
+        results["scenarios"]["quiz"] = {
+            **run_quiz(course.id, document_ids, args.quizzes, args.quiz_questions), "stages": stage_totals(),
+        }
+    return results
+
+
+def compare(base_path: str, new_path: str) -> None:
+    with open(base_path) as file:
+        base = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f"base {base.get('commit') or base_path}")
+    print(f"new  {new.get('commit') or new_path}")
+    if base["params"] != new["params"]:
+        print("warning: the runs used different parameters", file=sys.stderr)
+
+    metrics = ("seconds", "chunks_per_second", "mean_ms", "p50_ms", "p95_ms", "p99_ms")
+    print(f"{'scenario':<10} {'metric':<18} {'base':>10} {'new':>10} {'change':>8}")
+    for scenario in SCENARIOS:
+        if scenario not in base["scenarios"] or scenario not in new["scenarios"]:
+            continue
+        for metric in metrics:
+            before, after = base["scenarios"][scenario].get(metric), new["scenarios"][scenario].get(metric)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+            print(f"{scenario:<10} {metric:<18} {before:>10} {after:>10} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--files", type=int, default=3, help="Generated documents per format")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per generated document")
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--users", type=int, default=5, help="Chat threads the questions are spread over")
+    parser.add_argument("--quizzes", type=int, default=10)
+    parser.add_argument("--quiz-questions", type=int, default=6, help="Questions per quiz")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the fake LLM takes per call")
+    parser.add_argument("--output", help="JSON results file (default bench-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit = git_commit()
+    # Resolved before configure() changes the working directory
+    output = os.path.abspath(args.output or f"bench-{commit[:10] if commit else 'results'}.json")
+    results = run(args)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    for scenario, values in results["scenarios"].items():
+        headline = {key: value for key, value in values.items() if key not in ("stages", "formats")}
+        print(f"{scenario}: {headline}")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ from .models import *
 # Register your models here.
 admin.site.register(Courses)
 admin.site.register(Documents)
+admin.site.register(IngestionJobs)
+admin.site.register(QuizQuestions)
 admin.site.register(Libraries)
 admin.site.register(Admins)
 admin.site.register(Members)
@@ -0,0 +1,146 @@
+"""
+Per-course cache of chat answers, so questions students keep asking don't go
+through retrieval and the LLM every time.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+from django.conf import settings
+
+from .clients import shared, get_embed_model
+from .retrieval_cache import RetrievalCache, get_retrieval_cache
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    expires: float
+    # Of unit length, so its dot product with a query's is their cosine
+    embedding: np.ndarray | None = field(default=None, repr=False)
+
+
+def normalize_query(query: str) -> str:
+    """
+    "What is covered in Week 3?" and "what is covered in week 3" share an entry
+    """
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    Answers are keyed on the course, the set of its documents, the course's
+    index version and the normalised question. Uploading, replacing or
+    deleting a document changes the set or the version, which makes every
+    older answer for the course unreachable in all worker processes;
+    invalidate() also drops them from this one right away.
+
+    Entries expire after `ttl` seconds and the least recently used are
+    evicted past `max_entries`. With a `semantic_threshold`, a question
+    whose embedding is at least that similar to a cached one is a hit too.
+    Only the scope's entries are compared, and outside the lock, so other
+    threads aren't held up by the scan.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600,
+                 semantic_threshold: float | None = None, embed_model=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.embed_model = embed_model
+        self._entries: OrderedDict[tuple, CachedAnswer] = OrderedDict()
+        # The entries with an embedding, by scope
+        self._embedded: dict[tuple, dict[tuple, CachedAnswer]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _scope(course_id: int, document_ids: list[int]) -> tuple:
+        return int(course_id), frozenset(document_ids), RetrievalCache.version(course_id)
+
+    def _embed(self, query: str) -> np.ndarray | None:
+        if self.semantic_threshold is None:
+            return None
+        # Shares the memoized query embeddings with the retriever
+        vector = np.asarray(get_retrieval_cache().embed_query(query, self.embed_model or get_embed_model()),
+                            dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, key: tuple) -> None:
+        """Drops an entry; the lock must be held"""
+        del self._entries[key]
+        embedded = self._embedded.get(key[:3])
+        if embedded is not None:
+            embedded.pop(key, None)
+            if not embedded:
+                del self._embedded[key[:3]]
+
+    def get(self, course_id: int, document_ids: list[int], query: str) -> str | None:
+        scope = self._scope(course_id, document_ids)
+        normalized = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((*scope, normalized))
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end((*scope, normalized))
+                self.hits += 1
+                return entry.answer
+            if entry is not None:
+                self._remove((*scope, normalized))
+
+        if self.semantic_threshold is not None:
+            embedding = self._embed(normalized)
+            with self._lock:
+                candidates = [(key, entry.embedding) for key, entry in self._embedded.get(scope, {}).items()
+                              if entry.expires > now]
+            if candidates:
+                scores = np.stack([vector for _, vector in candidates]) @ embedding
+                best = int(np.argmax(scores))
+                if scores[best] >= self.semantic_threshold:
+                    with self._lock:
+                        # Unless it was evicted in the meantime
+                        entry = self._entries.get(candidates[best][0])
+                        if entry is not None:
+                            self._entries.move_to_end(candidates[best][0])
+                            self.hits += 1
+                            return entry.answer
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, course_id: int, document_ids: list[int], query: str, answer: str) -> None:
+        if not answer:
+            # Every later asker would get the empty answer
+            return
+        normalized = normalize_query(query)
+        entry = CachedAnswer(answer, time.monotonic() + self.ttl, self._embed(normalized))
+        key = (*self._scope(course_id, document_ids), normalized)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            if entry.embedding is not None:
+                self._embedded.setdefault(key[:3], {})[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, course_id: int) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == int(course_id)]:
+                self._remove(key)
+
+
+@shared
+def get_answer_cache() -> AnswerCache:
+    return AnswerCache(
+        max_entries=getattr(settings, "RAG_ANSWER_CACHE_SIZE", 1024),
+        ttl=getattr(settings, "RAG_ANSWER_CACHE_TTL", 3600),
+        semantic_threshold=getattr(settings, "RAG_ANSWER_CACHE_SEMANTIC_THRESHOLD", None),
+    )
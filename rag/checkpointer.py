@@ -0,0 +1,243 @@
+"""
+The chat history store (LangGraph checkpointer) and its upkeep. History is
+kept in a SQLite file by default, or in Postgres through a connection pool
+so that web workers on several nodes share it. In SQLite every turn of every
+thread adds a checkpoint, so old checkpoints and the threads of deleted
+courses and users are pruned periodically.
+"""
+import logging
+import os
+import sqlite3
+import statistics
+import time
+from contextlib import asynccontextmanager
+from itertools import islice
+
+import aiosqlite
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache as django_cache
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from .clients import shared
+from .models import Courses
+
+logger = logging.getLogger(__name__)
+
+# "sqlite" or "postgres"
+CHECKPOINTER = getattr(settings, "RAG_CHECKPOINTER", "sqlite")
+HISTORY_PATH = getattr(settings, "RAG_HISTORY_PATH", "history.sqlite3")
+# libpq connection string of the Postgres history database
+POSTGRES_URL = getattr(settings, "RAG_CHECKPOINTER_POSTGRES_URL", "")
+POOL_MIN_SIZE = getattr(settings, "RAG_CHECKPOINTER_POOL_MIN_SIZE", 2)
+POOL_MAX_SIZE = getattr(settings, "RAG_CHECKPOINTER_POOL_MAX_SIZE", 10)
+# Seconds a request waits for a free pooled connection before failing
+POOL_TIMEOUT = getattr(settings, "RAG_CHECKPOINTER_POOL_TIMEOUT", 30)
+# Seconds an unused connection above the minimum stays open
+POOL_MAX_IDLE = getattr(settings, "RAG_CHECKPOINTER_POOL_MAX_IDLE", 600)
+CONNECT_TIMEOUT = getattr(settings, "RAG_CHECKPOINTER_CONNECT_TIMEOUT", 10)
+# Checkpoints kept per thread; the latest one holds the whole conversation
+CHECKPOINT_KEEP = getattr(settings, "RAG_CHECKPOINT_KEEP", 2)
+# Seconds between the pruning runs of the ingestion workers (None disables them)
+CHECKPOINT_PRUNE_INTERVAL = getattr(settings, "RAG_CHECKPOINT_PRUNE_INTERVAL", 6 * 60 * 60)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    # 64MB page cache and 256MB of memory-mapped reads
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def connect_history(path: str = HISTORY_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+async def aconnect_history(path: str = HISTORY_PATH) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(path)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+def _postgres_pool_options() -> dict:
+    if not POSTGRES_URL:
+        raise ImproperlyConfigured("RAG_CHECKPOINTER_POSTGRES_URL is required with the postgres checkpointer")
+    from psycopg.rows import dict_row
+    return {
+        "conninfo": POSTGRES_URL,
+        "min_size": POOL_MIN_SIZE,
+        "max_size": POOL_MAX_SIZE,
+        "timeout": POOL_TIMEOUT,
+        "max_idle": POOL_MAX_IDLE,
+        # What the Postgres savers expect of their connections
+        "kwargs": {"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row,
+                   "connect_timeout": CONNECT_TIMEOUT},
+    }
+
+
+def create_checkpointer(backend: str = CHECKPOINTER):
+    if backend == "sqlite":
+        return SqliteSaver(connect_history())
+    if backend == "postgres":
+        from langgraph.checkpoint.postgres import PostgresSaver
+        from psycopg_pool import ConnectionPool
+        saver = PostgresSaver(ConnectionPool(open=True, **_postgres_pool_options()))
+        saver.setup()
+        return saver
+    raise ImproperlyConfigured(f"Unknown RAG_CHECKPOINTER {backend!r}, expected \"sqlite\" or \"postgres\"")
+
+
+@asynccontextmanager
+async def acreate_checkpointer(backend: str = CHECKPOINTER):
+    """
+    An async saver whose connection or pool is closed on exit. Async savers
+    are bound to the event loop they are created in, so this has to be
+    entered from inside the running loop.
+    """
+    if backend == "sqlite":
+        conn = await aconnect_history()
+        try:
+            yield AsyncSqliteSaver(conn)
+        finally:
+            await conn.close()
+    elif backend == "postgres":
+        from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+        from psycopg_pool import AsyncConnectionPool
+        async with AsyncConnectionPool(open=False, **_postgres_pool_options()) as pool:
+            saver = AsyncPostgresSaver(pool)
+            await saver.setup()
+            yield saver
+    else:
+        raise ImproperlyConfigured(f"Unknown RAG_CHECKPOINTER {backend!r}, expected \"sqlite\" or \"postgres\"")
+
+
+@shared
+def get_checkpointer():
+    """The process-wide checkpointer, with its connection or pool"""
+    return create_checkpointer()
+
+
+def _chunks(items: list, size: int = 500):
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def dead_threads(thread_ids: list[str]) -> list[str]:
+    """
+    Threads are named "<course_id>_<user_id>"; returns those whose course or
+    user no longer exists
+    """
+    parsed = {}
+    for thread_id in thread_ids:
+        course_id, _, user_id = thread_id.partition("_")
+        if course_id.isdigit() and user_id.isdigit():
+            parsed[thread_id] = (int(course_id), int(user_id))
+
+    courses, users = set(), set()
+    for chunk in _chunks(list({course_id for course_id, _ in parsed.values()})):
+        courses.update(Courses.objects.filter(id__in=chunk).values_list("id", flat=True))
+    for chunk in _chunks(list({user_id for _, user_id in parsed.values()})):
+        users.update(get_user_model().objects.filter(id__in=chunk).values_list("id", flat=True))
+    return [thread_id for thread_id, (course_id, user_id) in parsed.items()
+            if course_id not in courses or user_id not in users]
+
+
+def prune_checkpoints(conn: sqlite3.Connection, keep: int = CHECKPOINT_KEEP, vacuum: bool = True) -> dict:
+    """
+    Keeps the last `keep` checkpoints of every thread, deletes the threads
+    of deleted courses and users and the writes left without a checkpoint,
+    then vacuums the file. Returns how many rows were deleted.
+    """
+    SqliteSaver(conn).setup()
+    thread_ids = [row[0] for row in conn.execute("SELECT DISTINCT thread_id FROM checkpoints")]
+    dead = dead_threads(thread_ids)
+    with conn:
+        for chunk in _chunks(dead):
+            placeholders = ", ".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM checkpoints WHERE thread_id IN ({placeholders})", chunk)
+            conn.execute(f"DELETE FROM writes WHERE thread_id IN ({placeholders})", chunk)
+        # checkpoint ids are time-ordered UUIDs
+        checkpoints = conn.execute("""
+            DELETE FROM checkpoints WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, ROW_NUMBER() OVER (
+                        PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC
+                    ) AS position FROM checkpoints
+                ) WHERE position > ?
+            )
+        """, (keep,)).rowcount
+        writes = conn.execute("""
+            DELETE FROM writes WHERE NOT EXISTS (
+                SELECT 1 FROM checkpoints
+                WHERE checkpoints.thread_id = writes.thread_id
+                  AND checkpoints.checkpoint_ns = writes.checkpoint_ns
+                  AND checkpoints.checkpoint_id = writes.checkpoint_id
+            )
+        """).rowcount
+    if vacuum:
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return {"threads": len(dead), "checkpoints": checkpoints, "writes": writes}
+
+
+def checkpoint_stats(conn: sqlite3.Connection, path: str = HISTORY_PATH, sample: int = 50) -> dict:
+    """
+    Size of the store and the latency of loading the latest checkpoint of
+    up to `sample` threads, as the chat graph does on every request
+    """
+    saver = SqliteSaver(conn)
+    saver.setup()
+    threads, checkpoints = conn.execute(
+        "SELECT COUNT(DISTINCT thread_id), COUNT(*) FROM checkpoints"
+    ).fetchone()
+    writes = conn.execute("SELECT COUNT(*) FROM writes").fetchone()[0]
+    size = sum(os.path.getsize(file) for file in (path, f"{path}-wal") if os.path.exists(file))
+
+    latencies = []
+    for (thread_id,) in conn.execute(
+        "SELECT DISTINCT thread_id FROM checkpoints ORDER BY RANDOM() LIMIT ?", (sample,)
+    ).fetchall():
+        start = time.perf_counter()
+        saver.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+        latencies.append(time.perf_counter() - start)
+    return {
+        "bytes": size,
+        "threads": threads,
+        "checkpoints": checkpoints,
+        "writes": writes,
+        "read_ms_mean": statistics.mean(latencies) * 1000 if latencies else 0.0,
+        "read_ms_max": max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def prune_if_due() -> None:
+    """
+    Called by the ingestion workers between jobs. The key in Django's cache
+    makes sure only one worker prunes per interval when the cache is shared.
+    It doesn't vacuum: VACUUM holds the write lock for its whole run, which
+    on a large file outlasts the chat checkpointer's busy_timeout and fails
+    the requests waiting to save their turn. SQLite reuses the freed pages,
+    so the file stops growing; shrinking it is left to prune_checkpoints.
+    """
+    if not CHECKPOINT_PRUNE_INTERVAL or CHECKPOINTER != "sqlite":
+        return
+    if not django_cache.add("rag:checkpoint_prune", True, timeout=CHECKPOINT_PRUNE_INTERVAL):
+        return
+    conn = connect_history()
+    try:
+        deleted = prune_checkpoints(conn, vacuum=False)
+        logger.info("Pruned chat history: %s", deleted)
+    except Exception:
+        logger.exception("Pruning the chat history failed")
+    finally:
+        conn.close()
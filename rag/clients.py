@@ -0,0 +1,73 @@
+"""
+Process-wide clients shared by ingestion and retrieval. Each one is created
+on first use, so management commands that never embed or query (migrate,
+createsuperuser, ...) don't pay for loading the models.
+"""
+import threading
+from functools import wraps
+
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+
+_lock = threading.RLock()
+
+
+def shared(factory):
+    """
+    Turns a factory into a getter that builds the instance once per process.
+    get.set_instance() replaces it, e.g. with a fake model in benchmarks, and
+    get.existing() returns it only if it has been built.
+    """
+    instance = None
+
+    @wraps(factory)
+    def get():
+        nonlocal instance
+        if instance is None:
+            with _lock:
+                if instance is None:
+                    instance = factory()
+        return instance
+
+    def set_instance(value):
+        nonlocal instance
+        with _lock:
+            instance = value
+
+    def existing():
+        return instance
+
+    get.set_instance = set_instance
+    get.existing = existing
+    return get
+
+
+@shared
+def get_embed_model():
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=EMBED_MODEL_NAME)
+
+
+@shared
+def get_chroma_client():
+    import chromadb
+    return chromadb.PersistentClient()
+
+
+@shared
+def get_llm():
+    from langchain_ollama import ChatOllama
+    return ChatOllama(model="llama3.2:latest",
+                      temperature=0.7
+                      )
+
+
+def collection_name(course_id: int) -> str:
+    """
+    Every course has its own Chroma collection, so search cost follows the
+    size of the course rather than of the whole deployment
+    """
+    return f"course_{course_id}"
+
+
+def get_collection(course_id: int):
+    return get_chroma_client().get_or_create_collection(name=collection_name(course_id))
@@ -1,69 +1,332 @@
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import os
-import fitz
-import pytesseract
-import warnings
+import hashlib
+import logging
+import queue
+import threading
+from array import array
+from collections import Counter, defaultdict
+from itertools import groupby, islice
+from typing import Callable, Iterable, Iterator
+from django.conf import settings
 from langchain_community.document_loaders import Docx2txtLoader, UnstructuredPowerPointLoader, UnstructuredImageLoader, TextLoader
 from langchain.schema import Document
-from langchain_huggingface import HuggingFaceEmbeddings
-import chromadb
-
-embed_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-chroma_client = chromadb.PersistentClient()
-collection = chroma_client.get_or_create_collection(name="documents")
-
-
-def insert_pdf(file_path: str) -> Document:
-    doc = fitz.open(file_path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-        for image in page.get_images(full=True):
-            xref = image[0]
-            pix_pil = fitz.Pixmap(doc, xref).pil_image()
-            text_from_image = pytesseract.image_to_string(pix_pil)
-            text += text_from_image
-    return Document(page_content=text)
-
-
-def store_in_chromadb(doc_id: int, docs: Document) -> None:
-    texts = [doc.page_content for doc in docs]
-    embeddings = embed_model.embed_documents(texts)
-    collection.add(
-        ids=[f"{doc_id}_{i}" for i in range(len(docs))],
-        documents=texts,
-        embeddings=embeddings,
-        metadatas=[{"text": docs[i].page_content, "id":doc_id} for i in range(len(docs))]
-    )
-
-def delete_from_chromadb(doc_id: int) -> None:
-    collection.delete(where={"id": {"$eq": doc_id}})
-
-
-def process_file(file_path: str, doc_id: int) -> None:
+from langchain_core.embeddings import Embeddings
+from .clients import EMBED_MODEL_NAME, collection_name, get_chroma_client, get_collection, get_embed_model
+from .ingest_cache import ContentCache
+from .pdf_extract import iter_pdf_pages
+from .keyword_index import index_chunks, remove_chunks, remove_document
+from .retrieval_cache import RetrievalCache
+from .metrics import span, timed
+
+logger = logging.getLogger(__name__)
+
+# Chunks embedded and inserted into Chroma per call
+EMBED_BATCH_SIZE = getattr(settings, "RAG_EMBED_BATCH_SIZE", 64)
+# Processes used to extract and OCR PDF pages in parallel
+PDF_WORKERS = getattr(settings, "RAG_PDF_WORKERS", os.cpu_count())
+
+INGEST_CACHE_PATH = getattr(settings, "RAG_INGEST_CACHE_PATH", "ingest_cache.sqlite3")
+ocr_cache = ContentCache(INGEST_CACHE_PATH, "ocr",
+                         max_bytes=getattr(settings, "RAG_OCR_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+embedding_cache = ContentCache(INGEST_CACHE_PATH, "embeddings",
+                               max_bytes=getattr(settings, "RAG_EMBEDDING_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so chunk texts that were embedded before are
+    read back from the cache instead of going through the model again.
+    """
+
+    def __init__(self, model: Embeddings, cache: ContentCache, model_name: str):
+        self.model = model
+        self.cache = cache
+        # Vectors from one model must never be served for another
+        self.prefix = f"{model_name}\0".encode()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.prefix + text.encode() for text in texts]
+        vectors = []
+        for key in keys:
+            cached = self.cache.get(key)
+            vectors.append(array("f", cached).tolist() if cached is not None else None)
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self.model.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+                self.cache.set(keys[i], array("f", vector).tobytes())
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.model.embed_query(text)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def chunk_ids(doc_id: int, docs: Iterable[Document]) -> Iterator[tuple[str, Document]]:
+    """
+    Pairs every chunk with an id derived from its text, so editing one page
+    leaves the ids of every other chunk as they were. Repeated texts within
+    the document get an occurrence suffix to stay unique.
+    """
+    occurrences = Counter()
+    for doc in docs:
+        digest = hashlib.sha256(doc.page_content.encode()).hexdigest()[:16]
+        occurrences[digest] += 1
+        suffix = f"_{occurrences[digest]}" if occurrences[digest] > 1 else ""
+        yield f"{doc_id}_{digest}{suffix}", doc
+
+
+@timed("store_in_chromadb")
+def store_in_chromadb(doc_id: int, course_id: int, docs: Iterable[Document],
+                      heartbeat: Callable[[], None] | None = None) -> None:
+    """
+    Embeds and inserts the chunks EMBED_BATCH_SIZE at a time, so memory use
+    stays the same however long the document is. heartbeat() is called
+    after every batch.
+    """
+    embed_model = CachedEmbeddings(get_embed_model(), embedding_cache, EMBED_MODEL_NAME)
+    collection = get_collection(course_id)
+    for batch in batched(chunk_ids(doc_id, docs), EMBED_BATCH_SIZE):
+        ids = [chunk_id for chunk_id, _ in batch]
+        texts = [doc.page_content for _, doc in batch]
+        with span("embed"):
+            embeddings = embed_model.embed_documents(texts)
+        with span("chroma_add"):
+            collection.add(
+                ids=ids,
+                documents=texts,
+                embeddings=embeddings,
+                metadatas=[{**doc.metadata, "id": doc_id} for _, doc in batch]
+            )
+        with span("keyword_index"):
+            index_chunks(course_id, doc_id, ids, texts)
+        if heartbeat:
+            heartbeat()
+    RetrievalCache.bump_version(course_id)
+
+
+@timed("reindex_in_chromadb")
+def reindex_in_chromadb(doc_id: int, course_id: int, docs: Iterable[Document],
+                        heartbeat: Callable[[], None] | None = None) -> dict:
+    """
+    Brings the stored chunks of a document in line with `docs`: only chunks
+    whose text is new are embedded and added, chunks that merely moved get
+    their metadata updated, and chunks no longer present are deleted.
+    Returns how many chunks were added, updated, kept and removed.
+    """
+    embed_model = CachedEmbeddings(get_embed_model(), embedding_cache, EMBED_MODEL_NAME)
+    collection = get_collection(course_id)
+    existing = collection.get(where={"id": doc_id}, include=["metadatas"])
+    stored = dict(zip(existing["ids"], existing["metadatas"]))
+    counts = Counter()
+    seen = set()
+    for batch in batched(chunk_ids(doc_id, docs), EMBED_BATCH_SIZE):
+        added, moved = [], []
+        for chunk_id, doc in batch:
+            seen.add(chunk_id)
+            metadata = {**doc.metadata, "id": doc_id}
+            if chunk_id not in stored:
+                added.append((chunk_id, doc.page_content, metadata))
+            elif stored[chunk_id] != metadata:
+                moved.append((chunk_id, metadata))
+        if added:
+            ids, texts, metadatas = map(list, zip(*added))
+            with span("embed"):
+                embeddings = embed_model.embed_documents(texts)
+            collection.add(ids=ids, documents=texts, embeddings=embeddings, metadatas=metadatas)
+            index_chunks(course_id, doc_id, ids, texts)
+        if moved:
+            ids, metadatas = map(list, zip(*moved))
+            collection.update(ids=ids, metadatas=metadatas)
+        counts["added"] += len(added)
+        counts["updated"] += len(moved)
+        counts["kept"] += len(batch) - len(added) - len(moved)
+        if heartbeat:
+            heartbeat()
+
+    orphans = [chunk_id for chunk_id in stored if chunk_id not in seen]
+    for batch in batched(orphans, EMBED_BATCH_SIZE):
+        collection.delete(ids=batch)
+        remove_chunks(doc_id, batch)
+    counts["removed"] = len(orphans)
+    RetrievalCache.bump_version(course_id)
+    return dict(counts)
+
+
+def delete_from_chromadb(doc_id: int, course_id: int) -> None:
+    get_collection(course_id).delete(where={"id": {"$eq": doc_id}})
+    remove_document(doc_id)
+    RetrievalCache.bump_version(course_id)
+
+
+def delete_course_collection(course_id: int) -> None:
+    client = get_chroma_client()
+    # Created first so deleting a course that never had documents doesn't fail
+    client.get_or_create_collection(name=collection_name(course_id))
+    client.delete_collection(collection_name(course_id))
+    RetrievalCache.bump_version(course_id)
+
+
+def load_pages(file_path: str, pdf_workers: int = PDF_WORKERS) -> Iterator[Document]:
+    """
+    Returns an iterator over the file one page at a time (one slide for
+    PowerPoint, the whole file for formats without pages). Every page
+    carries its page number and source type in the metadata.
+    """
     file_type = file_path.split(".")[-1].lower()
     if file_type == "docx":
-        docs = Docx2txtLoader(file_path).load()
+        loader = Docx2txtLoader(file_path)
 
     elif file_type == "pdf":
-        docs = insert_pdf(file_path)
+        texts = iter_pdf_pages(file_path, workers=pdf_workers, ocr_cache=ocr_cache)
+        return (Document(page_content=text, metadata={"page": number, "source_type": file_type})
+                for number, text in enumerate(texts, start=1))
 
     elif file_type == "pptx":
-        docs = UnstructuredPowerPointLoader(file_path).load()
+        return _group_slides(UnstructuredPowerPointLoader(file_path, mode="elements").lazy_load())
 
-    elif file_type in [".png", ".jpg", ".jpeg"]:
-        docs = UnstructuredImageLoader(file_path).load()
+    elif file_type in ["png", "jpg", "jpeg"]:
+        loader = UnstructuredImageLoader(file_path)
 
     elif file_type == "txt":
-        docs = TextLoader(file_path, encoding="utf-8").load()
+        loader = TextLoader(file_path, encoding="utf-8")
 
     else:
         raise ValueError("Invalid file type")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    if file_type == "pdf":
-        docs = text_splitter.split_documents([docs])
-    else:
-        docs = text_splitter.split_documents(docs)
 
-    store_in_chromadb(doc_id, docs)
\ No newline at end of file
+    return (Document(page_content=doc.page_content, metadata={"page": number, "source_type": file_type})
+            for number, doc in enumerate(loader.lazy_load(), start=1))
+
+
+def _group_slides(elements: Iterator[Document]) -> Iterator[Document]:
+    for number, slide in groupby(elements, key=lambda element: element.metadata.get("page_number", 1)):
+        yield Document(page_content="\n\n".join(element.page_content for element in slide),
+                       metadata={"page": number, "source_type": "pptx"})
+
+
+def split_pages(pages: Iterable[Document]) -> Iterator[Document]:
+    """
+    Splits page by page, so chunks keep their page's metadata and only one
+    page is held in memory at a time
+    """
+    for page in pages:
+        yield from text_splitter.split_documents([page])
+
+
+@timed("process_file")
+def process_file(file_path: str, doc_id: int, course_id: int, heartbeat: Callable[[], None] | None = None) -> None:
+    # load page -> split -> embed batch -> insert, without ever holding the
+    # whole document
+    store_in_chromadb(doc_id, course_id, split_pages(load_pages(file_path)), heartbeat)
+    log_cache_stats()
+
+
+@timed("process_files")
+def process_files(files: list[tuple[str, int, int]],
+                  heartbeat: Callable[[], None] | None = None) -> dict[int, Exception]:
+    """
+    Ingests several (file_path, doc_id, course_id) documents at once. Every
+    file is extracted and chunked in its own thread, and chunks from all of
+    them share embedding batches, so one forward pass covers several
+    documents. Returns the error of every document that failed by id; the
+    chunks it stored before failing are left for the caller to delete.
+    """
+    chunks = queue.Queue(maxsize=EMBED_BATCH_SIZE * 2)
+    finished = object()
+    # Split the PDF pool between the files extracted at the same time
+    pdf_workers = max(1, (PDF_WORKERS or os.cpu_count() or 1) // len(files))
+
+    def extract(file_path: str, doc_id: int, course_id: int) -> None:
+        try:
+            pages = load_pages(file_path, pdf_workers=pdf_workers)
+            for chunk_id, doc in chunk_ids(doc_id, split_pages(pages)):
+                chunks.put((doc_id, course_id, chunk_id, doc))
+            chunks.put((doc_id, course_id, finished, None))
+        except Exception as e:
+            chunks.put((doc_id, course_id, finished, e))
+
+    embed_model = CachedEmbeddings(get_embed_model(), embedding_cache, EMBED_MODEL_NAME)
+    errors = {}
+
+    def flush(batch: list[tuple]) -> None:
+        batch = [item for item in batch if item[0] not in errors]
+        if not batch:
+            return
+        try:
+            with span("embed"):
+                embeddings = embed_model.embed_documents([doc.page_content for *_, doc in batch])
+        except Exception as e:
+            for doc_id, *_ in batch:
+                errors[doc_id] = e
+            return
+        by_document = defaultdict(list)
+        for item, embedding in zip(batch, embeddings):
+            by_document[item[:2]].append((*item[2:], embedding))
+        for (doc_id, course_id), items in by_document.items():
+            try:
+                ids = [chunk_id for chunk_id, _, _ in items]
+                texts = [doc.page_content for _, doc, _ in items]
+                get_collection(course_id).add(
+                    ids=ids,
+                    documents=texts,
+                    embeddings=[embedding for _, _, embedding in items],
+                    metadatas=[{**doc.metadata, "id": doc_id} for _, doc, _ in items],
+                )
+                index_chunks(course_id, doc_id, ids, texts)
+            except Exception as e:
+                errors[doc_id] = e
+
+    threads = [threading.Thread(target=extract, args=file, daemon=True) for file in files]
+    for thread in threads:
+        thread.start()
+    remaining, batch = len(files), []
+    while remaining:
+        doc_id, course_id, chunk_id, item = chunks.get()
+        if chunk_id is finished:
+            remaining -= 1
+            if item is not None:
+                errors[doc_id] = item
+            continue
+        batch.append((doc_id, course_id, chunk_id, item))
+        if len(batch) >= EMBED_BATCH_SIZE:
+            flush(batch)
+            batch = []
+            if heartbeat:
+                heartbeat()
+    flush(batch)
+    for thread in threads:
+        thread.join()
+
+    for course_id in {course_id for _, _, course_id in files}:
+        RetrievalCache.bump_version(course_id)
+    log_cache_stats()
+    return errors
+
+
+@timed("reindex_file")
+def reindex_file(file_path: str, doc_id: int, course_id: int, heartbeat: Callable[[], None] | None = None) -> dict:
+    """
+    Re-reads a replaced or re-chunked document and updates only the chunks
+    that changed. Unchanged scanned pages are served from the OCR cache.
+    """
+    counts = reindex_in_chromadb(doc_id, course_id, split_pages(load_pages(file_path)), heartbeat)
+    logger.info("Re-indexed document %s: %s", doc_id, counts)
+    log_cache_stats()
+    return counts
+
+
+def log_cache_stats() -> None:
+    for cache in (ocr_cache, embedding_cache):
+        stats = cache.stats()
+        logger.info("%s cache: %.1f%% hit rate (%d hits, %d misses)",
+                    stats["namespace"], stats["hit_rate"] * 100, stats["hits"], stats["misses"])
@@ -0,0 +1,136 @@
+"""
+Persistent content-addressed cache for expensive ingestion results (OCR text
+and chunk embeddings). Entries are keyed by the SHA-256 of their input and
+evicted least recently used first once a namespace grows past its size limit.
+Kept free of Django and LangChain so PDF pool workers can import it cheaply.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class ContentCache:
+    # How many writes go by between checks of the namespace size
+    EVICTION_CHECK_INTERVAL = 50
+
+    def __init__(self, path: str, namespace: str, max_bytes: int):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def __getstate__(self):
+        # Sent to PDF pool workers, which open their own connection
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                );
+                CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, last_used);
+                CREATE TABLE IF NOT EXISTS stats (
+                    namespace TEXT PRIMARY KEY,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0
+                );
+            """)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, content: bytes) -> bytes | None:
+        key = self.key(content)
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+            ).fetchone()
+            counter = "hits" if row else "misses"
+            with self.conn:
+                if row:
+                    self.conn.execute(
+                        "UPDATE cache SET last_used = ? WHERE namespace = ? AND key = ?",
+                        (time.time(), self.namespace, key),
+                    )
+                self.conn.execute(
+                    f"INSERT INTO stats (namespace, {counter}) VALUES (?, 1) "
+                    f"ON CONFLICT (namespace) DO UPDATE SET {counter} = {counter} + 1",
+                    (self.namespace,),
+                )
+        return row[0] if row else None
+
+    def set(self, content: bytes, value: bytes) -> None:
+        with self._lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (self.namespace, self.key(content), value, len(value), time.time()),
+                )
+            self._writes += 1
+            if self._writes % self.EVICTION_CHECK_INTERVAL == 1:
+                self._evict()
+
+    def _evict(self) -> None:
+        total = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Free down to 90% of the limit so we don't evict on every write
+        to_free = total - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM cache WHERE namespace = ? ORDER BY last_used", (self.namespace,)
+        ):
+            keys.append((self.namespace, key))
+            to_free -= size
+            if to_free <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.conn.execute(
+                "SELECT hits, misses FROM stats WHERE namespace = ?", (self.namespace,)
+            ).fetchone() or (0, 0)
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()
+        lookups = hits + misses
+        return {
+            "namespace": self.namespace,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def reset_stats(self) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM stats WHERE namespace = ?", (self.namespace,))
+
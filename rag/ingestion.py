@@ -0,0 +1,214 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .checkpointer import prune_if_due
+from .models import Documents, IngestionJobs
+from .quiz_bank import clear_bank, fill_bank, request_fill
+from .doc_add import process_file, process_files, reindex_file, delete_from_chromadb
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = getattr(settings, "RAG_INGESTION_MAX_ATTEMPTS", 3)
+# Seconds before the first retry, doubled on every further attempt
+RETRY_DELAY = getattr(settings, "RAG_INGESTION_RETRY_DELAY", 30)
+# A job whose worker hasn't reported progress for this many seconds is
+# assumed to belong to a worker that died and is picked up again
+STALE_AFTER = getattr(settings, "RAG_INGESTION_STALE_AFTER", 30 * 60)
+# Seconds between the progress reports of a running job
+HEARTBEAT_INTERVAL = getattr(settings, "RAG_INGESTION_HEARTBEAT_INTERVAL", 60)
+# New documents a worker claims at once and ingests together
+BATCH_JOBS = getattr(settings, "RAG_INGESTION_BATCH_JOBS", 4)
+
+
+def enqueue_document(document: Documents, kind: str = IngestionJobs.INGEST) -> IngestionJobs:
+    """
+    Queues the document for the ingestion workers. A new document is marked
+    as pending; one being re-indexed stays ready, since its old chunks keep
+    answering questions until the new ones are in.
+    """
+    if kind == IngestionJobs.INGEST:
+        Documents.objects.filter(id=document.id).update(status=Documents.PENDING, error="")
+        document.status = Documents.PENDING
+    return IngestionJobs.objects.create(document=document, kind=kind, max_attempts=MAX_ATTEMPTS)
+
+
+def enqueue_documents(documents: list[Documents]) -> list[IngestionJobs]:
+    """
+    Queues several newly created, pending documents with one insert.
+    """
+    return IngestionJobs.objects.bulk_create(
+        IngestionJobs(document=document, max_attempts=MAX_ATTEMPTS) for document in documents
+    )
+
+
+def claim_job() -> IngestionJobs | None:
+    """
+    Takes the next runnable job off the queue. The conditional update makes
+    sure two workers never claim the same job, even on databases without
+    SELECT ... FOR UPDATE SKIP LOCKED.
+    """
+    now = timezone.now()
+    runnable = (
+        Q(status=IngestionJobs.PENDING, run_after__lte=now)
+        | Q(status=IngestionJobs.PROCESSING, updated_at__lt=now - timedelta(seconds=STALE_AFTER))
+    )
+    with transaction.atomic():
+        job = (IngestionJobs.objects.select_for_update(skip_locked=True)
+               .filter(runnable).order_by("run_after").first())
+        if job is None:
+            return None
+        claimed = IngestionJobs.objects.filter(
+            id=job.id, status=job.status, attempts=job.attempts
+        ).update(status=IngestionJobs.PROCESSING, attempts=job.attempts + 1, updated_at=now)
+        if not claimed:
+            return None
+        if job.kind == IngestionJobs.INGEST:
+            Documents.objects.filter(id=job.document_id).update(status=Documents.PROCESSING)
+
+    job.refresh_from_db()
+    return job
+
+
+def heartbeat(jobs: list[IngestionJobs], interval: float = HEARTBEAT_INTERVAL):
+    """
+    Returns a function that refreshes the jobs' updated_at, at most once per
+    interval, so a document that takes longer than STALE_AFTER to ingest
+    isn't taken for abandoned and ingested a second time by another worker
+    """
+    ids = [job.id for job in jobs]
+    last = time.monotonic()
+
+    def beat() -> None:
+        nonlocal last
+        if time.monotonic() - last < interval:
+            return
+        last = time.monotonic()
+        IngestionJobs.objects.filter(id__in=ids, status=IngestionJobs.PROCESSING).update(updated_at=timezone.now())
+
+    return beat
+
+
+def claim_jobs(limit: int) -> list[IngestionJobs]:
+    jobs = []
+    while len(jobs) < limit and (job := claim_job()) is not None:
+        jobs.append(job)
+    return jobs
+
+
+def _job_failed(job: IngestionJobs, document: Documents, error: Exception) -> None:
+    """
+    Reschedules the job with exponential backoff until it runs out of
+    attempts.
+    """
+    if job.kind == IngestionJobs.INGEST:
+        # Drop whatever chunks were stored before the failure
+        delete_from_chromadb(document.id, document.course_id)
+    if job.attempts >= job.max_attempts:
+        job_status, document_status = IngestionJobs.FAILED, Documents.FAILED
+        run_after = job.run_after
+    else:
+        job_status, document_status = IngestionJobs.PENDING, Documents.PENDING
+        run_after = timezone.now() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+    IngestionJobs.objects.filter(id=job.id).update(
+        status=job_status, run_after=run_after, last_error=str(error), updated_at=timezone.now()
+    )
+    if job.kind == IngestionJobs.INGEST:
+        Documents.objects.filter(id=job.document_id).update(status=document_status, error=str(error))
+    elif job.kind == IngestionJobs.REINDEX:
+        # A half-done re-index still leaves a searchable document, which
+        # the next attempt brings up to date
+        Documents.objects.filter(id=job.document_id).update(error=str(error))
+
+
+def _job_done(job: IngestionJobs, document: Documents) -> None:
+    IngestionJobs.objects.filter(id=job.id).update(status=IngestionJobs.DONE, updated_at=timezone.now())
+    if job.kind == IngestionJobs.QUIZ:
+        return
+    if not Documents.objects.filter(id=job.document_id).update(status=Documents.READY, error=""):
+        # The document was deleted while it was being processed
+        delete_from_chromadb(document.id, document.course_id)
+        return
+    if job.kind == IngestionJobs.REINDEX:
+        # The old questions may be about text that is gone
+        clear_bank(document.id)
+    request_fill(document.id)
+
+
+def run_job(job: IngestionJobs) -> None:
+    """
+    Processes or re-indexes the job's document, or fills its quiz bank.
+    """
+    try:
+        document = job.document
+    except Documents.DoesNotExist:
+        return
+
+    try:
+        if job.kind == IngestionJobs.REINDEX:
+            reindex_file(document.file.path, document.id, document.course_id, heartbeat([job]))
+        elif job.kind == IngestionJobs.QUIZ:
+            fill_bank(document)
+        else:
+            process_file(document.file.path, document.id, document.course_id, heartbeat([job]))
+    except Exception as e:
+        logger.exception("%s of document %s failed", job.get_kind_display(), document.id)
+        _job_failed(job, document, e)
+        return
+    _job_done(job, document)
+
+
+def run_jobs(jobs: list[IngestionJobs]) -> None:
+    """
+    Ingests the documents of several jobs together, so they are extracted
+    concurrently and share embedding batches. Each job succeeds or fails on
+    its own.
+    """
+    documents = {}
+    for job in jobs:
+        try:
+            documents[job.id] = job.document
+        except Documents.DoesNotExist:
+            continue
+    if not documents:
+        return
+
+    errors = process_files([(document.file.path, document.id, document.course_id)
+                            for document in documents.values()], heartbeat(jobs))
+    for job in jobs:
+        document = documents.get(job.id)
+        if document is None:
+            continue
+        if document.id in errors:
+            logger.error("Ingestion of document %s failed", document.id, exc_info=errors[document.id])
+            _job_failed(job, document, errors[document.id])
+        else:
+            _job_done(job, document)
+
+
+def work(poll_interval: float = 2.0, once: bool = False) -> None:
+    """
+    Runs jobs until interrupted. With once=True it stops as soon as the
+    queue is empty. While idle it also prunes the chat history now and then.
+    """
+    while True:
+        jobs = claim_jobs(BATCH_JOBS)
+        if not jobs:
+            if once:
+                return
+            prune_if_due()
+            time.sleep(poll_interval)
+            continue
+        ingest = [job for job in jobs if job.kind == IngestionJobs.INGEST]
+        if len(ingest) > 1:
+            run_jobs(ingest)
+        elif ingest:
+            run_job(ingest[0])
+        for job in jobs:
+            if job.kind != IngestionJobs.INGEST:
+                run_job(job)
@@ -0,0 +1,158 @@
+"""
+Per-course inverted keyword index kept next to Chroma, and a hybrid
+retriever fusing BM25 over it with the dense results. Exact terms such as
+course codes, acronyms and formula names are matched badly by MiniLM.
+"""
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+
+from django.core.cache import cache as django_cache
+from django.db.models import Count, Sum
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .clients import get_collection
+from .metrics import span
+from .models import KeywordChunks, KeywordPostings
+from .retrieval_cache import RetrievalCache
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+# Rank constant of reciprocal rank fusion
+RRF_K = 60
+
+STATS_KEY = "rag:keyword_stats:{course_id}:{version}"
+# Seconds the statistics of an index version are kept; a change to the
+# index makes them unreachable sooner
+STATS_TIMEOUT = 24 * 60 * 60
+
+# Keeps things like "cs101", "h2o", "phy-201" and "3.14" as single terms
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have how i if in into is it its of on or so
+    that the their then there these this to was what when where which who why will with you
+""".split())
+
+
+def tokenize(text: str) -> list[str]:
+    return [term for term in TOKEN_RE.findall(text.lower())
+            if term not in STOP_WORDS and len(term) <= 64]
+
+
+def index_chunks(course_id: int, document_id: int, chunk_ids: list[str], texts: list[str]) -> None:
+    chunks, postings = [], []
+    for chunk_id, text in zip(chunk_ids, texts):
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        chunks.append(KeywordChunks(course_id=course_id, document_id=document_id,
+                                    chunk_id=chunk_id, length=length))
+        postings.extend(
+            KeywordPostings(course_id=course_id, document_id=document_id, chunk_id=chunk_id,
+                            chunk_length=length, term=term, frequency=frequency)
+            for term, frequency in counts.items()
+        )
+    # Chunk ids are derived from the text, so a chunk that is already in
+    # the index (e.g. written by an earlier attempt) has the same postings
+    KeywordChunks.objects.bulk_create(chunks, batch_size=1000, ignore_conflicts=True)
+    KeywordPostings.objects.bulk_create(postings, batch_size=1000, ignore_conflicts=True)
+
+
+def remove_document(document_id: int) -> None:
+    KeywordPostings.objects.filter(document_id=document_id).delete()
+    KeywordChunks.objects.filter(document_id=document_id).delete()
+
+
+def remove_chunks(document_id: int, chunk_ids: list[str]) -> None:
+    KeywordPostings.objects.filter(document_id=document_id, chunk_id__in=chunk_ids).delete()
+    KeywordChunks.objects.filter(document_id=document_id, chunk_id__in=chunk_ids).delete()
+
+
+def document_stats(course_id: int) -> dict[int, tuple[int, int]]:
+    """
+    The number of chunks and their total length in terms for every indexed
+    document of the course. Computed once per index version of the course,
+    which every change to the index bumps, and shared through Django's cache.
+    """
+    key = STATS_KEY.format(course_id=course_id, version=RetrievalCache.version(course_id))
+    stats = django_cache.get(key)
+    if stats is None:
+        stats = {
+            document_id: (count, total_length)
+            for document_id, count, total_length in KeywordChunks.objects.filter(course_id=course_id)
+            .values("document_id").annotate(count=Count("id"), total_length=Sum("length"))
+            .values_list("document_id", "count", "total_length")
+        }
+        django_cache.set(key, stats, timeout=STATS_TIMEOUT)
+    return stats
+
+
+def keyword_search(course_id: int, document_ids: list[int], query: str, k: int) -> list[str]:
+    """
+    Returns the ids of the k chunks with the best BM25 score. Costs one
+    query, for the postings of the query terms, once the collection
+    statistics are cached.
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+    stats = document_stats(course_id)
+    selected = [stats[document_id] for document_id in set(map(int, document_ids)) if document_id in stats]
+    total = sum(count for count, _ in selected)
+    if not total:
+        return []
+
+    postings = defaultdict(list)
+    for chunk_id, chunk_length, term, frequency in KeywordPostings.objects.filter(
+        course_id=course_id, document_id__in=document_ids, term__in=terms
+    ).values_list("chunk_id", "chunk_length", "term", "frequency"):
+        postings[term].append((chunk_id, chunk_length, frequency))
+
+    avg_length = sum(length for _, length in selected) / total or 1
+    scores = defaultdict(float)
+    for rows in postings.values():
+        idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+        for chunk_id, chunk_length, frequency in rows:
+            scores[chunk_id] += idf * frequency * (K1 + 1) / (
+                frequency + K1 * (1 - B + B * chunk_length / avg_length)
+            )
+    return heapq.nlargest(k, scores, key=scores.get)
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]]) -> list[str]:
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] += 1 / (RRF_K + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the dense retriever's ranking with BM25 over the keyword index.
+    Both rankings are `candidates` long and the top k of the fusion is kept.
+    """
+    dense: BaseRetriever
+    course_id: int
+    document_ids: list[int]
+    k: int = 5
+    candidates: int = 20
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        dense_docs = self.dense.invoke(query, {"callbacks": run_manager.get_child()})
+        with span("keyword_search"):
+            keyword_ids = keyword_search(self.course_id, self.document_ids, query, self.candidates)
+        fused = reciprocal_rank_fusion([[doc.id for doc in dense_docs], keyword_ids])[:self.k]
+
+        docs = {doc.id: doc for doc in dense_docs}
+        missing = [chunk_id for chunk_id in fused if chunk_id not in docs]
+        if missing:
+            result = get_collection(self.course_id).get(ids=missing, include=["documents", "metadatas"])
+            for chunk_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+                docs[chunk_id] = Document(id=chunk_id, page_content=text, metadata=metadata or {})
+        return [docs[chunk_id] for chunk_id in fused if chunk_id in docs]
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from rag.doc_add import ocr_cache, embedding_cache
+
+
+class Command(BaseCommand):
+    help = "Shows hit rates and sizes of the OCR and embedding caches used during ingestion"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset the hit/miss counters afterwards")
+
+    def handle(self, *args, **options):
+        for cache in (ocr_cache, embedding_cache):
+            stats = cache.stats()
+            self.stdout.write(
+                f"{stats['namespace']:<12} hit rate {stats['hit_rate']:6.1%}  "
+                f"hits {stats['hits']:<8} misses {stats['misses']:<8} "
+                f"entries {stats['entries']:<8} size {stats['bytes'] / (1024 * 1024):.1f}MB "
+                f"(limit {cache.max_bytes / (1024 * 1024):.0f}MB)"
+            )
+            if options["reset"]:
+                cache.reset_stats()
@@ -0,0 +1,49 @@
+import multiprocessing
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def run_worker(poll_interval: float, once: bool) -> None:
+    # Spawned children start without Django set up
+    django.setup()
+    from rag.ingestion import work
+    work(poll_interval=poll_interval, once=once)
+
+
+class Command(BaseCommand):
+    help = "Processes queued document uploads (OCR, chunking and embedding)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--poll-interval", type=float, default=2.0,
+                            help="Seconds to wait before polling an empty queue again")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        processes = options["processes"]
+        poll_interval = options["poll_interval"]
+        once = options["once"]
+
+        if processes <= 1:
+            run_worker(poll_interval, once)
+            return
+
+        # Forked children must not share the parent's database connections
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(poll_interval, once), name=f"ingest-worker-{i}")
+            for i in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {processes} ingestion workers")
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,62 @@
+import json
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.metrics import METRICS_FILE, percentile
+
+
+class Command(BaseCommand):
+    help = "Prints latency and query count percentiles per endpoint and per stage from the metrics file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", default=METRICS_FILE, help="JSONL file written by the metrics middleware")
+        parser.add_argument("--endpoint", help="Only report this endpoint")
+
+    def handle(self, *args, **options):
+        if not options["file"]:
+            raise CommandError("No metrics file, set RAG_METRICS_FILE or pass --file")
+
+        seconds, queries, errors = defaultdict(list), defaultdict(list), defaultdict(int)
+        stages = defaultdict(list)
+        try:
+            with open(options["file"], encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crashed process
+                        continue
+                    if record.get("type") == "span":
+                        stages[record["stage"]].append(record["seconds"])
+                        continue
+                    endpoint = record["endpoint"]
+                    if options["endpoint"] and endpoint != options["endpoint"]:
+                        continue
+                    seconds[endpoint].append(record["seconds"])
+                    queries[endpoint].append(record["queries"])
+                    errors[endpoint] += record["status"] >= 500
+                    for stage, value in record["spans"].items():
+                        stages[stage].append(value)
+        except FileNotFoundError:
+            raise CommandError(f"{options['file']} does not exist")
+
+        self.stdout.write(f"{'endpoint':<24} {'requests':>8} {'5xx':>5} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} "
+                          f"{'p50 q':>6} {'p95 q':>6} {'p99 q':>6}")
+        for endpoint in sorted(seconds):
+            times, counts = sorted(seconds[endpoint]), sorted(queries[endpoint])
+            self.stdout.write(
+                f"{endpoint:<24} {len(times):>8} {errors[endpoint]:>5} "
+                + " ".join(f"{percentile(times, q):>8.3f}" for q in (50, 95, 99)) + " "
+                + " ".join(f"{percentile(counts, q):>6}" for q in (50, 95, 99))
+            )
+
+        self.stdout.write("")
+        self.stdout.write(f"{'stage':<24} {'calls':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'total s':>10}")
+        for stage in sorted(stages):
+            times = sorted(stages[stage])
+            self.stdout.write(
+                f"{stage:<24} {len(times):>8} "
+                + " ".join(f"{percentile(times, q):>8.3f}" for q in (50, 95, 99))
+                + f" {sum(times):>10.1f}"
+            )
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+
+from rag.clients import collection_name, get_chroma_client
+from rag.keyword_index import index_chunks
+from rag.models import Courses, Documents, KeywordChunks
+from rag.retrieval_cache import RetrievalCache
+
+LEGACY_COLLECTION = "documents"
+
+
+class Command(BaseCommand):
+    help = ("Moves vectors from the old global \"documents\" collection into per-course collections "
+            "and builds the keyword index of documents that don't have one yet")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--keep-legacy", action="store_true",
+                            help="Copy the vectors without deleting them from the old collection")
+
+    def handle(self, *args, **options):
+        client = get_chroma_client()
+        legacy = client.get_or_create_collection(name=LEGACY_COLLECTION)
+        batch_size = options["batch_size"]
+
+        for course in Courses.objects.all():
+            document_ids = list(Documents.objects.filter(course=course).values_list("id", flat=True))
+            if not document_ids:
+                continue
+            target = client.get_or_create_collection(name=collection_name(course.id))
+            where = {"id": {"$in": document_ids}}
+            moved = 0
+            while True:
+                # Always read the first page: moved vectors are deleted from
+                # the legacy collection, or skipped by offset when kept
+                batch = legacy.get(
+                    where=where,
+                    limit=batch_size,
+                    offset=moved if options["keep_legacy"] else 0,
+                    include=["embeddings", "documents", "metadatas"],
+                )
+                if not batch["ids"]:
+                    break
+                # The chunk text used to be duplicated into the metadata
+                metadatas = [{key: value for key, value in metadata.items() if key != "text"}
+                             for metadata in batch["metadatas"]]
+                target.upsert(
+                    ids=batch["ids"],
+                    embeddings=batch["embeddings"],
+                    documents=batch["documents"],
+                    metadatas=metadatas,
+                )
+                if not options["keep_legacy"]:
+                    legacy.delete(ids=batch["ids"])
+                moved += len(batch["ids"])
+            indexed = self.index_keywords(course.id, target, document_ids, batch_size)
+            RetrievalCache.bump_version(course.id)
+            self.stdout.write(f"{course.course_name} ({course.id}): moved {moved} vectors, "
+                              f"indexed the keywords of {indexed} chunks")
+
+        if not options["keep_legacy"]:
+            remaining = legacy.count()
+            if remaining:
+                self.stdout.write(f"{remaining} vectors of deleted documents left in \"{LEGACY_COLLECTION}\"")
+            else:
+                client.delete_collection(LEGACY_COLLECTION)
+
+    @staticmethod
+    def index_keywords(course_id: int, collection, document_ids: list[int], batch_size: int) -> int:
+        """
+        Builds the keyword index from the stored chunks of the documents that
+        were ingested before it existed. Returns how many chunks were indexed.
+        """
+        indexed = set(KeywordChunks.objects.filter(document_id__in=document_ids)
+                      .values_list("document_id", flat=True).distinct())
+        chunks = 0
+        for document_id in document_ids:
+            if document_id in indexed:
+                continue
+            offset = 0
+            while True:
+                batch = collection.get(where={"id": document_id}, limit=batch_size, offset=offset,
+                                       include=["documents"])
+                if not batch["ids"]:
+                    break
+                index_chunks(course_id, document_id, batch["ids"], batch["documents"])
+                offset += len(batch["ids"])
+            chunks += offset
+        return chunks
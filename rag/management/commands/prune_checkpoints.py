@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from rag.checkpointer import (
+    CHECKPOINT_KEEP, CHECKPOINTER, HISTORY_PATH, checkpoint_stats, connect_history, prune_checkpoints,
+)
+
+
+class Command(BaseCommand):
+    help = ("Keeps the last checkpoints of every chat thread, drops the threads of deleted courses "
+            "and users and vacuums the history database")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--keep", type=int, default=CHECKPOINT_KEEP, help="Checkpoints kept per thread")
+        parser.add_argument("--no-vacuum", action="store_true", help="Skip the VACUUM afterwards")
+        parser.add_argument("--sample", type=int, default=50,
+                            help="Threads whose latest checkpoint is read to measure latency")
+
+    def handle(self, *args, **options):
+        if CHECKPOINTER != "sqlite":
+            self.stderr.write("Pruning is only implemented for the SQLite checkpointer")
+            return
+        if options["keep"] < 1:
+            self.stderr.write("--keep must be at least 1")
+            return
+        conn = connect_history()
+        try:
+            before = checkpoint_stats(conn, HISTORY_PATH, options["sample"])
+            deleted = prune_checkpoints(conn, keep=options["keep"], vacuum=not options["no_vacuum"])
+            after = checkpoint_stats(conn, HISTORY_PATH, options["sample"])
+        finally:
+            conn.close()
+
+        self.stdout.write(f"Deleted {deleted['threads']} threads, {deleted['checkpoints']} checkpoints "
+                          f"and {deleted['writes']} writes")
+        for label, stats in (("before", before), ("after", after)):
+            self.stdout.write(
+                f"{label:<7} size {stats['bytes'] / (1024 * 1024):.1f}MB  threads {stats['threads']:<7} "
+                f"checkpoints {stats['checkpoints']:<9} writes {stats['writes']:<9} "
+                f"read {stats['read_ms_mean']:.2f}ms mean / {stats['read_ms_max']:.2f}ms max"
+            )
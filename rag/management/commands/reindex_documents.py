@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from rag.ingestion import enqueue_document
+from rag.models import Documents, IngestionJobs
+
+
+class Command(BaseCommand):
+    help = "Queues ready documents for re-indexing, e.g. after the chunking settings changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("doc_ids", nargs="*", type=int, help="Documents to re-index (default: all)")
+        parser.add_argument("--course", type=int, help="Only re-index the documents of this course")
+
+    def handle(self, *args, **options):
+        documents = Documents.objects.filter(status=Documents.READY)
+        if options["doc_ids"]:
+            documents = documents.filter(id__in=options["doc_ids"])
+        if options["course"]:
+            documents = documents.filter(course_id=options["course"])
+
+        queued = 0
+        for document in documents.iterator():
+            enqueue_document(document, kind=IngestionJobs.REINDEX)
+            queued += 1
+        self.stdout.write(f"Queued {queued} documents for re-indexing")
@@ -0,0 +1,252 @@
+"""
+Lightweight request and stage instrumentation. The middleware records each
+request's latency, database query count and the time spent in the stages
+wrapped with span()/timed() (retrieval, LLM, ingestion steps, ...). The
+aggregates are exposed in Prometheus text format on /metrics, and every
+request can also be appended to a JSONL file for the metrics_report command.
+"""
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+METRICS_ENABLED = getattr(settings, "RAG_METRICS_ENABLED", True)
+# JSONL file every request and out-of-request span is appended to (None disables it)
+METRICS_FILE = getattr(settings, "RAG_METRICS_FILE", None)
+# Bearer token a scraper reads /metrics with (staff users can always read it)
+METRICS_TOKEN = getattr(settings, "RAG_METRICS_TOKEN", None)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, math.inf)
+
+
+class RequestMetrics:
+    __slots__ = ("queries", "db_seconds", "spans")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.spans = {}
+
+
+_current: ContextVar[RequestMetrics | None] = ContextVar("rag_request_metrics", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Per-process histograms and counters, keyed by metric name and labels
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: dict[tuple, Histogram] = {}
+        self.counters: dict[tuple, int] = {}
+
+    def observe(self, name: str, labels: tuple, value: float, buckets: tuple = DURATION_BUCKETS) -> None:
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name: str, labels: tuple) -> None:
+        with self._lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + 1
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Nearest-rank percentile (q in 0-100) of an already sorted list
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+registry = Registry()
+_file_lock = threading.Lock()
+
+
+def _write(record: dict) -> None:
+    if not METRICS_FILE:
+        return
+    line = json.dumps(record, separators=(",", ":")) + "\n"
+    with _file_lock, open(METRICS_FILE, "a", encoding="utf-8") as file:
+        file.write(line)
+
+
+def record_span(stage: str, seconds: float) -> None:
+    registry.observe("rag_stage_duration_seconds", (("stage", stage),), seconds)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.spans[stage] = metrics.spans.get(stage, 0.0) + seconds
+    else:
+        # Ingestion workers and other work outside a request
+        _write({"type": "span", "stage": stage, "seconds": round(seconds, 6), "time": time.time()})
+
+
+@contextmanager
+def span(stage: str):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+
+def timed(stage: str):
+    """
+    Decorator recording every call of the function as a span
+    """
+    def decorator(func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _count_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_seconds += time.perf_counter() - start
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # Installed on every connection, so ORM calls made through
+    # sync_to_async (which carries the request's context) are counted too
+    if METRICS_ENABLED and _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and query count per endpoint (URL name). For
+    streamed responses the latency ends when the response is returned,
+    before its body is sent.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not METRICS_ENABLED:
+            return self.get_response(request)
+        token, start = _current.set(RequestMetrics()), time.perf_counter()
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            self._finish(request, response, start, token)
+
+    async def __acall__(self, request):
+        if not METRICS_ENABLED:
+            return await self.get_response(request)
+        token, start = _current.set(RequestMetrics()), time.perf_counter()
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            self._finish(request, response, start, token)
+
+    @staticmethod
+    def _finish(request, response, start, token) -> None:
+        seconds = time.perf_counter() - start
+        metrics = _current.get()
+        _current.reset(token)
+        match = getattr(request, "resolver_match", None)
+        endpoint = (match.url_name or match.view_name) if match else "unmatched"
+        status = response.status_code if response is not None else 500
+        labels = (("endpoint", endpoint), ("method", request.method))
+        registry.increment("rag_requests_total", labels + (("status", str(status)),))
+        registry.observe("rag_request_duration_seconds", labels, seconds)
+        registry.observe("rag_request_queries", labels, metrics.queries, QUERY_BUCKETS)
+        _write({
+            "type": "request",
+            "endpoint": endpoint,
+            "method": request.method,
+            "status": status,
+            "seconds": round(seconds, 6),
+            "queries": metrics.queries,
+            "db_seconds": round(metrics.db_seconds, 6),
+            "spans": {stage: round(value, 6) for stage, value in metrics.spans.items()},
+            "time": time.time(),
+        })
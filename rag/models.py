@@ -1,9 +1,10 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 import os
 
 from django.core.exceptions import ValidationError
-from .doc_add import delete_from_chromadb
+from .answer_cache import get_answer_cache
 
 class Libraries(models.Model):
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="created_libraries")
@@ -39,20 +40,124 @@ def validate_file_extension(value):
         raise ValidationError('Unsupported file extension.')
     
 class Documents(models.Model):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    READY = "ready"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (PROCESSING, "Processing"),
+        (READY, "Ready"),
+        (FAILED, "Failed"),
+    ]
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="documents")
     course = models.ForeignKey(Courses, on_delete=models.CASCADE, related_name="documents")
     file = models.FileField(upload_to="documents/%Y/%m/%d/", validators=[validate_file_size, validate_file_extension])
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Documents uploaded before the ingestion queue were processed inline,
+    # new uploads are created as pending
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=READY)
+    error = models.TextField(blank=True, default="")
 
     def __str__(self):
         return self.file.name
     
     def delete(self, *args, **kwargs):
+        # doc_add stores into the keyword index models, so it can't be
+        # imported while this module loads
+        from .doc_add import delete_from_chromadb
         self.file.delete()
-        delete_from_chromadb(self.id)
+        delete_from_chromadb(self.id, self.course_id)
+        get_answer_cache().invalidate(self.course_id)
         super().delete(*args, **kwargs)
 
 
+class KeywordChunks(models.Model):
+    """A chunk in the keyword index, with its length in terms for BM25"""
+    course = models.ForeignKey(Courses, on_delete=models.CASCADE, related_name="keyword_chunks")
+    document = models.ForeignKey(Documents, on_delete=models.CASCADE, related_name="keyword_chunks")
+    chunk_id = models.CharField(max_length=100)
+    length = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["document", "chunk_id"], name="unique_keyword_chunk")]
+
+    def __str__(self):
+        return self.chunk_id
+
+
+class KeywordPostings(models.Model):
+    """
+    How often a term occurs in a chunk. The chunk's id and length are copied
+    in so a search only has to read the postings of its terms.
+    """
+    course = models.ForeignKey(Courses, on_delete=models.CASCADE, related_name="keyword_postings")
+    document = models.ForeignKey(Documents, on_delete=models.CASCADE, related_name="keyword_postings")
+    chunk_id = models.CharField(max_length=100)
+    chunk_length = models.PositiveIntegerField()
+    term = models.CharField(max_length=64)
+    frequency = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["course", "term"])]
+        constraints = [
+            models.UniqueConstraint(fields=["document", "chunk_id", "term"], name="unique_keyword_posting"),
+        ]
+
+    def __str__(self):
+        return f"{self.term} - {self.chunk_id}"
+
+
+class IngestionJobs(models.Model):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (PROCESSING, "Processing"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+    INGEST = "ingest"
+    REINDEX = "reindex"
+    QUIZ = "quiz"
+    KIND_CHOICES = [
+        (INGEST, "Ingest"),
+        (REINDEX, "Re-index"),
+        (QUIZ, "Quiz bank"),
+    ]
+
+    document = models.ForeignKey(Documents, on_delete=models.CASCADE, related_name="ingestion_jobs")
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=INGEST)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        return f"{self.document} - {self.status}"
+
+
+class QuizQuestions(models.Model):
+    document = models.ForeignKey(Documents, on_delete=models.CASCADE, related_name="quiz_questions")
+    question = models.TextField()
+    options = models.JSONField()
+    answer = models.CharField(max_length=1)
+    explanation = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.question
+
+
 class Admins(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="admin_of")
     library = models.ForeignKey(Libraries, on_delete=models.CASCADE, related_name="admins")
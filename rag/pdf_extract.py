@@ -0,0 +1,97 @@
+"""
+PDF text extraction spread over a process pool. Kept apart from doc_add so
+pool workers only import fitz and pytesseract.
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import fitz
+import pytesseract
+
+from .ingest_cache import ContentCache
+
+# Each pool worker keeps its last opened PDF instead of reopening it per page,
+# and one connection per OCR cache
+_open_doc = None
+_ocr_caches = {}
+
+
+def _get_doc(file_path: str) -> fitz.Document:
+    global _open_doc
+    if _open_doc is None or _open_doc.name != file_path:
+        _open_doc = fitz.open(file_path)
+    return _open_doc
+
+
+def _get_ocr_cache(ocr_cache: ContentCache | None) -> ContentCache | None:
+    if ocr_cache is None:
+        return None
+    return _ocr_caches.setdefault((ocr_cache.path, ocr_cache.namespace), ocr_cache)
+
+
+def ocr_image(doc: fitz.Document, xref: int, ocr_cache: ContentCache | None = None) -> str:
+    """
+    OCRs an embedded image, skipping Tesseract for image bytes seen before
+    """
+    image_bytes = doc.xref_stream_raw(xref) if ocr_cache is not None else None
+    if image_bytes:
+        cached = ocr_cache.get(image_bytes)
+        if cached is not None:
+            return cached.decode()
+
+    pix_pil = fitz.Pixmap(doc, xref).pil_image()
+    text = pytesseract.image_to_string(pix_pil)
+    if image_bytes:
+        ocr_cache.set(image_bytes, text.encode())
+    return text
+
+
+def extract_page(doc: fitz.Document, page_number: int, ocr_cache: ContentCache | None = None) -> str:
+    """
+    Returns the page text followed by the OCR text of every image on it
+    """
+    page = doc[page_number]
+    parts = [page.get_text()]
+    for image in page.get_images(full=True):
+        parts.append(ocr_image(doc, image[0], ocr_cache))
+    return "".join(parts)
+
+
+def _extract_page_from_path(file_path: str, page_number: int, ocr_cache: ContentCache | None) -> str:
+    return extract_page(_get_doc(file_path), page_number, _get_ocr_cache(ocr_cache))
+
+
+def iter_pdf_pages(file_path: str, workers: int | None = None, min_pages: int = 4,
+                   ocr_cache: ContentCache | None = None) -> Iterator[str]:
+    """
+    Yields the text of every page, OCR included, in page order. Pages are
+    spread over `workers` processes; short documents are done in-process
+    since starting the pool would cost more than it saves.
+    """
+    workers = workers or os.cpu_count() or 1
+    with fitz.open(file_path) as doc:
+        page_count = doc.page_count
+        if workers <= 1 or page_count < min_pages:
+            for page_number in range(page_count):
+                yield extract_page(doc, page_number, ocr_cache)
+            return
+
+    # Spawned rather than forked: the parent may hold torch/Chroma threads
+    with ProcessPoolExecutor(max_workers=min(workers, page_count),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Only a couple of pages per worker are in flight, so memory doesn't
+        # grow with the document when the consumer is slower than the pool
+        pending = deque()
+        for page_number in range(page_count):
+            pending.append(pool.submit(_extract_page_from_path, file_path, page_number, ocr_cache))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def extract_pdf_text(file_path: str, workers: int | None = None, ocr_cache: ContentCache | None = None) -> str:
+    return "".join(iter_pdf_pages(file_path, workers, ocr_cache=ocr_cache))
@@ -1,40 +1,30 @@
 from rest_framework.permissions import BasePermission
-from .models import Libraries, Admins, Members
+from .roles import get_library_role
 
 class IsLibraryCreator(BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated:
             return False
-        
+
         library_id = request.data.get("library_id")
-        
+
         if not library_id:
             return False
-        
-        try:
-            library = Libraries.objects.get(id=library_id)
-        except Libraries.DoesNotExist:
-            return False
-        
-        return request.user == library.creator
-    
+
+        return get_library_role(request, library_id).is_creator
+
 
 class IsLibraryAdmin(BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated:
             return False
-        
+
         library_id = request.POST.get("library_id")
         if not library_id:
             return False
-        
-        try:
-            library = Libraries.objects.get(id=library_id)
-        except Libraries.DoesNotExist:
-            return False
-        
-        return Admins.objects.filter(user=request.user, library=library).exists()
-    
+
+        return get_library_role(request, library_id).is_admin
+
 
 class IsLibraryCreatorOrAdmin(BasePermission):
     def has_permission(self, request, view):
@@ -47,31 +37,25 @@ class IsLibraryCreatorOrAdmin(BasePermission):
             print("Library ID not provided")
             return False
 
-        try:
-            library = Libraries.objects.get(id=library_id)
-        except Libraries.DoesNotExist:
+        role = get_library_role(request, library_id)
+        if role.library is None:
             print("Library does not exist")
             return False
 
-        return request.user == library.creator or Admins.objects.filter(user=request.user, library=library).exists()
-    
+        return role.can_edit
+
 
 class IsLibraryMember(BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated:
             return False
-        
+
         if request.method in ["POST", "DELETE"]:
             library_id = request.data.get("library_id")
         else:
             library_id = request.query_params.get("library_id")
-            
+
         if not library_id:
             return False
-        
-        try:
-            library = Libraries.objects.get(id=library_id)
-        except Libraries.DoesNotExist:
-            return False
 
-        return Members.objects.filter(user=request.user, library=library).exists() or request.user == library.creator or Admins.objects.filter(user=request.user, library=library).exists()
\ No newline at end of file
+        return get_library_role(request, library_id).can_view
@@ -0,0 +1,68 @@
+"""
+Pre-generated quiz questions per document. The bank is filled by the
+ingestion workers once a document is ready, so the quiz endpoints only
+sample from it and fall back to live generation while it is still empty.
+"""
+from django.conf import settings
+
+from .answer_cache import normalize_query
+from .models import Documents, IngestionJobs, QuizQuestions
+from .retrieval_qa import get_quiz
+
+# Questions generated for every document
+BANK_SIZE = getattr(settings, "RAG_QUIZ_BANK_SIZE", 30)
+# The bank is topped up once it holds fewer questions than this
+BANK_MIN = getattr(settings, "RAG_QUIZ_BANK_MIN", 10)
+
+FIELDS = ("question", "options", "answer", "explanation")
+
+
+def sample_questions(document_id: int, number_of_questions: int) -> list[dict]:
+    return list(QuizQuestions.objects.filter(document_id=document_id)
+                .order_by("?").values(*FIELDS)[:number_of_questions])
+
+
+async def asample_questions(document_id: int, number_of_questions: int) -> list[dict]:
+    return [question async for question in QuizQuestions.objects.filter(document_id=document_id)
+            .order_by("?").values(*FIELDS)[:number_of_questions]]
+
+
+def request_fill(document_id: int, wanted: int = 0) -> None:
+    """
+    Queues a fill of the document's bank when it holds fewer than BANK_MIN
+    (or `wanted`) questions and no fill is queued yet
+    """
+    if QuizQuestions.objects.filter(document_id=document_id).count() >= max(BANK_MIN, min(wanted, BANK_SIZE)):
+        return
+    if IngestionJobs.objects.filter(
+        document_id=document_id, kind=IngestionJobs.QUIZ,
+        status__in=[IngestionJobs.PENDING, IngestionJobs.PROCESSING],
+    ).exists():
+        return
+    IngestionJobs.objects.create(document_id=document_id, kind=IngestionJobs.QUIZ)
+
+
+def fill_bank(document: Documents) -> int:
+    """
+    Generates questions until the bank holds BANK_SIZE, skipping ones it
+    already has. Returns how many were added.
+    """
+    existing = {normalize_query(question) for question in
+                QuizQuestions.objects.filter(document=document).values_list("question", flat=True)}
+    missing = BANK_SIZE - len(existing)
+    if missing <= 0:
+        return 0
+
+    added = []
+    for question in get_quiz(document.course_id, document.id, missing):
+        key = normalize_query(question["question"])
+        if key in existing:
+            continue
+        existing.add(key)
+        added.append(QuizQuestions(document=document, **{field: question[field] for field in FIELDS}))
+    QuizQuestions.objects.bulk_create(added)
+    return len(added)
+
+
+def clear_bank(document_id: int) -> None:
+    QuizQuestions.objects.filter(document_id=document_id).delete()
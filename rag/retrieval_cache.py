@@ -0,0 +1,111 @@
+"""
+Memoizes query embeddings and vector search results, so repeated and
+follow-up questions skip the embedding model and the Chroma search.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .clients import shared, get_collection, get_embed_model
+from .metrics import span
+
+VERSION_KEY = "rag:index_version:{course_id}"
+
+
+class LRUCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RetrievalCache:
+    """
+    Results are keyed on the query, the document set, k and the course's
+    index version. The version lives in Django's cache so that with a shared
+    cache backend, documents changed by an ingestion worker invalidate the
+    web processes' results too.
+
+    Versions are timestamps rather than counters: a cache backend may evict
+    the key, and a counter starting over at 0 would make results cached
+    before the evicted bumps reachable again.
+    """
+
+    def __init__(self, max_entries: int = 2048):
+        self.embeddings = LRUCache(max_entries)
+        self.results = LRUCache(max_entries)
+
+    @staticmethod
+    def version(course_id: int) -> int:
+        return django_cache.get_or_set(VERSION_KEY.format(course_id=course_id), time.time_ns, timeout=None)
+
+    @staticmethod
+    def bump_version(course_id: int) -> None:
+        django_cache.set(VERSION_KEY.format(course_id=course_id), time.time_ns(), timeout=None)
+
+    def embed_query(self, query: str, embed_model) -> list[float]:
+        embedding = self.embeddings.get(query)
+        if embedding is None:
+            embedding = embed_model.embed_query(query)
+            self.embeddings.set(query, embedding)
+        return embedding
+
+
+@shared
+def get_retrieval_cache() -> RetrievalCache:
+    return RetrievalCache(max_entries=getattr(settings, "RAG_RETRIEVAL_CACHE_SIZE", 2048))
+
+
+class CachedRetriever(BaseRetriever):
+    """
+    Top-k similarity search over the chunks of the given documents in a
+    course's collection, served from the retrieval cache when possible
+    """
+    course_id: int
+    document_ids: list[int]
+    k: int = 5
+    cache: RetrievalCache
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        key = (query, self.course_id, frozenset(self.document_ids), self.k,
+               self.cache.version(self.course_id))
+        docs = self.cache.results.get(key)
+        if docs is None:
+            with span("embed_query"):
+                embedding = self.cache.embed_query(query, get_embed_model())
+            with span("vector_search"):
+                result = get_collection(self.course_id).query(
+                    query_embeddings=[embedding],
+                    n_results=self.k,
+                    where={"id": {"$in": self.document_ids}},
+                    include=["documents", "metadatas"],
+                )
+            docs = [
+                Document(id=chunk_id, page_content=text, metadata=metadata or {})
+                for chunk_id, text, metadata in zip(result["ids"][0], result["documents"][0], result["metadatas"][0])
+            ]
+            self.cache.results.set(key, docs)
+        return list(docs)
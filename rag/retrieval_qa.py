@@ -1,142 +1,568 @@
-from typing import Any, List, Annotated
+import asyncio
+import logging
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from typing import Any, List, Annotated, AsyncIterator, Iterator
 from typing_extensions import TypedDict
-from langchain_ollama import ChatOllama
-from langchain.chains import RetrievalQA
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnableSequence
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.messages import HumanMessage, AIMessage
-from langgraph.checkpoint.sqlite import SqliteSaver
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.output_parsers import PydanticOutputParser, StrOutputParser
+from langchain_core.messages import (
+    HumanMessage, AIMessage, AIMessageChunk, BaseMessage, RemoveMessage, SystemMessage, trim_messages,
+)
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-import sqlite3
-import chromadb
 from pydantic import BaseModel, Field
+from django.conf import settings
+from .answer_cache import get_answer_cache, normalize_query
+from .checkpointer import acreate_checkpointer, get_checkpointer
+from .clients import shared, get_collection, get_llm
+from .keyword_index import HybridRetriever
+from .metrics import span, timed
+from .retrieval_cache import CachedRetriever, get_retrieval_cache
 
 
-conn = sqlite3.connect("history.sqlite3", check_same_thread=False)
-embed_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-chroma_client = chromadb.PersistentClient()
-llm = ChatOllama(model="llama3.2:latest",
-                    temperature=0.7
-                    )
+logger = logging.getLogger(__name__)
 
-vectorstore = Chroma(
-    collection_name="documents",
-    client=chroma_client,
-    embedding_function=embed_model
-)
+# Fuse BM25 over the keyword index with the dense search
+HYBRID_RETRIEVAL = getattr(settings, "RAG_HYBRID_RETRIEVAL", True)
+# Length of each ranking that goes into the fusion
+HYBRID_CANDIDATES = getattr(settings, "RAG_HYBRID_CANDIDATES", 20)
+# Tokens of recent conversation sent to the LLM with every question
+HISTORY_TOKENS = getattr(settings, "RAG_HISTORY_TOKENS", 1000)
+# Once a thread's messages grow past this, the older ones are folded into
+# its summary. Kept above HISTORY_TOKENS so that doesn't happen every turn
+SUMMARIZE_AFTER = getattr(settings, "RAG_HISTORY_SUMMARIZE_AFTER", 2 * HISTORY_TOKENS)
+# Threads that summarise in the background after their answer was sent
+SUMMARY_WORKERS = getattr(settings, "RAG_HISTORY_SUMMARY_WORKERS", 2)
+# Rewrite follow-up questions into standalone ones before retrieval
+CONDENSE_QUESTION = getattr(settings, "RAG_CONDENSE_QUESTION", False)
+# Questions asked of the LLM per quiz batch; batches run concurrently
+QUIZ_BATCH_SIZE = getattr(settings, "RAG_QUIZ_BATCH_SIZE", 3)
+# Chunks of the document each batch is written from
+QUIZ_BATCH_CHUNKS = getattr(settings, "RAG_QUIZ_BATCH_CHUNKS", 4)
+# Extra attempts at a batch whose output can't be parsed
+QUIZ_BATCH_RETRIES = getattr(settings, "RAG_QUIZ_BATCH_RETRIES", 2)
+# Most batches generated at the same time
+QUIZ_CONCURRENCY = getattr(settings, "RAG_QUIZ_CONCURRENCY", 8)
 
 
-def get_chain(document_ids: list[int], query:str, course_id:int, user_id:int) -> str:
+class State(TypedDict):
+    messages: Annotated[list, add_messages]
+    # Rolling summary of the messages that were dropped from the thread
+    summary: str
+    # What the chunks are retrieved with for the current question
+    query: str
+
+
+CHAT_TEMPLATE = """You are an educational assistant. Answer the question based on the context provided. 
+                If the questions seems off-topic, ask for clarification. If it's still off topic then say you can't help.
+                If the question is not clear, ask for clarification."""
+
+CONTEXT_TEMPLATE = """Use the following pieces of context to answer the user's question. 
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
+----------------
+{context}"""
+
+CONDENSE_TEMPLATE = """Given the conversation so far, rewrite the student's follow-up question as a 
+standalone question that can be understood without the conversation. Return only the question."""
+
+SUMMARY_TEMPLATE = """Extend the summary of the conversation between a student and an educational assistant 
+with the messages below. Keep the topics discussed and the facts needed to follow up on them, in a few sentences.
+
+Current summary:
+{summary}"""
+
+
+def count_tokens(messages: list[BaseMessage]) -> int:
     """
-    This deals with generating chat responses when users ask
+    Rough token count (four characters a token, plus a few per message),
+    which is all the history budget needs and costs no tokenizer call
     """
-    retriever = vectorstore.as_retriever(
-        search_kwargs={"k": 5, "filter": {"id": {"$in": document_ids}}}
+    return sum(len(str(message.content)) // 4 + 4 for message in messages)
+
+
+def recent_messages(messages: list[BaseMessage], max_tokens: int) -> list[BaseMessage]:
+    """
+    The latest messages that fit in max_tokens, starting on a question
+    """
+    return trim_messages(messages, max_tokens=max_tokens, token_counter=count_tokens,
+                         strategy="last", start_on="human")
+
+
+def get_retriever(course_id: int, document_ids: list[int], k: int = 5):
+    """
+    Returns a retriever limited to the chunks of the given documents
+    """
+    if not HYBRID_RETRIEVAL:
+        return CachedRetriever(course_id=course_id, document_ids=document_ids, k=k, cache=get_retrieval_cache())
+
+    candidates = max(k, HYBRID_CANDIDATES)
+    return HybridRetriever(
+        dense=CachedRetriever(course_id=course_id, document_ids=document_ids, k=candidates,
+                              cache=get_retrieval_cache()),
+        course_id=course_id,
+        document_ids=document_ids,
+        k=k,
+        candidates=candidates,
     )
 
-    thread_id = f"{course_id}_{user_id}"
 
-    class State(TypedDict):
-        messages: Annotated[list, add_messages]
+class ChatEngine:
+    """
+    Holds the prompts and the compiled chat graph so they are built once per
+    process. Everything that changes between requests (document ids, thread id
+    and the query) goes in through the graph config and state.
 
-    template = """You are an educational assistant. Answer the question based on the context provided. 
-                If the questions seems off-topic, ask for clarification. If it's still off topic then say you can't help.
-                If the question is not clear, ask for clarification."""
-        
-    prompt = ChatPromptTemplate.from_messages([
-        template,
-        MessagesPlaceholder(variable_name="messages", optional=True),
-        ("user", "{input}")
-    ])
-
-    def create_chain():
-        return RunnableSequence(
-            lambda inputs: {
-                "messages": inputs["messages"],
-                "input": inputs["query"]
-            },
-            prompt,
-            lambda input_with_prompt: {
-                "query": input_with_prompt.to_string()
-            },
-            RetrievalQA.from_chain_type(
-                retriever=retriever,
-                llm=llm,
-                chain_type="stuff",
-                output_key="result",
-            ),
-            lambda result: AIMessage(content=result["result"]),
-        )
-        
-    rag_chain = create_chain()
+    The graph rewrites the question into a retrieval query and answers it.
+    Once the answer is out, a background thread folds the older messages of
+    a long thread into a rolling summary. The prompt only ever carries the
+    summary and HISTORY_TOKENS of recent messages, so requests don't get
+    slower as a thread grows, and no request waits for the summary.
+    """
+
+    def __init__(self, llm, checkpointer, async_checkpointer=None, retriever_factory=get_retriever,
+                 history_tokens: int = HISTORY_TOKENS, summarize_after: int = SUMMARIZE_AFTER,
+                 condense_question: bool = CONDENSE_QUESTION, summary_workers: int = SUMMARY_WORKERS):
+        self.llm = llm
+        self.get_retriever = retriever_factory
+        self.history_tokens = history_tokens
+        self.summarize_after = summarize_after
+        self.condense_question = condense_question
+        self.prompt = ChatPromptTemplate.from_messages([
+            ("system", CHAT_TEMPLATE),
+            MessagesPlaceholder(variable_name="summary", optional=True),
+            MessagesPlaceholder(variable_name="history", optional=True),
+            ("system", CONTEXT_TEMPLATE),
+            ("user", "{question}"),
+        ])
+        self.qa_chain = self.prompt | llm
+        self.condense_chain = ChatPromptTemplate.from_messages([
+            ("system", CONDENSE_TEMPLATE),
+            MessagesPlaceholder(variable_name="history"),
+            ("user", "{question}"),
+        ]) | llm | StrOutputParser()
+        self.summary_chain = ChatPromptTemplate.from_messages([
+            ("system", SUMMARY_TEMPLATE),
+            MessagesPlaceholder(variable_name="messages"),
+            ("user", "Write the updated summary."),
+        ]) | llm | StrOutputParser()
+
+        graph_builder = StateGraph(State)
+        graph_builder.add_node("rewrite", RunnableLambda(self.rewrite, afunc=self.arewrite))
+        graph_builder.add_node("chatbot", RunnableLambda(self.chatbot, afunc=self.achatbot))
+        graph_builder.add_edge(START, "rewrite")
+        graph_builder.add_edge("rewrite", "chatbot")
+        graph_builder.add_edge("chatbot", END)
+        self.graph_builder = graph_builder
+        self.graph = graph_builder.compile(checkpointer=checkpointer)
+        # SqliteSaver and PostgresSaver have no async methods, so async
+        # requests get their own graph compiled against an async checkpointer
+        self._async_graph = None
+        if async_checkpointer is not None:
+            self._async_graph = graph_builder.compile(checkpointer=async_checkpointer)
+        # Otherwise one per event loop, with the stack that closes its
+        # checkpointer (see async_graph)
+        self._async_graphs: dict[asyncio.AbstractEventLoop, tuple] = {}
+        self._async_locks: dict[asyncio.AbstractEventLoop, asyncio.Lock] = {}
+        # Summaries run on the sync graph for both paths, so they don't
+        # depend on the event loop of the request that queued them
+        self._summaries = ThreadPoolExecutor(max_workers=summary_workers, thread_name_prefix="summarize")
+        self._summarizing: set[str] = set()
+        self._summarizing_lock = threading.Lock()
 
-    def chatbot(state: State):
+    @staticmethod
+    def config(document_ids: list[int], course_id: int, user_id: int) -> dict:
+        return {"configurable": {
+            "thread_id": f"{course_id}_{user_id}",
+            "course_id": int(course_id),
+            "document_ids": document_ids,
+        }}
+
+    @staticmethod
+    def _question(state: State) -> str:
         last_user_message = next(
             (m for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), 
             None
         )
-        inputs = {
-            "messages": state["messages"][:-1],
-            "query": last_user_message.content
+        return last_user_message.content
+
+    def _history(self, state: State) -> list[BaseMessage]:
+        return recent_messages(state["messages"][:-1], self.history_tokens)
+
+    def _condense_inputs(self, state: State) -> dict | None:
+        if not self.condense_question:
+            return None
+        history = self._history(state)
+        if not history:
+            return None
+        return {"history": history, "question": self._question(state)}
+
+    def rewrite(self, state: State, config: RunnableConfig):
+        inputs = self._condense_inputs(state)
+        if inputs is None:
+            return {"query": self._question(state)}
+        with span("condense"):
+            return {"query": self.condense_chain.invoke(inputs, config)}
+
+    async def arewrite(self, state: State, config: RunnableConfig):
+        inputs = self._condense_inputs(state)
+        if inputs is None:
+            return {"query": self._question(state)}
+        with span("condense"):
+            return {"query": await self.condense_chain.ainvoke(inputs, config)}
+
+    def _answer_inputs(self, state: State, docs) -> dict:
+        summary = state.get("summary")
+        return {
+            "summary": [SystemMessage(content=f"Summary of the earlier conversation: {summary}")] if summary else [],
+            "history": self._history(state),
+            "context": "\n\n".join(doc.page_content for doc in docs),
+            "question": self._question(state),
         }
-        result = rag_chain.invoke(inputs)
+
+    def chatbot(self, state: State, config: RunnableConfig):
+        configurable = config["configurable"]
+        retriever = self.get_retriever(configurable["course_id"], configurable["document_ids"])
+        with span("retrieve"):
+            docs = retriever.invoke(state["query"], config)
+        with span("llm"):
+            result = self.qa_chain.invoke(self._answer_inputs(state, docs), config)
+        # Returning the model's own message keeps its id, so the streamed
+        # chunks and the final message aren't emitted twice
         return {"messages": [result]}
 
-    # memory = MemorySaver()
-    memory = SqliteSaver(conn)
+    async def achatbot(self, state: State, config: RunnableConfig):
+        configurable = config["configurable"]
+        retriever = self.get_retriever(configurable["course_id"], configurable["document_ids"])
+        with span("retrieve"):
+            docs = await retriever.ainvoke(state["query"], config)
+        with span("llm"):
+            result = await self.qa_chain.ainvoke(self._answer_inputs(state, docs), config)
+        return {"messages": [result]}
 
-    graph_builder = StateGraph(State)
-    graph_builder.add_node("chatbot", chatbot)
-    graph_builder.add_edge(START, "chatbot")
-    graph_builder.add_edge("chatbot", END)
+    def _folded(self, state: State) -> list[BaseMessage]:
+        """
+        The messages that no longer fit in the window once the thread has
+        grown past summarize_after
+        """
+        messages = state.get("messages", [])
+        if count_tokens(messages) <= self.summarize_after:
+            return []
+        kept = {message.id for message in recent_messages(messages, self.history_tokens)}
+        # The latest question and its answer stay even when they alone are
+        # over the budget, so the thread never ends up empty
+        last_question = next((i for i in range(len(messages) - 1, -1, -1)
+                              if isinstance(messages[i], HumanMessage)), len(messages))
+        kept.update(message.id for message in messages[last_question:])
+        return [message for message in messages if message.id not in kept]
 
-    graph = graph_builder.compile(checkpointer=memory)
-    config = {"configurable": {"thread_id": thread_id}}
+    def summarize(self, config: dict) -> bool:
+        """
+        Folds the older messages of the thread into its summary if it has
+        grown past summarize_after. Returns whether it did.
+        """
+        state = self.graph.get_state(config).values
+        folded = self._folded(state)
+        if not folded:
+            return False
+        with span("summarize"):
+            summary = self.summary_chain.invoke({"summary": state.get("summary") or "None yet.", "messages": folded})
+        self.graph.update_state(
+            config,
+            {"summary": summary, "messages": [RemoveMessage(id=message.id) for message in folded]},
+            as_node="chatbot",
+        )
+        return True
 
-    def stream_graph_updates():
-        response = []
-        for message in graph.stream({
-            "messages": [{"role": "user", "content": query}]}, config=config):
-            for value in message.values():
-                response.append(value)
+    def summarize_later(self, config: dict) -> None:
+        """
+        Queues summarize() for the thread, so the turns that fold its history
+        don't wait for the extra LLM call. A thread is summarised by one task
+        at a time; a run that fails is made up for after the thread's next
+        turn, as the prompt window keeps the thread's requests bounded meanwhile.
+        """
+        thread_id = config["configurable"]["thread_id"]
+        with self._summarizing_lock:
+            if thread_id in self._summarizing:
+                return
+            self._summarizing.add(thread_id)
 
-        return response[0]["messages"][0].content
+        def run():
+            try:
+                self.summarize(config)
+            except Exception:
+                logger.exception("Summarising chat thread %s failed", thread_id)
+            finally:
+                with self._summarizing_lock:
+                    self._summarizing.discard(thread_id)
 
-    return stream_graph_updates()
-    
+        self._summaries.submit(run)
+
+    def invoke(self, document_ids: list[int], query: str, course_id: int, user_id: int) -> str:
+        config = self.config(document_ids, course_id, user_id)
+        answer = None
+        for update in self.graph.stream(
+            {"messages": [{"role": "user", "content": query}]}, config=config, stream_mode="updates",
+        ):
+            # Taken from the chatbot node's update rather than the final
+            # state, whose messages a summary may have folded meanwhile
+            if "chatbot" in update:
+                answer = update["chatbot"]["messages"][-1].content
+        self.summarize_later(config)
+        return answer
+
+    @staticmethod
+    def _token(chunk: BaseMessage, metadata: dict, streamed: bool) -> str | None:
+        """
+        The text the chatbot node contributes to a streamed answer. A model
+        that doesn't stream emits no chunks, only its final message, which
+        is then the whole answer.
+        """
+        if metadata.get("langgraph_node") != "chatbot" or not chunk.content:
+            return None
+        if isinstance(chunk, AIMessageChunk) or (isinstance(chunk, AIMessage) and not streamed):
+            return chunk.content
+        return None
+
+    def stream(self, document_ids: list[int], query: str, course_id: int, user_id: int) -> Iterator[str]:
+        """
+        Yields the answer token by token as the LLM produces it. The final
+        message is still written to the checkpointer once the graph finishes.
+        """
+        config = self.config(document_ids, course_id, user_id)
+        streamed = False
+        for chunk, metadata in self.graph.stream(
+            {"messages": [{"role": "user", "content": query}]}, config=config, stream_mode="messages",
+        ):
+            token = self._token(chunk, metadata, streamed)
+            if token:
+                streamed = True
+                yield token
+        self.summarize_later(config)
+
+    def has_history(self, document_ids: list[int], course_id: int, user_id: int) -> bool:
+        """
+        Whether the user's thread already holds messages, which a follow-up
+        question may refer to
+        """
+        values = self.graph.get_state(self.config(document_ids, course_id, user_id)).values
+        return bool(values.get("messages") or values.get("summary"))
+
+    async def ahas_history(self, document_ids: list[int], course_id: int, user_id: int) -> bool:
+        graph = await self.async_graph()
+        values = (await graph.aget_state(self.config(document_ids, course_id, user_id))).values
+        return bool(values.get("messages") or values.get("summary"))
+
+    def record(self, document_ids: list[int], query: str, answer: str, course_id: int, user_id: int) -> None:
+        """
+        Adds a question and an answer that didn't come from the graph (e.g. a
+        cached one) to the thread's history without calling the LLM
+        """
+        config = self.config(document_ids, course_id, user_id)
+        self.graph.update_state(
+            config, {"messages": [HumanMessage(content=query), AIMessage(content=answer)]}, as_node="chatbot",
+        )
+        self.summarize_later(config)
+
+    async def arecord(self, document_ids: list[int], query: str, answer: str, course_id: int, user_id: int) -> None:
+        graph = await self.async_graph()
+        config = self.config(document_ids, course_id, user_id)
+        await graph.aupdate_state(
+            config, {"messages": [HumanMessage(content=query), AIMessage(content=answer)]}, as_node="chatbot",
+        )
+        self.summarize_later(config)
+
+    async def async_graph(self):
+        """
+        The graph async requests run on. Async checkpointers have to be
+        created inside the running event loop and can't be used from another
+        one, so every loop opens its own on first use. It stays open until
+        aclose(), or until the loop shuts down: asyncio.run() closes the
+        async generators started in the loop, acreate_checkpointer's included.
+        """
+        if self._async_graph is not None:
+            return self._async_graph
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_graphs:
+            # Requests that arrive while the first one connects wait for it
+            async with self._async_locks.setdefault(loop, asyncio.Lock()):
+                if loop not in self._async_graphs:
+                    for closed in [other for other in self._async_graphs if other.is_closed()]:
+                        del self._async_graphs[closed]
+                        self._async_locks.pop(closed, None)
+                    stack = AsyncExitStack()
+                    checkpointer = await stack.enter_async_context(acreate_checkpointer())
+                    self._async_graphs[loop] = (self.graph_builder.compile(checkpointer=checkpointer), stack)
+        return self._async_graphs[loop][0]
 
-def get_quiz(document_id:int, number_of_questions:int) -> dict[str, Any]:
+    async def aclose(self) -> None:
+        """
+        Closes the async checkpointer of the running event loop, e.g. when
+        the ASGI server shuts down
+        """
+        loop = asyncio.get_running_loop()
+        self._async_locks.pop(loop, None)
+        entry = self._async_graphs.pop(loop, None)
+        if entry is not None:
+            await entry[1].aclose()
+
+    async def ainvoke(self, document_ids: list[int], query: str, course_id: int, user_id: int) -> str:
+        graph = await self.async_graph()
+        config = self.config(document_ids, course_id, user_id)
+        answer = None
+        async for update in graph.astream(
+            {"messages": [{"role": "user", "content": query}]}, config=config, stream_mode="updates",
+        ):
+            if "chatbot" in update:
+                answer = update["chatbot"]["messages"][-1].content
+        self.summarize_later(config)
+        return answer
+
+    async def astream(self, document_ids: list[int], query: str, course_id: int, user_id: int) -> AsyncIterator[str]:
+        graph = await self.async_graph()
+        config = self.config(document_ids, course_id, user_id)
+        streamed = False
+        async for chunk, metadata in graph.astream(
+            {"messages": [{"role": "user", "content": query}]}, config=config, stream_mode="messages",
+        ):
+            token = self._token(chunk, metadata, streamed)
+            if token:
+                streamed = True
+                yield token
+        self.summarize_later(config)
+
+
+@shared
+def get_chat_engine() -> ChatEngine:
+    return ChatEngine(get_llm(), get_checkpointer())
+
+
+async def aclose_chat_engine() -> None:
     """
-    Generates quiz questions from a document with robust parsing.
-    
-    Args:
-        query: The topic or prompt for quiz generation
-        document_id: ID of the document to use as context
-        number_of_questions: Number of questions to generate
-        
-    Returns:
-        Dictionary containing questions, answers, and possible answers or error info
-    """
-    # Define a simpler output schema that's easier for the LLM to generate
-    class QuizQuestion(BaseModel):
-        question: str = Field(description="The quiz question text")
-        options: List[str] = Field(description="List of 4 multiple choice options", min_items=4, max_items=4)
-        answer: str = Field(description="The correct option letter (A, B, C, or D)")
-        explanation: str = Field(description="The explanation of why the answer selected is the correct option")
+    Closes the async chat history connection of the running event loop, if
+    the chat engine was ever used
+    """
+    engine = get_chat_engine.existing()
+    if engine is not None:
+        await engine.aclose()
+
+
+def get_chain(document_ids: list[int], query:str, course_id:int, user_id:int) -> str:
+    """
+    This deals with generating chat responses when users ask. Answers are
+    shared through the cache only for a thread's first question: a follow-up
+    like "can you give an example of that?" depends on the conversation.
+    """
+    engine = get_chat_engine()
+    if engine.has_history(document_ids, course_id, user_id):
+        return engine.invoke(document_ids, query, course_id, user_id)
+
+    answer_cache = get_answer_cache()
+    cached = answer_cache.get(course_id, document_ids, query)
+    if cached is not None:
+        engine.record(document_ids, query, cached, course_id, user_id)
+        return cached
+
+    response = engine.invoke(document_ids, query, course_id, user_id)
+    if response:
+        answer_cache.set(course_id, document_ids, query, response)
+    return response
+
+
+def stream_chain(document_ids: list[int], query:str, course_id:int, user_id:int) -> Iterator[str]:
+    """
+    Same as get_chain but yields the response tokens as they are generated
+    """
+    engine = get_chat_engine()
+    if engine.has_history(document_ids, course_id, user_id):
+        yield from engine.stream(document_ids, query, course_id, user_id)
+        return
+
+    answer_cache = get_answer_cache()
+    cached = answer_cache.get(course_id, document_ids, query)
+    if cached is not None:
+        engine.record(document_ids, query, cached, course_id, user_id)
+        yield cached
+        return
+
+    tokens = []
+    for token in engine.stream(document_ids, query, course_id, user_id):
+        tokens.append(token)
+        yield token
+    # Only reached once the graph has finished: a client that disconnects
+    # closes the generator at the yield, so a cut-off answer isn't cached
+    if tokens:
+        answer_cache.set(course_id, document_ids, query, "".join(tokens))
+
+
+async def aget_chain(document_ids: list[int], query:str, course_id:int, user_id:int) -> str:
+    """
+    Async version of get_chain for ASGI views
+    """
+    engine = get_chat_engine()
+    if await engine.ahas_history(document_ids, course_id, user_id):
+        return await engine.ainvoke(document_ids, query, course_id, user_id)
+
+    answer_cache = get_answer_cache()
+    # Semantic lookups embed the question, which would block the event loop
+    cached = await asyncio.to_thread(answer_cache.get, course_id, document_ids, query)
+    if cached is not None:
+        await engine.arecord(document_ids, query, cached, course_id, user_id)
+        return cached
+
+    response = await engine.ainvoke(document_ids, query, course_id, user_id)
+    if response:
+        await asyncio.to_thread(answer_cache.set, course_id, document_ids, query, response)
+    return response
+
+
+async def astream_chain(document_ids: list[int], query:str, course_id:int, user_id:int) -> AsyncIterator[str]:
+    """
+    Async version of stream_chain. Under ASGI a sync generator is read to the
+    end before the response is sent, so only this one streams token by token.
+    """
+    engine = get_chat_engine()
+    if await engine.ahas_history(document_ids, course_id, user_id):
+        async for token in engine.astream(document_ids, query, course_id, user_id):
+            yield token
+        return
+
+    answer_cache = get_answer_cache()
+    cached = await asyncio.to_thread(answer_cache.get, course_id, document_ids, query)
+    if cached is not None:
+        await engine.arecord(document_ids, query, cached, course_id, user_id)
+        yield cached
+        return
+
+    tokens = []
+    async for token in engine.astream(document_ids, query, course_id, user_id):
+        tokens.append(token)
+        yield token
+    if tokens:
+        await asyncio.to_thread(answer_cache.set, course_id, document_ids, query, "".join(tokens))
     
-    class QuizOutput(BaseModel):
-        quiz: List[QuizQuestion] = Field(description="List of generated quiz questions")
 
-    # Get parser and format instructions
-    parser = PydanticOutputParser(pydantic_object=QuizOutput)
-    format_instructions = parser.get_format_instructions()
+# Define a simpler output schema that's easier for the LLM to generate
+class QuizQuestion(BaseModel):
+    question: str = Field(description="The quiz question text")
+    options: List[str] = Field(description="List of 4 multiple choice options", min_items=4, max_items=4)
+    answer: str = Field(description="The correct option letter (A, B, C, or D)")
+    explanation: str = Field(description="The explanation of why the answer selected is the correct option")
+
 
-    # Create a very explicit prompt template
-    template = """Generate exactly {number} quiz questions based on the context below.
+class QuizOutput(BaseModel):
+    quiz: List[QuizQuestion] = Field(description="List of generated quiz questions")
+
+
+# Get parser and format instructions
+quiz_parser = PydanticOutputParser(pydantic_object=QuizOutput)
+
+# Create a very explicit prompt template
+QUIZ_TEMPLATE = """Generate exactly {number} quiz questions based on the context below.
     
     FORMATTING INSTRUCTIONS:
     {format_instructions}
@@ -164,60 +590,137 @@ def get_quiz(document_id:int, number_of_questions:int) -> dict[str, Any]:
     
     Now generate {number} questions."""
 
-    prompt = ChatPromptTemplate.from_template(template).partial(
-        format_instructions=format_instructions,
-        number=number_of_questions,
-    )
+quiz_prompt = ChatPromptTemplate.from_template(QUIZ_TEMPLATE).partial(
+    format_instructions=quiz_parser.get_format_instructions(),
+)
+
+
+def _parse_quiz(raw_output: str) -> list[dict[str, Any]]:
+    # First try direct parsing
+    try:
+        parsed = quiz_parser.parse(raw_output)
+    except Exception as parse_error:
+        # Fallback: Try to extract JSON from output
+        try:
+            json_str = raw_output.split("```json")[1].split("```")[0].strip()
+            parsed = quiz_parser.parse(json_str)
+        except Exception as json_error:
+            raise Exception(
+                "Failed to parse quiz questions. Please check the output format."
+            ) from json_error
+
+    return [
+        {"question": q.question, 
+         "options":q.options, 
+         "answer": q.answer, 
+         "explanation": q.explanation} 
+         for q in parsed.quiz]
+
+
+def quiz_chunk_sets(course_id: int, document_id: int, sets: int, size: int = QUIZ_BATCH_CHUNKS) -> list[str]:
+    """
+    Samples `sets` disjoint groups of chunks from across the document (fewer
+    chunks than that and they're shared), returned as one context per group
+    """
+    collection = get_collection(course_id)
+    chunk_ids = collection.get(where={"id": document_id}, include=[])["ids"]
+    if not chunk_ids:
+        raise ValueError("The document has no indexed content")
+    picked = random.sample(chunk_ids, min(len(chunk_ids), sets * size))
+    result = collection.get(ids=picked, include=["documents"])
+    texts = dict(zip(result["ids"], result["documents"]))
+    groups = [picked[i::sets] or [picked[i % len(picked)]] for i in range(sets)]
+    return ["\n\n".join(texts[chunk_id] for chunk_id in group) for group in groups]
+
+
+def _quiz_batches(number_of_questions: int) -> list[int]:
+    batches = math.ceil(number_of_questions / QUIZ_BATCH_SIZE)
+    return [min(QUIZ_BATCH_SIZE, number_of_questions - i * QUIZ_BATCH_SIZE) for i in range(batches)]
 
-    retriever = vectorstore.as_retriever(
-        search_kwargs={"k": 5, "filter": {"id": {"$eq": [document_id]}}}
-    )
 
-    qa_chain = RetrievalQA.from_chain_type(
-        retriever=retriever,
-        llm=llm,
-        chain_type_kwargs={
-            "prompt": prompt,
-            "document_variable_name": "context"
-        },
-        chain_type="stuff",
-        output_key="result"
+def _quiz_chain():
+    # Parsing is part of the retried runnable, so a malformed answer only
+    # costs its own small batch
+    return (quiz_prompt | get_llm() | StrOutputParser() | RunnableLambda(_parse_quiz)).with_retry(
+        stop_after_attempt=QUIZ_BATCH_RETRIES + 1
     )
 
-    try:
-        response = qa_chain.invoke({"query": "Generate quiz questions"})
-        raw_output = response["result"]
-        
+
+def _merge_quiz(batches: list, number_of_questions: int) -> list[dict[str, Any]]:
+    """
+    Drops failed batches and questions asked twice
+    """
+    questions, seen = [], set()
+    for batch in batches:
+        if isinstance(batch, Exception):
+            logger.warning("Quiz batch failed: %s", batch)
+            continue
+        for question in batch:
+            key = normalize_query(question["question"])
+            if key not in seen:
+                seen.add(key)
+                questions.append(question)
+    if not questions:
+        raise Exception("Failed to parse quiz questions. Please check the output format.")
+    return questions[:number_of_questions]
+
+
+@timed("quiz")
+def get_quiz(course_id:int, document_id:int, number_of_questions:int) -> list[dict[str, Any]]:
+    """
+    Generates quiz questions from a document with robust parsing. The quiz
+    is split into batches of QUIZ_BATCH_SIZE questions, each written from a
+    different sample of the document's chunks and generated concurrently;
+    a batch that keeps failing to parse is dropped.
+    
+    Args:
+        course_id: ID of the course the document belongs to
+        document_id: ID of the document to use as context
+        number_of_questions: Number of questions to generate
         
-        # First try direct parsing
-        try:
-            parsed = parser.parse(raw_output)
-            return [
-                {"question": q.question, 
-                 "options":q.options, 
-                 "answer": q.answer, 
-                 "explanation": q.explanation} 
-                 for q in parsed.quiz]
-        except Exception as parse_error:
-            # Fallback: Try to extract JSON from output
+    Returns:
+        List of questions with their options, answer and explanation
+    """
+    try:
+        sizes = _quiz_batches(number_of_questions)
+        with span("quiz_chunks"):
+            contexts = quiz_chunk_sets(course_id, document_id, len(sizes))
+        chain = _quiz_chain()
+
+        def generate(size: int, context: str):
             try:
-                json_str = raw_output.split("```json")[1].split("```")[0].strip()
-                parsed = parser.parse(json_str)
-                return [
-                {"question": q.question, 
-                 "options":q.options, 
-                 "answer": q.answer, 
-                 "explanation": q.explanation} 
-                 for q in parsed.quiz]
-            
-            except Exception as json_error:
-                # Final fallback: Manual extraction
-                raise Exception(
-                    "Failed to parse quiz questions. Please check the output format."
-                ) from json_error
+                return chain.invoke({"number": size, "context": context})
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(QUIZ_CONCURRENCY, len(sizes))) as pool:
+            batches = list(pool.map(generate, sizes, contexts))
+        return _merge_quiz(batches, number_of_questions)
     except Exception as e:
         raise Exception(
             "Failed to generate quiz questions. Please check the input and try again."
         ) from e
 
-    
+
+@timed("quiz")
+async def aget_quiz(course_id:int, document_id:int, number_of_questions:int) -> list[dict[str, Any]]:
+    """
+    Async version of get_quiz
+    """
+    try:
+        sizes = _quiz_batches(number_of_questions)
+        with span("quiz_chunks"):
+            contexts = await asyncio.to_thread(quiz_chunk_sets, course_id, document_id, len(sizes))
+        chain = _quiz_chain()
+        semaphore = asyncio.Semaphore(QUIZ_CONCURRENCY)
+
+        async def generate(size: int, context: str):
+            async with semaphore:
+                return await chain.ainvoke({"number": size, "context": context})
+
+        batches = await asyncio.gather(*map(generate, sizes, contexts), return_exceptions=True)
+        return _merge_quiz(batches, number_of_questions)
+    except Exception as e:
+        raise Exception(
+            "Failed to generate quiz questions. Please check the input and try again."
+        ) from e
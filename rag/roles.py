@@ -1,21 +1,115 @@
-from .models import Admins, Libraries
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+
+from .models import Admins, Libraries, Members
+
+# Seconds a resolved role is reused across requests (0 disables the cache).
+# Membership changes invalidate it right away through signals.
+ROLE_CACHE_TTL = getattr(settings, "RAG_ROLE_CACHE_TTL", 0)
+
+
+@dataclass(frozen=True)
+class LibraryRole:
+    library: Libraries | None
+    is_creator: bool = False
+    is_admin: bool = False
+    is_member: bool = False
+
+    @property
+    def can_edit(self) -> bool:
+        return self.is_creator or self.is_admin
+
+    @property
+    def can_view(self) -> bool:
+        return self.is_creator or self.is_admin or self.is_member
+
+
+def _version_key(library_id) -> str:
+    return f"rag:role_version:{library_id}"
+
+
+def invalidate_roles(library_id) -> None:
+    """
+    Makes every cached role for the library stale. Like the course index
+    versions, role versions are timestamps so that an evicted version key
+    never brings back roles cached under an older one.
+    """
+    if not ROLE_CACHE_TTL:
+        return
+    cache.set(_version_key(library_id), time.time_ns(), timeout=None)
+
+
+def resolve_role(user, library_id) -> LibraryRole:
+    """
+    Loads the library together with the user's admin and member status in a
+    single query
+    """
+    library = Libraries.objects.filter(id=library_id).annotate(
+        user_is_admin=Exists(Admins.objects.filter(library=OuterRef("pk"), user_id=user.id)),
+        user_is_member=Exists(Members.objects.filter(library=OuterRef("pk"), user_id=user.id)),
+    ).first()
+    if library is None:
+        return LibraryRole(library=None)
+    return LibraryRole(
+        library=library,
+        is_creator=library.creator_id == user.id,
+        is_admin=library.user_is_admin,
+        is_member=library.user_is_member,
+    )
+
+
+def _cached_role(user, library_id) -> LibraryRole:
+    if not ROLE_CACHE_TTL:
+        return resolve_role(user, library_id)
+    version = cache.get_or_set(_version_key(library_id), time.time_ns, timeout=None)
+    key = f"rag:role:{library_id}:{user.id}:{version}"
+    role = cache.get(key)
+    if role is None:
+        role = resolve_role(user, library_id)
+        cache.set(key, role, timeout=ROLE_CACHE_TTL)
+    return role
+
+
+def get_library_role(request, library_id) -> LibraryRole:
+    """
+    The user's role in the library, resolved once per request and shared by
+    the permission classes and the view
+    """
+    # Kept on the Django request, which DRF requests wrap
+    http_request = getattr(request, "_request", request)
+    roles = getattr(http_request, "_library_roles", None)
+    if roles is None:
+        roles = http_request._library_roles = {}
+    key = str(library_id)
+    if key not in roles:
+        try:
+            roles[key] = _cached_role(request.user, library_id)
+        except (ValueError, TypeError):
+            # Not a valid id
+            roles[key] = LibraryRole(library=None)
+    return roles[key]
+
 
 def is_creator(user, library: Libraries) -> bool:
     """
     Check if the user is a creator of the specified library.
     """
-    return library.creator == user
+    return library.creator_id == user.id
 
 
 def is_admin(user, library: Libraries) -> bool:
     """
     Check if the user is an admin of the specified library.
     """
-    return Admins.objects.filter(user=user, library=library).exists()
+    return _cached_role(user, library.id).is_admin
 
 
 def has_edit_permission(user, library: Libraries) -> bool:
     """
     Check if the user has edit permissions for the specified library.
     """
-    return is_creator(user, library) or is_admin(user, library)
\ No newline at end of file
+    return is_creator(user, library) or is_admin(user, library)
@@ -43,7 +43,7 @@ class DocumentsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Documents
         fields = "__all__"
-        read_only_fields = ["id", "uploaded_at", "user"]
+        read_only_fields = ["id", "uploaded_at", "user", "status", "error"]
 
 class LibrariesSerializer(serializers.ModelSerializer):
     class Meta:
@@ -77,7 +77,10 @@ class MembersSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        is_admin = Admins.objects.filter(user=instance.user, library=instance.library).exists()
+        # Querysets annotated with is_admin (see get_members) avoid a query per row
+        is_admin = getattr(instance, "is_admin", None)
+        if is_admin is None:
+            is_admin = Admins.objects.filter(user_id=instance.user_id, library_id=instance.library_id).exists()
         data["is_admin"] = is_admin
         return data
     
\ No newline at end of file
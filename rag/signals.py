@@ -0,0 +1,41 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .answer_cache import get_answer_cache
+from .doc_add import delete_course_collection
+from .models import Admins, Courses, Documents, Libraries, Members
+from .roles import invalidate_roles
+
+
+@receiver(post_delete, sender=Documents)
+def delete_document_file(sender, instance, **kwargs):
+    """
+    Deleting a course or library cascades to its documents without calling
+    Documents.delete, so their files are removed here
+    """
+    if instance.file:
+        instance.file.delete(save=False)
+
+
+@receiver(post_delete, sender=Courses)
+def delete_course_vectors(sender, instance, **kwargs):
+    """
+    Drops the course's Chroma collection, whether the course was deleted
+    directly or along with its library
+    """
+    delete_course_collection(instance.id)
+    get_answer_cache().invalidate(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Members)
+@receiver([post_save, post_delete], sender=Admins)
+def invalidate_member_roles(sender, instance, **kwargs):
+    """
+    Cached library roles must not outlive a membership change
+    """
+    invalidate_roles(instance.library_id)
+
+
+@receiver([post_save, post_delete], sender=Libraries)
+def invalidate_library_roles(sender, instance, **kwargs):
+    invalidate_roles(instance.id)
@@ -1,3 +1,850 @@
+import asyncio
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import chromadb
+from chromadb.config import Settings as ChromaSettings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+from langchain_core.vectorstores import InMemoryVectorStore
+from langgraph.checkpoint.memory import MemorySaver
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from .answer_cache import AnswerCache
+from .checkpointer import prune_if_due
+from .clients import get_chroma_client, get_collection
+from .doc_add import reindex_in_chromadb, store_in_chromadb
+from .ingestion import RETRY_DELAY, STALE_AFTER, claim_job, enqueue_document, heartbeat, run_job
+from .keyword_index import HybridRetriever, index_chunks, keyword_search, reciprocal_rank_fusion
+from .models import Admins, Courses, Documents, IngestionJobs, KeywordChunks, KeywordPostings, Libraries, Members
+from .permissions import IsLibraryAdmin, IsLibraryCreator, IsLibraryCreatorOrAdmin, IsLibraryMember
+from .quiz_bank import BANK_SIZE
+from .retrieval_cache import VERSION_KEY, RetrievalCache
+from .retrieval_qa import (
+    ChatEngine, _merge_quiz, _quiz_batches, astream_chain, get_chain, get_quiz, recent_messages, stream_chain,
+)
+from .roles import _version_key
+
+User = get_user_model()
+
+
+class QueryCountTestCase(TestCase):
+    """
+    Base for query-count regression tests. An endpoint's query count must
+    stay the same as rows are added, however many there are.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.creator = self.make_user("creator")
+        self.library = Libraries.objects.create(
+            creator=self.creator, library_name="Library", library_description="", entry_key="key"
+        )
+        self.client.force_authenticate(self.creator)
+
+    def make_user(self, username: str):
+        return User.objects.create_user(username=username, email=f"{username}@example.com", password="password")
+
+    def count_queries(self, request) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+        self.assertLess(response.status_code, 400, getattr(response, "data", None))
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, request, add_rows, rounds: int = 2):
+        """
+        Runs the request, adds rows with add_rows(round) and runs it again,
+        `rounds` times, failing if the query count changes
+        """
+        expected = self.count_queries(request)
+        for round_number in range(rounds):
+            add_rows(round_number)
+            self.assertEqual(self.count_queries(request), expected,
+                             f"query count grew after adding rows (round {round_number + 1})")
+
+
+class GetMembersQueryCountTests(QueryCountTestCase):
+    def add_members(self, round_number: int):
+        for i in range(5):
+            user = self.make_user(f"member_{round_number}_{i}")
+            Members.objects.create(user=user, library=self.library)
+            if i % 2 == 0:
+                Admins.objects.create(user=user, library=self.library)
+
+    def get_members(self):
+        return self.client.get(reverse("getMembers"), {"library_id": self.library.id})
+
+    def test_query_count_does_not_grow_with_members(self):
+        self.add_members(-1)
+        self.assertConstantQueries(self.get_members, self.add_members)
+
+    def test_members_are_flagged_as_admins(self):
+        self.add_members(0)
+        response = self.get_members()
+        admin_ids = set(Admins.objects.filter(library=self.library).values_list("user_id", flat=True))
+        for member in response.data["members"]:
+            self.assertEqual(member["is_admin"], member["user"]["id"] in admin_ids)
+        self.assertTrue(all(admin["is_admin"] for admin in response.data["body"]))
+
+
+class StreamLlmTests(QueryCountTestCase):
+    def test_event_source_accept_header_is_accepted(self):
+        course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        response = self.client.get(
+            reverse("questionStream"),
+            {"library_id": self.library.id, "course_id": course.id, "query": "What is entropy?"},
+            HTTP_ACCEPT="text/event-stream",
+        )
+        # No ready documents yet: the error comes back as an event, not a 406
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(response["Content-Type"].startswith("text/event-stream"))
+        self.assertIn(b"event: error", response.content)
+
+
+class NonStreamingChatModel(BaseChatModel):
+    """Returns the whole answer in one message, without token callbacks"""
+    answer: str = "Entropy measures how spread out energy is."
+
+    @property
+    def _llm_type(self) -> str:
+        return "non-streaming"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+
+class ChatEngineTestCase(TestCase):
+    """
+    Runs the chat functions against an in-memory chat engine and answer
+    cache, with a retriever that finds nothing
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.answer_cache = AnswerCache()
+        patches = [
+            mock.patch("rag.retrieval_qa.get_chat_engine", side_effect=lambda: self.engine),
+            mock.patch("rag.retrieval_qa.get_answer_cache", return_value=self.answer_cache),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.use_llm(NonStreamingChatModel())
+
+    def use_llm(self, llm, **kwargs):
+        checkpointer = MemorySaver()
+        self.engine = ChatEngine(llm, checkpointer, async_checkpointer=checkpointer,
+                                 retriever_factory=lambda course_id, document_ids: RunnableLambda(lambda query: []),
+                                 **kwargs)
+
+
+class StreamChainTests(ChatEngineTestCase):
+    def test_model_that_does_not_stream(self):
+        answer = NonStreamingChatModel().answer
+        self.assertEqual("".join(stream_chain([1], "What is entropy?", 1, 1)), answer)
+        # Another student gets the cached answer, not an empty one
+        self.assertEqual(get_chain([1], "What is entropy?", 1, 2), answer)
+
+    def test_async_model_that_does_not_stream(self):
+        async def tokens():
+            return [token async for token in astream_chain([1], "What is entropy?", 1, 1)]
+
+        self.assertEqual("".join(asyncio.run(tokens())), NonStreamingChatModel().answer)
+
+    def test_cut_off_stream_is_not_cached(self):
+        self.use_llm(FakeListChatModel(responses=["A long answer"]))
+        tokens = stream_chain([1], "What is entropy?", 1, 1)
+        next(tokens)
+        # What the server does when the client disconnects
+        tokens.close()
+        self.assertIsNone(self.answer_cache.get(1, [1], "What is entropy?"))
+
+    def test_empty_answer_is_not_cached(self):
+        self.answer_cache.set(1, [1], "What is entropy?", "")
+        self.assertIsNone(self.answer_cache.get(1, [1], "What is entropy?"))
+
+
+class AnswerCacheThreadTests(ChatEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_llm(FakeListChatModel(responses=["First answer", "Follow-up answer"]))
+
+    def test_first_question_is_shared_between_threads(self):
+        self.assertEqual(get_chain([1], "What is entropy?", 1, 1), "First answer")
+        self.assertEqual(get_chain([1], "What is entropy?", 1, 2), "First answer")
+        # The cached answer is part of the second student's thread too
+        self.assertTrue(self.engine.has_history([1], 1, 2))
+        self.assertEqual(self.engine.llm.i, 1)
+
+    def test_follow_up_is_neither_looked_up_nor_cached(self):
+        get_chain([1], "Can you give an example?", 1, 1)
+        self.answer_cache.set(1, [1], "What is entropy?", "Cached answer")
+        self.assertEqual(get_chain([1], "What is entropy?", 1, 1), "Follow-up answer")
+        self.assertEqual(get_chain([1], "What is entropy?", 1, 2), "Cached answer")
+
+    def test_threads_of_other_courses_are_separate(self):
+        get_chain([1], "What is entropy?", 1, 1)
+        self.assertFalse(self.engine.has_history([1], 2, 1))
+        self.assertEqual(get_chain([1], "What is entropy?", 2, 1), "Follow-up answer")
+
+
+class ChatHistoryTests(ChatEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_llm(NonStreamingChatModel(), history_tokens=30, summarize_after=60, summary_workers=1)
+        self.config = ChatEngine.config([1], 1, 1)
+
+    def ask(self, turns: int, wait: bool = True):
+        for turn in range(turns):
+            self.engine.invoke([1], f"Question {turn} about entropy?", 1, 1)
+            if wait:
+                # Lets the queued summary finish before the next turn
+                self.engine._summaries.submit(lambda: None).result()
+
+    def messages(self):
+        return self.engine.graph.get_state(self.config).values["messages"]
+
+    def test_recent_messages_start_on_a_question(self):
+        messages = [HumanMessage(content="a" * 40), AIMessage(content="b" * 40),
+                    HumanMessage(content="c" * 40), AIMessage(content="d" * 40)]
+        self.assertEqual(recent_messages(messages, 30), messages[2:])
+        # An answer that fits without its question is dropped as well
+        self.assertEqual(recent_messages(messages, 20), [])
+
+    def test_answer_does_not_wait_for_the_summary(self):
+        with mock.patch.object(self.engine, "summarize") as summarize:
+            self.ask(4)
+        self.assertEqual(len(self.messages()), 8)
+        summarize.assert_called_with(self.config)
+
+    def test_long_thread_is_summarized(self):
+        self.ask(4)
+        state = self.engine.graph.get_state(self.config).values
+        self.assertEqual(state["summary"], NonStreamingChatModel().answer)
+        messages = state["messages"]
+        self.assertLess(len(messages), 8)
+        self.assertIsInstance(messages[0], HumanMessage)
+        self.assertEqual(messages[-2].content, "Question 3 about entropy?")
+        self.assertFalse(self.engine.summarize(self.config))
+
+    def test_failed_summary_is_made_up_for_after_the_next_turn(self):
+        summary_chain = self.engine.summary_chain
+        self.engine.summary_chain = RunnableLambda(mock.Mock(side_effect=RuntimeError))
+        with self.assertLogs("rag.retrieval_qa", "ERROR"):
+            self.ask(3)
+        self.engine.summary_chain = summary_chain
+        self.assertEqual(len(self.messages()), 6)
+        self.assertEqual(self.engine._summarizing, set())
+        self.ask(1)
+        self.assertLess(len(self.messages()), 8)
+
+
+class WordCountEmbeddings(Embeddings):
+    """Counts a few words, so questions using the same ones are similar"""
+    WORDS = ("entropy", "enthalpy", "gas", "reaction")
+
+    def embed_query(self, text: str) -> list[float]:
+        return [float(text.count(word)) for word in self.WORDS]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class SemanticAnswerCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patch = mock.patch("rag.answer_cache.get_retrieval_cache", return_value=RetrievalCache())
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.answer_cache = AnswerCache(max_entries=2, semantic_threshold=0.9, embed_model=WordCountEmbeddings())
+
+    def test_similar_question_is_a_hit(self):
+        self.answer_cache.set(1, [1], "What is the entropy of a gas?", "An answer")
+        self.assertEqual(self.answer_cache.get(1, [1], "Explain gas entropy"), "An answer")
+        self.assertIsNone(self.answer_cache.get(1, [1], "What is the enthalpy of a reaction?"))
+
+    def test_only_the_same_documents_are_compared(self):
+        self.answer_cache.set(1, [1], "What is the entropy of a gas?", "An answer")
+        self.assertIsNone(self.answer_cache.get(1, [1, 2], "Explain gas entropy"))
+        self.assertIsNone(self.answer_cache.get(2, [1], "Explain gas entropy"))
+
+    def test_evicted_and_invalidated_answers_are_not_compared(self):
+        self.answer_cache.set(1, [1], "What is the entropy of a gas?", "First")
+        self.answer_cache.set(1, [1], "What is enthalpy?", "Second")
+        self.answer_cache.set(1, [1], "What is a reaction?", "Third")
+        self.assertIsNone(self.answer_cache.get(1, [1], "Explain gas entropy"))
+        self.answer_cache.invalidate(1)
+        self.assertIsNone(self.answer_cache.get(1, [1], "What is a reaction?"))
+        self.assertEqual(self.answer_cache._embedded, {})
+
+
+class AsyncCheckpointerTests(TestCase):
+    def setUp(self):
+        self.engine = ChatEngine(FakeListChatModel(responses=["An answer"]), MemorySaver(),
+                                 retriever_factory=lambda course_id, document_ids: RunnableLambda(lambda query: []))
+
+    async def connection(self, close: bool = False):
+        graph = await self.engine.async_graph()
+        if close:
+            await self.engine.aclose()
+        return graph.checkpointer.conn
+
+    def assertClosed(self, conn):
+        # aiosqlite's connection thread, which would keep the process alive
+        conn.join(timeout=5)
+        self.assertFalse(conn.is_alive())
+
+    def test_each_event_loop_has_its_own_connection(self):
+        first = asyncio.run(self.connection())
+        second = asyncio.run(self.connection())
+        self.assertIsNot(first, second)
+        self.assertClosed(first)
+        self.assertClosed(second)
+
+    def test_aclose(self):
+        self.assertClosed(asyncio.run(self.connection(close=True)))
+        self.assertEqual(self.engine._async_graphs, {})
+
+
+def quiz_question(question: str) -> dict:
+    return {"question": question, "options": ["A. 1", "B. 2", "C. 3", "D. 4"], "answer": "A",
+            "explanation": "Because."}
+
+
+class QuizGenerationTests(TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch("rag.retrieval_qa.quiz_chunk_sets", side_effect=lambda course_id, document_id, n: ["notes"] * n),
+            # One batch at a time, so they take the fake model's answers in order
+            mock.patch("rag.retrieval_qa.QUIZ_CONCURRENCY", 1),
+            mock.patch("rag.retrieval_qa.QUIZ_BATCH_SIZE", 3),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def use_answers(self, *answers):
+        llm = FakeListChatModel(responses=list(answers))
+        patch = mock.patch("rag.retrieval_qa.get_llm", return_value=llm)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return llm
+
+    @staticmethod
+    def answer(*questions) -> str:
+        return json.dumps({"quiz": [quiz_question(question) for question in questions]})
+
+    def test_batch_sizes(self):
+        self.assertEqual(_quiz_batches(7), [3, 3, 1])
+        self.assertEqual(_quiz_batches(3), [3])
+        self.assertEqual(_quiz_batches(1), [1])
+
+    def test_malformed_batch_is_retried_on_its_own(self):
+        llm = self.use_answers(self.answer("Q1", "Q2", "Q3"), "Sorry, I can't.", self.answer("Q4", "Q5"), "Unused")
+        quiz = get_quiz(1, 1, 5)
+        self.assertEqual([question["question"] for question in quiz], ["Q1", "Q2", "Q3", "Q4", "Q5"])
+        self.assertEqual(llm.i, 3)
+
+    def test_failed_batches_and_repeated_questions_are_dropped(self):
+        batches = [[quiz_question("What is entropy?"), quiz_question("What is enthalpy?")],
+                   Exception("unparseable"),
+                   [quiz_question("what is  entropy"), quiz_question("What is a gas?")]]
+        with self.assertLogs("rag.retrieval_qa", "WARNING"):
+            quiz = _merge_quiz(batches, 9)
+        self.assertEqual([question["question"] for question in quiz],
+                         ["What is entropy?", "What is enthalpy?", "What is a gas?"])
+
+    def test_quiz_fails_when_every_batch_does(self):
+        with self.assertLogs("rag.retrieval_qa", "WARNING"), self.assertRaises(Exception):
+            _merge_quiz([Exception("unparseable")], 3)
+
+
+class QuizViewTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        self.document = Documents.objects.create(user=self.creator, course=course, file="documents/notes.txt")
+
+    def get_quiz(self, number_of_questions, name="quiz"):
+        return self.client.get(reverse(name), {
+            "library_id": self.library.id,
+            "document_id": self.document.id,
+            "number_of_questions": number_of_questions,
+        })
+
+    def test_number_of_questions_out_of_range_is_rejected(self):
+        for name in ("quiz", "asyncQuiz"):
+            for number_of_questions in (-3, 0, BANK_SIZE + 1, "many"):
+                with self.subTest(name=name, number_of_questions=number_of_questions):
+                    self.assertEqual(self.get_quiz(number_of_questions, name).status_code, 400)
+
+    def test_document_that_is_not_ready_is_a_conflict(self):
+        for document_status in (Documents.PENDING, Documents.PROCESSING, Documents.FAILED):
+            Documents.objects.filter(id=self.document.id).update(status=document_status)
+            for name in ("quiz", "asyncQuiz"):
+                with self.subTest(name=name, status=document_status):
+                    response = self.get_quiz(5, name)
+                    self.assertEqual(response.status_code, 409)
+                    self.assertEqual(response.json()["status"], document_status)
+
+
+class ReplaceDocumentTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        self.document = Documents.objects.create(user=self.creator, course=course, file="documents/notes.txt")
+
+    def replace(self, file, library_id=None):
+        return self.client.post(reverse("replaceDocument"), {
+            "library_id": library_id or self.library.id,
+            "doc_id": self.document.id,
+            "file": file,
+        }, format="multipart")
+
+    def test_invalid_file_leaves_the_document_alone(self):
+        response = self.replace(SimpleUploadedFile("notes.exe", b"binary"))
+        self.assertEqual(response.status_code, 400)
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.file.name, "documents/notes.txt")
+
+    def test_document_of_another_library_is_not_found(self):
+        other = Libraries.objects.create(
+            creator=self.creator, library_name="Other", library_description="", entry_key="other"
+        )
+        response = self.replace(SimpleUploadedFile("notes.txt", b"new notes"), library_id=other.id)
+        self.assertEqual(response.status_code, 404)
+
+
+class BulkDocumentsTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        for i in range(4):
+            Documents.objects.create(user=self.creator, course=self.course, file=f"documents/notes_{i}.txt")
+
+    def upload(self, *files):
+        return self.client.post(reverse("bulkDocuments"), {
+            "library_id": self.library.id, "course_id": self.course.id, "files": list(files),
+        }, format="multipart")
+
+    def test_invalid_files_do_not_count_towards_the_limit(self):
+        response = self.upload(SimpleUploadedFile("week5.txt", b"notes"), SimpleUploadedFile("notes.exe", b"binary"))
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertIn("document", response.data["results"][0])
+        self.assertIn("error", response.data["results"][1])
+        self.assertEqual(Documents.objects.filter(course=self.course).count(), 5)
+
+    def test_valid_files_over_the_limit_are_rejected(self):
+        response = self.upload(SimpleUploadedFile("week5.txt", b"notes"), SimpleUploadedFile("week6.txt", b"notes"))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Documents.objects.filter(course=self.course).count(), 4)
+
+
+class DocumentStatusTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        self.document = Documents.objects.create(user=self.creator, course=course, file="documents/notes.txt",
+                                                 status=Documents.READY)
+
+    def get_status(self, library_id=None):
+        return self.client.get(reverse("documentStatus"),
+                               {"library_id": library_id or self.library.id, "doc_id": self.document.id})
+
+    def test_reports_the_ingestion_job_rather_than_the_quiz_bank_fill(self):
+        IngestionJobs.objects.create(document=self.document, kind=IngestionJobs.INGEST,
+                                     status=IngestionJobs.DONE, attempts=1)
+        IngestionJobs.objects.create(document=self.document, kind=IngestionJobs.QUIZ)
+        response = self.get_status()
+        self.assertEqual(response.data["job"], IngestionJobs.INGEST)
+        self.assertEqual(response.data["job_status"], IngestionJobs.DONE)
+
+    def test_document_of_another_library_is_not_found(self):
+        # A member of another library passes the permission check for it
+        other = Libraries.objects.create(
+            creator=self.creator, library_name="Other", library_description="", entry_key="other"
+        )
+        self.assertEqual(self.get_status(library_id=other.id).status_code, 404)
+
+
+class IngestionJobTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        self.document = Documents.objects.create(user=self.creator, course=course, file="documents/notes.txt")
+        patches = [
+            mock.patch("rag.ingestion.delete_from_chromadb"),
+            mock.patch("rag.ingestion.request_fill"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_job_is_claimed_once(self):
+        enqueue_document(self.document)
+        job = claim_job()
+        self.assertEqual((job.status, job.attempts), (IngestionJobs.PROCESSING, 1))
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, Documents.PROCESSING)
+        self.assertIsNone(claim_job())
+
+    def test_abandoned_job_is_reclaimed(self):
+        enqueue_document(self.document)
+        job = claim_job()
+        IngestionJobs.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(seconds=STALE_AFTER + 1))
+        reclaimed = claim_job()
+        self.assertEqual((reclaimed.id, reclaimed.attempts), (job.id, 2))
+
+    @mock.patch("rag.ingestion.process_file", side_effect=RuntimeError("unreadable file"))
+    def test_failed_job_is_retried_with_backoff(self, process_file):
+        job = enqueue_document(self.document)
+        for attempt in range(1, job.max_attempts + 1):
+            # Skips the backoff of the previous attempt
+            IngestionJobs.objects.filter(id=job.id).update(run_after=timezone.now())
+            with self.assertLogs("rag.ingestion", "ERROR"):
+                run_job(claim_job())
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+            if attempt < job.max_attempts:
+                self.assertEqual(job.status, IngestionJobs.PENDING)
+                delay = job.run_after - job.updated_at
+                self.assertAlmostEqual(delay.total_seconds(), RETRY_DELAY * 2 ** (attempt - 1), delta=1)
+                self.assertIsNone(claim_job())
+        self.assertEqual(job.status, IngestionJobs.FAILED)
+        self.assertEqual(job.last_error, "unreadable file")
+        self.document.refresh_from_db()
+        self.assertEqual((self.document.status, self.document.error), (Documents.FAILED, "unreadable file"))
+        self.assertEqual(process_file.call_count, job.max_attempts)
+
+    @mock.patch("rag.ingestion.process_file")
+    def test_done_job_marks_the_document_ready(self, process_file):
+        enqueue_document(self.document)
+        run_job(claim_job())
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, Documents.READY)
+        self.assertEqual(IngestionJobs.objects.get(document=self.document).status, IngestionJobs.DONE)
+
+
+class IngestionHeartbeatTests(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        self.document = Documents.objects.create(user=self.creator, course=course, file="documents/notes.txt")
+
+    def test_job_that_reports_progress_is_not_reclaimed(self):
+        enqueue_document(self.document)
+        job = claim_job()
+        # As long as STALE_AFTER since the job was claimed
+        IngestionJobs.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(seconds=STALE_AFTER + 1))
+        heartbeat([job], interval=0)()
+        self.assertIsNone(claim_job())
+
+    def test_chunks_are_indexed_once(self):
+        for _ in range(2):
+            index_chunks(self.document.course_id, self.document.id, ["chunk"], ["entropy and enthalpy"])
+        self.assertEqual(KeywordChunks.objects.filter(document=self.document).count(), 1)
+        self.assertEqual(KeywordPostings.objects.filter(document=self.document).count(), 2)
+
+
+class PruneIfDueTests(TestCase):
+    @mock.patch("rag.checkpointer.CHECKPOINT_PRUNE_INTERVAL", 60)
+    @mock.patch("rag.checkpointer.CHECKPOINTER", "sqlite")
+    @mock.patch("rag.checkpointer.prune_checkpoints", return_value={})
+    def test_periodic_prune_does_not_vacuum(self, prune):
+        cache.delete("rag:checkpoint_prune")
+        prune_if_due()
+        prune.assert_called_once()
+        self.assertFalse(prune.call_args.kwargs["vacuum"])
+
+
+class KeywordIndexTestCase(QueryCountTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+        self.document = Documents.objects.create(user=self.creator, course=self.course, file="documents/notes.txt")
+
+    def index(self, texts: dict[str, str], document=None):
+        document = document or self.document
+        index_chunks(self.course.id, document.id, list(texts), list(texts.values()))
+        RetrievalCache.bump_version(self.course.id)
+
+
+class KeywordSearchTests(KeywordIndexTestCase):
+    def test_statistics_are_not_recomputed_per_query(self):
+        self.index({"a": "entropy of a gas", "b": "enthalpy of a reaction"})
+        keyword_search(self.course.id, [self.document.id], "entropy", 5)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(keyword_search(self.course.id, [self.document.id], "entropy", 5), ["a"])
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_statistics_follow_the_index_version(self):
+        self.index({"a": "entropy of a gas"})
+        self.assertEqual(keyword_search(self.course.id, [self.document.id], "enthalpy", 5), [])
+        self.index({"b": "enthalpy of a reaction"})
+        self.assertEqual(keyword_search(self.course.id, [self.document.id], "enthalpy", 5), ["b"])
+
+
+class KeywordRankingTests(KeywordIndexTestCase):
+    def test_bm25_ranking(self):
+        self.index({
+            "repeated": "entropy entropy entropy of a gas",
+            "long": "entropy of a gas in a closed container kept at constant volume and temperature",
+            "short": "entropy of a gas",
+            "other": "enthalpy of a reaction",
+        })
+        ranking = keyword_search(self.course.id, [self.document.id], "What is entropy?", 5)
+        self.assertEqual(ranking, ["repeated", "short", "long"])
+        # A rarer term outweighs one found in most chunks
+        self.assertEqual(keyword_search(self.course.id, [self.document.id], "entropy reaction", 1), ["other"])
+
+    def test_only_the_selected_documents_are_searched(self):
+        other = Documents.objects.create(user=self.creator, course=self.course, file="documents/other.txt")
+        self.index({"a": "entropy of a gas"})
+        self.index({"b": "entropy of a reaction"}, document=other)
+        self.assertEqual(keyword_search(self.course.id, [other.id], "entropy", 5), ["b"])
+        self.assertEqual(keyword_search(self.course.id, [self.document.id], "", 5), [])
+
+    def test_reciprocal_rank_fusion(self):
+        # Found by both rankings beats first in one of them
+        self.assertEqual(reciprocal_rank_fusion([["a", "b", "c"], ["c", "b", "d"]]), ["c", "b", "a", "d"])
+
+    def test_hybrid_retriever_fetches_keyword_only_chunks(self):
+        self.index({"dense": "a gas in a container", "keyword": "entropy of a gas"})
+        vectorstore = InMemoryVectorStore(WordCountEmbeddings())
+        vectorstore.add_documents([Document(id="dense", page_content="a gas in a container")])
+        dense = vectorstore.as_retriever(search_kwargs={"k": 1})
+        collection = mock.Mock()
+        collection.get.return_value = {"ids": ["keyword"], "documents": ["entropy of a gas"], "metadatas": [None]}
+        with mock.patch("rag.keyword_index.get_collection", return_value=collection):
+            docs = HybridRetriever(dense=dense, course_id=self.course.id, document_ids=[self.document.id],
+                                   k=2).invoke("entropy")
+        self.assertCountEqual([doc.id for doc in docs], ["dense", "keyword"])
+        collection.get.assert_called_once_with(ids=["keyword"], include=["documents", "metadatas"])
+
+
+class ReindexTests(KeywordIndexTestCase):
+    def setUp(self):
+        super().setUp()
+        client = chromadb.EphemeralClient(ChromaSettings(anonymized_telemetry=False, allow_reset=True))
+        get_chroma_client.set_instance(client)
+        self.addCleanup(get_chroma_client.set_instance, None)
+        self.addCleanup(client.reset)
+        patches = [
+            mock.patch("rag.doc_add.get_embed_model", return_value=DeterministicFakeEmbedding(size=8)),
+            mock.patch("rag.doc_add.embedding_cache", mock.Mock(**{"get.return_value": None})),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.pages = [f"Paragraph {i} on the entropy of a gas." for i in range(30)]
+        store_in_chromadb(self.document.id, self.course.id, self.docs(self.pages))
+
+    @staticmethod
+    def docs(pages: list[str]) -> list[Document]:
+        return [Document(page_content=text, metadata={"page": i}) for i, text in enumerate(pages, start=1)]
+
+    def reindex(self, pages: list[str]) -> dict:
+        return reindex_in_chromadb(self.document.id, self.course.id, self.docs(pages))
+
+    def test_editing_one_paragraph(self):
+        self.pages[4] = "Paragraph 4 on the enthalpy of a reaction."
+        self.assertEqual(self.reindex(self.pages), {"added": 1, "updated": 0, "kept": 29, "removed": 1})
+        self.assertEqual(len(keyword_search(self.course.id, [self.document.id], "enthalpy", 5)), 1)
+        self.assertEqual(len(keyword_search(self.course.id, [self.document.id], "entropy", 50)), 29)
+
+    def test_inserting_a_page_moves_the_others(self):
+        counts = self.reindex(["A new first page on entropy."] + self.pages)
+        self.assertEqual(counts, {"added": 1, "updated": 30, "kept": 0, "removed": 0})
+        stored = get_collection(self.course.id).get(where={"id": self.document.id}, include=["metadatas"])
+        self.assertEqual(sorted(metadata["page"] for metadata in stored["metadatas"]), list(range(1, 32)))
+
+    def test_unchanged_document(self):
+        self.assertEqual(self.reindex(self.pages), {"added": 0, "updated": 0, "kept": 30, "removed": 0})
+        self.assertEqual(self.reindex(self.pages[:20]), {"added": 0, "updated": 0, "kept": 20, "removed": 10})
+        self.assertEqual(KeywordChunks.objects.filter(document=self.document).count(), 20)
+
+
+class MigrateVectorCollectionsTests(KeywordIndexTestCase):
+    def setUp(self):
+        super().setUp()
+        client = chromadb.EphemeralClient(ChromaSettings(anonymized_telemetry=False, allow_reset=True))
+        get_chroma_client.set_instance(client)
+        self.addCleanup(get_chroma_client.set_instance, None)
+        self.addCleanup(client.reset)
+        client.get_or_create_collection("documents").add(
+            ids=["legacy_1", "legacy_2"],
+            embeddings=[[1.0, 0.0], [0.0, 1.0]],
+            documents=["entropy of a gas", "enthalpy of a reaction"],
+            metadatas=[{"id": self.document.id, "text": "entropy of a gas"},
+                       {"id": self.document.id, "text": "enthalpy of a reaction"}],
+        )
+
+    def test_moved_documents_get_a_keyword_index(self):
+        call_command("migrate_vector_collections", stdout=StringIO())
+        self.assertEqual(keyword_search(self.course.id, [self.document.id], "enthalpy", 5), ["legacy_2"])
+        # Running it again doesn't index the chunks twice
+        call_command("migrate_vector_collections", stdout=StringIO())
+        self.assertEqual(KeywordChunks.objects.filter(document=self.document).count(), 2)
+
+
+class MetricsViewTests(QueryCountTestCase):
+    def test_regular_users_and_anonymous_clients_are_refused(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="127.0.0.1").status_code, 403)
+
+    def test_staff_users_can_read_metrics(self):
+        self.creator.is_staff = True
+        self.creator.save()
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+    def test_scraper_token(self):
+        self.client.force_authenticate(None)
+        with mock.patch("rag.views.METRICS_TOKEN", "secret"):
+            self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
+            self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+
+
+class IndexVersionTests(TestCase):
+    def test_evicted_version_never_repeats(self):
+        seen = {RetrievalCache.version(1)}
+        RetrievalCache.bump_version(1)
+        seen.add(RetrievalCache.version(1))
+        # As if the cache backend had culled the key
+        cache.delete(VERSION_KEY.format(course_id=1))
+        self.assertNotIn(RetrievalCache.version(1), seen)
+        self.assertEqual(len(seen), 2)
+
+
+class PermissionTests(QueryCountTestCase):
+    # Whether creator, admin, member and outsider pass each permission class
+    EXPECTED = {
+        IsLibraryCreator: (True, False, False, False),
+        IsLibraryAdmin: (False, True, False, False),
+        IsLibraryCreatorOrAdmin: (True, True, False, False),
+        IsLibraryMember: (True, True, True, False),
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.make_user("admin")
+        Members.objects.create(user=self.admin, library=self.library)
+        Admins.objects.create(user=self.admin, library=self.library)
+        self.member = self.make_user("member")
+        Members.objects.create(user=self.member, library=self.library)
+        self.outsider = self.make_user("outsider")
+
+    def has_permission(self, permission, user, library_id, method="post") -> bool:
+        data = {} if library_id is None else {"library_id": library_id}
+        if method == "get":
+            http_request = APIRequestFactory().get("/", data)
+        else:
+            http_request = APIRequestFactory().post("/", data)
+        force_authenticate(http_request, user=user)
+        return permission().has_permission(APIView().initialize_request(http_request), None)
+
+    def test_roles(self):
+        users = (self.creator, self.admin, self.member, self.outsider)
+        for permission, expected in self.EXPECTED.items():
+            for user, allowed in zip(users, expected):
+                with self.subTest(permission=permission.__name__, user=user.username):
+                    self.assertEqual(self.has_permission(permission, user, self.library.id), allowed)
+
+    def test_member_check_reads_the_query_string_on_get(self):
+        self.assertTrue(self.has_permission(IsLibraryMember, self.member, self.library.id, method="get"))
+        self.assertFalse(self.has_permission(IsLibraryMember, self.outsider, self.library.id, method="get"))
+
+    def test_invalid_or_missing_library_id(self):
+        for permission in self.EXPECTED:
+            for library_id in (None, "", "abc", 999999):
+                with self.subTest(permission=permission.__name__, library_id=library_id):
+                    self.assertFalse(self.has_permission(permission, self.creator, library_id))
+
+    def test_role_is_resolved_once_per_request(self):
+        http_request = APIRequestFactory().post("/", {"library_id": self.library.id})
+        force_authenticate(http_request, user=self.admin)
+        request = APIView().initialize_request(http_request)
+        with CaptureQueriesContext(connection) as context:
+            for permission in self.EXPECTED:
+                permission().has_permission(request, None)
+        self.assertEqual(len(context.captured_queries), 1)
+
+
+@mock.patch("rag.roles.ROLE_CACHE_TTL", 30)
+class CachedRoleTests(PermissionTests):
+    """
+    With roles cached across requests, membership changes made through the
+    API must take effect on the very next request
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.course = Courses.objects.create(course_name="Course", course_description="", library=self.library)
+
+    def get_courses(self, user):
+        self.client.force_authenticate(user)
+        return self.client.get(reverse("getCourses"), {"library_id": self.library.id})
+
+    def add_course(self, user, name):
+        self.client.force_authenticate(user)
+        return self.client.post(reverse("Courses"), {
+            "library_id": self.library.id, "course_name": name, "course_description": "Description",
+        })
+
+    def test_leaving(self):
+        self.assertEqual(self.get_courses(self.member).status_code, 200)
+        response = self.client.delete(reverse("leavLibrary"), {"library_id": self.library.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_courses(self.member).status_code, 403)
+
+    def test_being_removed(self):
+        self.assertEqual(self.get_courses(self.admin).status_code, 200)
+        self.client.force_authenticate(self.creator)
+        response = self.client.delete(reverse("removeMember"),
+                                      {"library_id": self.library.id, "user_id": self.admin.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_courses(self.admin).status_code, 403)
+
+    def test_being_demoted(self):
+        self.assertEqual(self.add_course(self.admin, "First").status_code, 201)
+        self.client.force_authenticate(self.creator)
+        response = self.client.delete(reverse("Admins"),
+                                      {"library_id": self.library.id, "user_id": self.admin.id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.add_course(self.admin, "Second").status_code, 403)
+        # Still a member
+        self.assertEqual(self.get_courses(self.admin).status_code, 200)
+
+    def test_evicted_version_does_not_revive_old_roles(self):
+        self.assertEqual(self.add_course(self.admin, "First").status_code, 201)
+        self.client.force_authenticate(self.creator)
+        self.client.delete(reverse("Admins"), {"library_id": self.library.id, "user_id": self.admin.id},
+                           format="json")
+        # As if the cache backend had culled the key
+        cache.delete(_version_key(self.library.id))
+        self.assertEqual(self.add_course(self.admin, "Second").status_code, 403)
 
-# Create your tests here.
+    def test_roles_are_reused_across_requests(self):
+        self.assertEqual(self.get_courses(self.member).status_code, 200)
+        with CaptureQueriesContext(connection) as context:
+            self.get_courses(self.member)
+        self.assertFalse(any("rag_admins" in query["sql"] for query in context.captured_queries))
@@ -11,10 +11,18 @@ urlpatterns = [
     path("Admins", views.manage_admin, name="Admins"),
     path("Courses", views.manage_course, name="Courses"),
     path("Documents", views.add_document, name="Documents"),
+    path("bulkDocuments", views.add_documents, name="bulkDocuments"),
+    path("replaceDocument", views.replace_document, name="replaceDocument"),
     path("Libraries", views.get_libraries, name="Libraries"),
     path("getDocuments", views.get_documents, name="getDocuments"),
+    path("documentStatus", views.document_status, name="documentStatus"),
     path("getCourses", views.get_courses, name="getCourses"),
     path("getMembers", views.get_members, name="getMembers"),
     path("question", views.query_llm, name="question"),
-    path("quiz", views.quiz, name="quiz")
+    path("questionStream", views.stream_llm, name="questionStream"),
+    path("quiz", views.quiz, name="quiz"),
+    path("asyncQuestion", views.aquery_llm, name="asyncQuestion"),
+    path("asyncQuestionStream", views.astream_llm, name="asyncQuestionStream"),
+    path("asyncQuiz", views.aquiz, name="asyncQuiz"),
+    path("metrics", views.metrics, name="metrics"),
 ]
\ No newline at end of file
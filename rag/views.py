@@ -1,16 +1,31 @@
+import hmac
+import json
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q, Value
+from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import APIException
+from rest_framework.views import APIView
 from .models import  *
 from .permissions import *
 from .serializers import *
 from .roles import *
-from .retrieval_qa import get_chain, get_quiz
-from .doc_add import process_file
+from .retrieval_qa import get_chain, aget_chain, stream_chain, astream_chain, get_quiz, aget_quiz
+from .ingestion import enqueue_document, enqueue_documents
+from .answer_cache import get_answer_cache
+from .metrics import METRICS_TOKEN, registry
+from .renderers import EventStreamRenderer
+from .quiz_bank import BANK_SIZE, asample_questions, request_fill, sample_questions
 
 
 # Create your views here.
@@ -51,7 +66,7 @@ def join_library(request):
         return Response({"error": "Library is full"}, status=status.HTTP_400_BAD_REQUEST)    
     if not library.joinable:
         return Response({"message": "Library is not joinable"}, status=status.HTTP_403_FORBIDDEN)
-    if library.creator == request.user:
+    if library.creator_id == request.user.id:
         return Response({"message": "You are the creator of this library"}, status=status.HTTP_400_BAD_REQUEST)
     if library.members.filter(user=request.user).exists():
         return Response({"message": "Already a member of this library"}, status=status.HTTP_400_BAD_REQUEST)
@@ -67,7 +82,7 @@ def remove_member(request):
     """Remove a member from a library."""
     library_id = request.data.get("library_id")
     user_id = request.data.get("user_id")
-    library = Libraries.objects.get(id=library_id)
+    library = get_library_role(request, library_id).library
     user = User.objects.get(id=user_id)
     member = get_object_or_404(Members, user=user, library=library)
     try:
@@ -84,7 +99,7 @@ def remove_member(request):
 def leave_library(request):
     """Member leaves a library."""
     library_id = request.data.get("library_id")
-    library = Libraries.objects.get(id=library_id)
+    library = get_library_role(request, library_id).library
     user = request.user
     member = get_object_or_404(Members, user=user, library=library)
     try:
@@ -103,9 +118,9 @@ def manage_admin(request):
     library_id = request.data.get("library_id")
     user_id = request.data.get("user_id")
     user = get_object_or_404(User, id=user_id)
-    library = get_object_or_404(Libraries, id=library_id)
+    library = get_library_role(request, library_id).library
     admins = Admins.objects.filter(library=library).count()
-    if library.creator == user:
+    if library.creator_id == user.id:
         return Response({"error": "You cannot add yourself as an admin"}, status=status.HTTP_400_BAD_REQUEST)
     try :
         if request.method == "POST":
@@ -128,7 +143,7 @@ def manage_admin(request):
 def manage_course(request):
     """Add or remove a course from a library."""
     library_id = request.data.get("library_id")
-    library = get_object_or_404(Libraries, id=library_id)
+    library = get_library_role(request, library_id).library
 
     if request.method == "POST":
         serializer = CoursesSerializer(data=request.data)
@@ -172,16 +187,125 @@ def add_document(request):
             user=request.user,
             course=course,
             file=request.FILES["file"],
+            status=Documents.PENDING,
         )
-        process_file(document.file.path, document.id)
-        return Response({"message": "File uploaded successfully", 
+        enqueue_document(document)
+        get_answer_cache().invalidate(course.id)
+        return Response({"message": "File uploaded, processing has started", 
                          "document":DocumentsSerializer(document).data}, 
-                         status=status.HTTP_201_CREATED)
+                         status=status.HTTP_202_ACCEPTED)
     
     except Exception as e:
         if "document" in locals():
             document.delete()  
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated, IsLibraryCreatorOrAdmin])
+def add_documents(request):
+    """Add several documents to a course in one request."""
+    files = request.FILES.getlist("files")
+    if not files:
+        return Response({"error": "No files provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+    course_id = request.data.get("course_id")
+    course = get_object_or_404(Courses, id=course_id)
+
+    # Every file is checked before any is stored
+    results, accepted = [], []
+    for file in files:
+        try:
+            validate_file_size(file)
+            validate_file_extension(file)
+        except ValidationError as e:
+            results.append({"file": file.name, "error": " ".join(e.messages)})
+            continue
+        results.append({"file": file.name})
+        accepted.append((results[-1], file))
+
+    # Only the files that would be stored count towards the limit
+    documents = Documents.objects.filter(course=course).count()
+    if documents + len(accepted) > 5:
+        return Response({"error": f"You can only have 5 documents per course, {5 - documents} more can be added",
+                         "results": results},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    if accepted:
+        with transaction.atomic():
+            created = [
+                Documents.objects.create(user=request.user, course=course, file=file, status=Documents.PENDING)
+                for _, file in accepted
+            ]
+            # Queued together so a worker picks them up as one batch
+            enqueue_documents(created)
+        for (result, _), document in zip(accepted, created):
+            result["document"] = DocumentsSerializer(document).data
+        get_answer_cache().invalidate(course.id)
+
+    return Response({"results": results},
+                    status=status.HTTP_202_ACCEPTED if accepted else status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated, IsLibraryCreatorOrAdmin])
+def replace_document(request):
+    """Replace a document's file, re-indexing only the chunks that changed."""
+    if "file" not in request.FILES:
+        return Response({"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+    doc_id = request.data.get("doc_id")
+    # Scoped to the library the permission check ran against
+    document = get_object_or_404(Documents, id=doc_id, course__library_id=request.data.get("library_id"))
+    if document.status in (Documents.PENDING, Documents.PROCESSING):
+        return Response({"error": "The document is still being processed"}, status=status.HTTP_409_CONFLICT)
+
+    # save(update_fields=...) doesn't run the field validators, and the old
+    # file is gone once the new one is saved
+    file = request.FILES["file"]
+    try:
+        validate_file_size(file)
+        validate_file_extension(file)
+    except ValidationError as e:
+        return Response({"error": " ".join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+
+    old_file = document.file.name
+    document.file = file
+    document.error = ""
+    document.save(update_fields=["file", "error"])
+    if old_file != document.file.name:
+        document.file.storage.delete(old_file)
+
+    # A document that failed to ingest has no chunks to diff against
+    kind = IngestionJobs.REINDEX if document.status == Documents.READY else IngestionJobs.INGEST
+    enqueue_document(document, kind=kind)
+    get_answer_cache().invalidate(document.course_id)
+    return Response({"message": "File replaced, re-indexing has started",
+                     "document": DocumentsSerializer(document).data},
+                     status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsLibraryMember])
+def document_status(request):
+    """Get the processing status of an uploaded document."""
+    doc_id = request.GET.get("doc_id")
+    # Scoped to the library the permission check ran against
+    document = get_object_or_404(Documents, id=doc_id, course__library_id=request.GET.get("library_id"))
+    # The quiz bank fill queued after ingestion says nothing about the index
+    job = document.ingestion_jobs.filter(
+        kind__in=[IngestionJobs.INGEST, IngestionJobs.REINDEX]
+    ).order_by("-created").first()
+    response = {
+        "id": document.id,
+        "status": document.status,
+        "error": document.error,
+        "job": job.kind if job else None,
+        "job_status": job.status if job else None,
+        "attempts": job.attempts if job else 0,
+        "max_attempts": job.max_attempts if job else 0,
+    }
+    return Response(response, status=status.HTTP_200_OK)
         
 
 @api_view(["DELETE"])
@@ -201,7 +325,7 @@ def delete_document(request):
 @permission_classes([IsAuthenticated, IsLibraryCreator])
 def delete_library(request):
     library_id = request.data.get("library_id")
-    library = get_object_or_404(Libraries, id=library_id)
+    library = get_library_role(request, library_id).library
     library.delete()
     return Response({"message": f"{library.library_name} has been deleted"})
 
@@ -226,14 +350,15 @@ def get_libraries(request):
 def get_courses(request):
     """Get all courses for a library."""
     library_id = request.GET.get("library_id")
-    library = get_object_or_404(Libraries, id=library_id)
+    role = get_library_role(request, library_id)
+    library = role.library
     courses = Courses.objects.filter(library=library)
     serializer = CoursesSerializer(courses, many=True)
     response = {
         "header": LibrariesSerializer(library).data,
         "header_active": True,
         "body": serializer.data,
-        "active": has_edit_permission(request.user, library),
+        "active": role.can_edit,
     }
     return Response(response, status=status.HTTP_200_OK)
 
@@ -246,10 +371,10 @@ def get_documents(request):
     course = get_object_or_404(Courses, id=course_id)
     documents = Documents.objects.filter(course=course)
     library_id = request.GET.get("library_id")
-    library = get_object_or_404(Libraries, id=library_id)
+    role = get_library_role(request, library_id)
     serializer = DocumentsSerializer(documents, many=True)
     response = {
-        "permission": has_edit_permission(request.user, library),
+        "permission": role.can_edit,
         "data": serializer.data
     }
     return Response(response, status=status.HTTP_200_OK)
@@ -260,20 +385,23 @@ def get_documents(request):
 def get_members(request):
     """Get all members for a library."""
     library_id = request.GET.get("library_id")
-    library = get_object_or_404(Libraries, id=library_id)
-    admins = Admins.objects.filter(library=library)
+    role = get_library_role(request, library_id)
+    library = role.library
+    admins = Admins.objects.filter(library=library).select_related("user").annotate(is_admin=Value(True))
     admin_serializer = MembersSerializer(admins, many=True)
-    members = Members.objects.filter(library=library)
+    members = Members.objects.filter(library=library).select_related("user").annotate(
+        is_admin=Exists(Admins.objects.filter(user=OuterRef("user"), library=OuterRef("library")))
+    )
     member_serializer = MembersSerializer(members, many=True)
 
     response = {
         "header": "Admins",
-        "header_active" : is_creator(request.user, library),
+        "header_active" : role.is_creator,
         "sub_header": library.entry_key,
         "body": admin_serializer.data,
         "members": member_serializer.data,
         "active": False,
-        "creator": is_creator(request.user, library),
+        "creator": role.is_creator,
     }
     return Response(response, status=status.HTTP_200_OK)
 
@@ -285,7 +413,9 @@ def query_llm(request):
     query = request.GET.get("query")
     course_id = request.GET.get("course_id")
     course = get_object_or_404(Courses, id=course_id)
-    documents = Documents.objects.filter(course=course)
+    # Answers are cached per set of documents, so a document becoming ready
+    # is what moves the course on to fresh answers
+    documents = Documents.objects.filter(course=course, status=Documents.READY)
     document_ids = [document.id for document in documents]
     if not query:
         return Response({"error": "Query is required"}, status=status.HTTP_400_BAD_REQUEST)
@@ -302,12 +432,177 @@ def query_llm(request):
     return Response({"LLM_response": response})
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsLibraryMember])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def stream_llm(request):
+    """Streams the LLM response as server-sent events while it is generated."""
+    query = request.GET.get("query")
+    course_id = request.GET.get("course_id")
+    course = get_object_or_404(Courses, id=course_id)
+    document_ids = list(Documents.objects.filter(course=course, status=Documents.READY).values_list("id", flat=True))
+    if not query:
+        return Response({"error": "Query is required"}, status=status.HTTP_400_BAD_REQUEST)
+    if not document_ids:
+        return Response({"error": "No documents found"}, status=status.HTTP_404_NOT_FOUND)
+
+    def events():
+        try:
+            for token in stream_chain(document_ids, query, course_id, request.user.id):
+                yield f"data: {json.dumps({'token': token})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            return
+        yield "event: end\ndata: {}\n\n"
+
+    return event_stream(events())
+
+
+def event_stream(events) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated, IsLibraryMember])
 def quiz(request):
     """This function is used to generate a quiz."""
     document_id = request.GET.get("document_id")
     document = get_object_or_404(Documents, id=document_id)
-    number_of_questions = request.GET.get("number_of_questions")
-    response = get_quiz(document.id, number_of_questions)
-    return Response(response)
\ No newline at end of file
+    number_of_questions = question_count(request)
+    if number_of_questions is None:
+        return Response({"error": f"number_of_questions must be a number from 1 to {BANK_SIZE}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if document.status != Documents.READY:
+        return Response({"error": "The document is not ready", "status": document.status},
+                        status=status.HTTP_409_CONFLICT)
+    # Sampled from the question bank, which is topped up in the background
+    request_fill(document.id, number_of_questions)
+    questions = sample_questions(document.id, number_of_questions)
+    if questions:
+        return Response(questions)
+    try:
+        response = get_quiz(document.course_id, document.id, number_of_questions)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return Response(response)
+
+
+def question_count(request) -> int | None:
+    """number_of_questions, or None unless it is a whole number from 1 to BANK_SIZE"""
+    try:
+        number_of_questions = int(request.GET.get("number_of_questions"))
+    except (TypeError, ValueError):
+        return None
+    return number_of_questions if 1 <= number_of_questions <= BANK_SIZE else None
+
+
+def authorize(request, permissions) -> Request | None:
+    """
+    Runs DRF authentication and the given permission classes for a plain
+    Django view. Returns the DRF request, or None if access is denied.
+    """
+    drf_request = APIView().initialize_request(request)
+    try:
+        for permission in permissions:
+            if not permission().has_permission(drf_request, None):
+                return None
+    except APIException:
+        return None
+    return drf_request
+
+
+@require_GET
+async def aquery_llm(request):
+    """Async version of query_llm, meant to be served through ASGI."""
+    drf_request = await sync_to_async(authorize)(request, [IsAuthenticated, IsLibraryMember])
+    if drf_request is None:
+        return JsonResponse({"detail": "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+    query = request.GET.get("query")
+    course_id = request.GET.get("course_id")
+    if not await Courses.objects.filter(id=course_id).aexists():
+        return JsonResponse({"error": "Course not found"}, status=status.HTTP_404_NOT_FOUND)
+    document_ids = [doc_id async for doc_id in
+                    Documents.objects.filter(course_id=course_id, status=Documents.READY).values_list("id", flat=True)]
+    if not query:
+        return JsonResponse({"error": "Query is required"}, status=status.HTTP_400_BAD_REQUEST)
+    if not document_ids:
+        return JsonResponse({"error": "No documents found"}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        response = await aget_chain(document_ids, query, course_id, drf_request.user.id)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return JsonResponse({"LLM_response": response})
+
+
+@require_GET
+async def astream_llm(request):
+    """Async version of stream_llm. Only this one streams token by token under ASGI."""
+    drf_request = await sync_to_async(authorize)(request, [IsAuthenticated, IsLibraryMember])
+    if drf_request is None:
+        return JsonResponse({"detail": "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+    query = request.GET.get("query")
+    course_id = request.GET.get("course_id")
+    if not await Courses.objects.filter(id=course_id).aexists():
+        return JsonResponse({"error": "Course not found"}, status=status.HTTP_404_NOT_FOUND)
+    document_ids = [doc_id async for doc_id in
+                    Documents.objects.filter(course_id=course_id, status=Documents.READY).values_list("id", flat=True)]
+    if not query:
+        return JsonResponse({"error": "Query is required"}, status=status.HTTP_400_BAD_REQUEST)
+    if not document_ids:
+        return JsonResponse({"error": "No documents found"}, status=status.HTTP_404_NOT_FOUND)
+
+    async def events():
+        try:
+            async for token in astream_chain(document_ids, query, course_id, drf_request.user.id):
+                yield f"data: {json.dumps({'token': token})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            return
+        yield "event: end\ndata: {}\n\n"
+
+    return event_stream(events())
+
+
+@require_GET
+async def aquiz(request):
+    """Async version of quiz, meant to be served through ASGI."""
+    drf_request = await sync_to_async(authorize)(request, [IsAuthenticated, IsLibraryMember])
+    if drf_request is None:
+        return JsonResponse({"detail": "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+    document_id = request.GET.get("document_id")
+    document = await Documents.objects.filter(id=document_id).values("id", "course_id", "status").afirst()
+    if document is None:
+        return JsonResponse({"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND)
+    number_of_questions = question_count(request)
+    if number_of_questions is None:
+        return JsonResponse({"error": f"number_of_questions must be a number from 1 to {BANK_SIZE}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+    if document["status"] != Documents.READY:
+        return JsonResponse({"error": "The document is not ready", "status": document["status"]},
+                            status=status.HTTP_409_CONFLICT)
+    await sync_to_async(request_fill)(document["id"], number_of_questions)
+    questions = await asample_questions(document["id"], number_of_questions)
+    if questions:
+        return JsonResponse(questions, safe=False)
+    try:
+        response = await aget_quiz(document["course_id"], document["id"], number_of_questions)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return JsonResponse(response, safe=False)
+
+
+@require_GET
+def metrics(request):
+    """Request and stage metrics of this process in Prometheus text format."""
+    # The client address proves nothing behind a reverse proxy on the same host
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    has_token = bool(METRICS_TOKEN) and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")
+    if not has_token and authorize(request, [IsAdminUser]) is None:
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")